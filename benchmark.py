@@ -0,0 +1,301 @@
+"""Load and latency benchmark for VoIPServer.
+
+Starts a real server in a child process on loopback with a synthetic
+clients.json, connects simulated AsyncVoIPClients, drives them with an
+open-loop Poisson load over the configured mix of requests and writes the
+throughput, per-opcode latency percentiles and server CPU/RSS as JSON.
+
+    python benchmark.py --clients 1000 --rate 5000 --duration 20 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+from client.async_api import AsyncVoIPClient
+from utils import security, utils
+from utils.utils import REQUEST_CODES
+
+OPERATIONS = ("ping", "friends_list", "send_text")
+DEFAULT_MIX = "ping=50,friends_list=20,send_text=30"
+
+
+def parse_mix(text: str):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name!r}, expected one of {OPERATIONS}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def write_clients(path: str, count: int):
+    clients = [{"id": f"bench-{i:06d}", "username": f"user{i:06d}"} for i in range(count)]
+    with open(path, 'w') as f:
+        json.dump({"clients": clients}, f)
+    return clients
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port(host: str):
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def process_usage(pid: int):
+    """CPU seconds and resident memory of a process, read from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_bytes": int(status.get("VmRSS", "0 kB").split()[0]) * 1024,
+        "peak_rss_bytes": int(status.get("VmHWM", "0 kB").split()[0]) * 1024,
+    }
+
+
+def summarize(latencies, errors: int = 0):
+    latencies = sorted(latencies)
+    count = len(latencies)
+
+    def percentile(q):
+        return latencies[min(count - 1, int(count * q))] * 1000 if count else 0.0
+
+    return {
+        "count": count,
+        "errors": errors,
+        "mean_ms": sum(latencies) / count * 1000 if count else 0.0,
+        "p50_ms": percentile(0.5),
+        "p99_ms": percentile(0.99),
+        "p999_ms": percentile(0.999),
+        "max_ms": latencies[-1] * 1000 if count else 0.0,
+    }
+
+
+def _run_server(host, port, engine, directory, clients_file, ready, done):
+    from server.server import VoIPServer
+
+    raise_fd_limit()
+    sys.stdout = open(os.devnull, 'w')
+    # Everything the server writes stays in the run's directory, away from a real deployment's files.
+    settings = utils.get_all_settings_from_json().get('server', {})
+    settings = dict(settings,
+                    log=dict(settings.get('log', {}), file=os.path.join(directory, "VoIPServer.log")),
+                    spool=dict(settings.get('spool', {}), path=os.path.join(directory, "spool")),
+                    identity_key=os.path.join(directory, "identity.pem"))
+    server = VoIPServer(host, port, engine, settings=settings)
+    server.load_clients(clients_file)
+    server.start()
+    ready.set()
+    done.wait()
+    server.stop()
+
+
+class LoadGenerator:
+    """Simulated clients hitting one server at a fixed aggregate rate.
+
+    Requests are scheduled open-loop: latency is measured from the moment a
+    request was due, not from when it was actually sent, so a stalled server
+    shows up in the percentiles instead of silently lowering the load.
+    """
+
+    def __init__(self, host: str, port: int, clients, rate: float, mix: dict, duration: float,
+                 connect_concurrency: int = 64, presence: bool = False, timeout: float = 10, key_exchange: str = "rsa"):
+        self.host = host
+        self.port = port
+        self.accounts = clients
+        self.rate = rate
+        self.mix = mix
+        self.duration = duration
+        self.connect_concurrency = connect_concurrency
+        self.presence = presence
+        self.timeout = timeout
+        self.key_exchange = key_exchange
+        self.latencies = {name: [] for name in ("connect",) + OPERATIONS + ("disconnect",)}
+        self.errors = dict.fromkeys(self.latencies, 0)
+        self.clients = []
+
+    async def _connect(self, account, keys, limit):
+        async with limit:
+            client = AsyncVoIPClient(account["id"], self.host, self.port, account["username"], keys, self.key_exchange)
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(client.connect(self.presence), self.timeout)
+            except (OSError, asyncio.TimeoutError, ValueError):
+                self.errors["connect"] += 1
+                return
+            if response.get("code") != REQUEST_CODES["OK"]:
+                self.errors["connect"] += 1
+                return
+            self.latencies["connect"].append(time.perf_counter() - started)
+            self.clients.append(client)
+
+    def _issue(self, name, client):
+        if name == "ping":
+            return client.request(REQUEST_CODES["PING"])
+        if name == "friends_list":
+            return client.request(REQUEST_CODES["FRIENDS_LIST"], {"id": client.id}, encrypted=True)
+        peer = random.choice(self.clients)
+        return client.request(REQUEST_CODES["SEND_TEXT"], {"to": peer.username, "message": "benchmark", "encrypted": True})
+
+    async def _timed(self, name, client, due):
+        loop = asyncio.get_running_loop()
+        try:
+            response = await asyncio.wait_for(self._issue(name, client), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.errors[name] += 1
+            return
+        if response.get("code") != REQUEST_CODES["OK"]:
+            self.errors[name] += 1
+            return
+        self.latencies[name].append(loop.time() - due)
+
+    async def _drive(self, client, rate, deadline):
+        loop = asyncio.get_running_loop()
+        names, weights = list(self.mix), list(self.mix.values())
+        tasks = []
+        due = loop.time() + random.expovariate(rate)
+        while due < deadline:
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(loop.create_task(self._timed(random.choices(names, weights)[0], client, due)))
+            due += random.expovariate(rate)
+        await asyncio.gather(*tasks)
+
+    async def _disconnect(self, client, limit):
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(client.disconnect(), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.errors["disconnect"] += 1
+                return
+            self.latencies["disconnect"].append(time.perf_counter() - started)
+
+    async def run(self, on_phase=None):
+        keys = security.key_pool().take() if self.key_exchange == "rsa" else None
+        limit = asyncio.Semaphore(self.connect_concurrency)
+        on_phase = on_phase or (lambda phase: None)
+
+        on_phase("connect")
+        await asyncio.gather(*(self._connect(account, keys, limit) for account in self.accounts))
+
+        on_phase("load")
+        started = time.perf_counter()
+        if self.clients:
+            rate = self.rate / len(self.clients)
+            deadline = asyncio.get_running_loop().time() + self.duration
+            await asyncio.gather(*(self._drive(client, rate, deadline) for client in self.clients))
+        elapsed = time.perf_counter() - started
+
+        on_phase("disconnect")
+        await asyncio.gather(*(self._disconnect(client, limit) for client in self.clients))
+        on_phase("done")
+
+        completed = sum(len(self.latencies[name]) for name in OPERATIONS)
+        return {
+            "connected": len(self.clients),
+            "load_seconds": elapsed,
+            "completed": completed,
+            "throughput_rps": completed / elapsed if elapsed else 0.0,
+            "operations": {name: summarize(values, self.errors[name]) for name, values in self.latencies.items()},
+        }
+
+
+def run_benchmark(clients: int = 100, rate: float = 1000, duration: float = 10, mix: str = DEFAULT_MIX,
+                  engine: str = "threading", host: str = "127.0.0.1", connect_concurrency: int = 64,
+                  presence: bool = False, timeout: float = 10, key_exchange: str = "rsa"):
+    raise_fd_limit()
+    port = free_port(host)
+    with tempfile.TemporaryDirectory(prefix="voip-bench-") as directory:
+        clients_file = os.path.join(directory, "clients.json")
+        accounts = write_clients(clients_file, clients)
+        ready, done = multiprocessing.Event(), multiprocessing.Event()
+        process = multiprocessing.Process(target=_run_server, args=(host, port, engine, directory, clients_file, ready, done), daemon=True)
+        process.start()
+        try:
+            if not ready.wait(30):
+                raise RuntimeError("Benchmark server did not start")
+            generator = LoadGenerator(host, port, accounts, rate, parse_mix(mix), duration, connect_concurrency, presence, timeout,
+                                      key_exchange)
+            usage = {}
+            results = asyncio.run(generator.run(lambda phase: usage.__setitem__(phase, (time.perf_counter(), process_usage(process.pid)))))
+        finally:
+            done.set()
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+    server = {}
+    if all(usage.get(phase, (0, None))[1] for phase in ("connect", "load", "disconnect", "done")):
+        (load_at, load), (disconnect_at, loaded) = usage["load"], usage["disconnect"]
+        (_, first), (_, last) = usage["connect"], usage["done"]
+        server = {
+            "cpu_seconds": last["cpu_seconds"] - first["cpu_seconds"],
+            "load_cpu_utilization": (loaded["cpu_seconds"] - load["cpu_seconds"]) / (disconnect_at - load_at),
+            "rss_bytes": loaded["rss_bytes"],
+            "peak_rss_bytes": last["peak_rss_bytes"],
+        }
+    results.update({
+        "config": {
+            "clients": clients, "rate": rate, "duration": duration, "mix": parse_mix(mix), "engine": engine,
+            "connect_concurrency": connect_concurrency, "presence": presence, "key_exchange": key_exchange,
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "server": server,
+    })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for VoIPServer.")
+    parser.add_argument("--clients", type=int, default=100, help="simulated clients to connect")
+    parser.add_argument("--rate", type=float, default=1000, help="aggregate requests per second once connected")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of steady load")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted request mix (default {DEFAULT_MIX})")
+    parser.add_argument("--engine", default="threading", choices=("threading", "asyncio"))
+    parser.add_argument("--connect-concurrency", type=int, default=64, help="CONNECTs in flight at once")
+    parser.add_argument("--presence", action="store_true", help="subscribe clients to presence pushes")
+    parser.add_argument("--key-exchange", default="rsa", choices=("rsa", "x25519"), help="how clients agree on session keys")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.clients, args.rate, args.duration, args.mix, args.engine,
+                            connect_concurrency=args.connect_concurrency, presence=args.presence,
+                            key_exchange=args.key_exchange)
+    print(f"{results['connected']} clients, {results['throughput_rps']:.0f} req/s on the {args.engine} engine")
+    for name, stats in results["operations"].items():
+        print(f"{name:>13}: n={stats['count']:<7} err={stats['errors']:<5} p50={stats['p50_ms']:.2f}ms "
+              f"p99={stats['p99_ms']:.2f}ms p999={stats['p999_ms']:.2f}ms")
+    if results["server"]:
+        print(f"server: {results['server']['load_cpu_utilization'] * 100:.0f}% CPU under load, "
+              f"peak RSS {results['server']['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
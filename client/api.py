@@ -1,11 +1,27 @@
-import json
+import itertools
+import logging
+import os
 import socket
+import threading
+from concurrent.futures import Future
 
 from utils import utils, security
+from .media import MediaChannel
+from .presence import PresenceCache
+from .rooms import RoomKeyring
+
+PUSH_CODES = {utils.REQUEST_CODES[name] for name in ("PING", "SEND_TEXT", "CALL", "HANGUP", "PRESENCE", "ROOM_KEY", "ROOM_POST")}
+
+logger = logging.getLogger("VoIPClient")
+
+
+KEY_EXCHANGES = ("rsa", "x25519")
 
 
 class VoIPClient:
-    def __init__(self, id, host='127.0.0.1', port=8080, username="no username"):
+    def __init__(self, id, host='127.0.0.1', port=8080, username="no username", keys=None, key_exchange="rsa", ticket=None):
+        if key_exchange not in KEY_EXCHANGES:
+            raise ValueError(f"Unknown key exchange {key_exchange!r}, expected one of {KEY_EXCHANGES}")
         self.id = id
         self.username = username
         self.host = host
@@ -13,38 +29,235 @@ class VoIPClient:
         self.isConnected = False
         self.message = {}
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.frames = utils.FrameReader()
         self.server_public_key = None
-        self.private_key, self.public_key = security.generate_keys()
-        self.private_key = security.get_private_key(self.private_key)
-        self.public_key = security.get_public_key(self.public_key)
+        self.cipher = None
+        self.binary = False
+        self.inbox = []
+        self.call_id = None
+        self.media = None
+        self.audio = None
+        self.presence = PresenceCache()
+        self.rooms = RoomKeyring()
+        self.timeout = 30
+        self.reader = None
+        self._pending = {}
+        self._request_ids = itertools.count(1)
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self.key_exchange = key_exchange
+        self._exchange_key = None
+        # (ticket, resumption secret) from the last session, to resume it on reconnect.
+        self.ticket = ticket
+        if keys is None and key_exchange == "rsa":
+            keys = security.key_pool().take()
+        # An X25519 session needs no RSA key pair at all.
+        self.private_key, self.public_key = keys or (None, None)
         
     def create_connection(self):
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((self.host, self.port))
+        utils.set_nodelay(self.client_socket)
+        self.frames = utils.FrameReader()
 
     def connect_to_server(self):
+        if self.ticket is not None and self._resume():
+            return
         self.message = {
             "code": utils.REQUEST_CODES["CONNECT"],
             "payload": {
                 "id": str(self.id),
                 "username": str(self.username),
-                "public_key": self.public_key.decode('utf-8')
+                "session": True,
+                "formats": ["binary"],
+                "presence": True
             }
         }
+        if self.public_key:
+            self.message["payload"]["public_key"] = self.public_key.decode('utf-8')
+        if self.key_exchange == "x25519":
+            self._exchange_key = security.generate_exchange_key()
+            self.message["payload"]["exchange_key"] = security.get_exchange_key(self._exchange_key).hex()
         try:
             self.create_connection()
-            response = utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket)
-            response = json.loads(response)
+            response = utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket, frames=self.frames)
+            response = utils.decode_message(response)
             if response.get("code") == utils.REQUEST_CODES["OK"]:
-                print(f"Connected to server as {response.get('payload', 'Unknown')}.")
-                self.isConnected = True
-                self.server_public_key = response.get("public_key")
+                if response.get("exchange_key") and self._exchange_key is not None:
+                    session_key = security.derive_session_key(self._exchange_key, bytes.fromhex(response["exchange_key"]))
+                    self.cipher = security.SessionCipher(session_key)
+                elif response.get("session_key"):
+                    session_key = security.unwrap_session_key(bytes.fromhex(response["session_key"]), self.private_key)
+                    self.cipher = security.SessionCipher(session_key)
+                self._exchange_key = None
+                self._session_started(response)
             else:
                 print(f"Failed to connect: {response.get('payload', 'Unknown error')}")
                 self.client_socket.close()
         except socket.error as e:
             print(f"Failed to connect to server: Server not available.")
 
+    def _resume(self):
+        """Restore the previous session from its ticket in one round trip.
+
+        Returns False when the server refuses the ticket, in which case the
+        caller falls back to a full CONNECT; a busy server is not a refusal.
+        """
+        ticket, secret = self.ticket
+        nonce = os.urandom(16)
+        self.message = {
+            "code": utils.REQUEST_CODES["RESUME"],
+            "payload": {
+                "ticket": ticket,
+                "nonce": nonce.hex(),
+                "proof": security.resume_proof(secret, nonce).hex(),
+                "presence": True
+            }
+        }
+        try:
+            self.create_connection()
+            response = utils.decode_message(utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket, frames=self.frames))
+        except socket.error:
+            self.client_socket.close()
+            return False
+        if response.get("code") == utils.REQUEST_CODES["BUSY"]:
+            # The ticket is still good; a full CONNECT now would only add to the load.
+            print(f"Failed to connect: {response.get('payload')} Retry in {response.get('retry_after', 1)}s.")
+            self.client_socket.close()
+            return True
+        if response.get("code") != utils.REQUEST_CODES["OK"] or not response.get("resumed"):
+            self.ticket = None
+            self.client_socket.close()
+            return False
+        self.cipher = security.SessionCipher(security.resume_session_key(secret, nonce, bytes.fromhex(response["nonce"])))
+        self._session_started(response)
+        return True
+
+    def _session_started(self, response):
+        print(f"Connected to server as {response.get('payload', 'Unknown')}.")
+        self.isConnected = True
+        self.server_public_key = security.load_public_key(response.get("public_key"))
+        self.binary = response.get("format") == "binary"
+        if response.get("ticket") and self.cipher is not None:
+            self.ticket = (response["ticket"], security.derive_resumption_secret(self.cipher.key))
+        self.presence = PresenceCache(response.get("payload"))
+        if response.get("presence"):
+            # The snapshot is queued right behind the reply.
+            while not self.presence.fresh:
+                self._handle_push(self._receive())
+        self._start_reader()
+
+    def _receive(self):
+        return utils.decode_message(utils.receive_message(self.client_socket, self.private_key, self.frames, self.cipher))
+
+    def submit(self, message: dict):
+        """Send a request without waiting for the previous ones.
+
+        Returns a Future resolved with the reply by the background reader, so
+        several requests can be in flight on the connection at once.
+        """
+        future = Future()
+        with self._send_lock:
+            request_id = next(self._request_ids)
+            with self._pending_lock:
+                self._pending[request_id] = future
+            try:
+                utils.send_message(utils.encode_message(dict(message, request_id=request_id), self.binary), self.client_socket, self.server_public_key, self.cipher, self.binary)
+            except socket.error:
+                with self._pending_lock:
+                    self._pending.pop(request_id, None)
+                raise
+        return future
+
+    def _request(self):
+        return self.submit(self.message).result(self.timeout)
+
+    def _start_reader(self):
+        self.reader = threading.Thread(target=self._read, daemon=True, args=[self.client_socket, self.frames, self.cipher])
+        self.reader.start()
+
+    def _read(self, client_socket, frames, cipher):
+        while True:
+            try:
+                frame = frames.read_frame(client_socket)
+            except (OSError, ValueError):
+                # Closed, reset, or a frame too large to ever resync after.
+                break
+            try:
+                self._dispatch(frame, cipher)
+            except Exception as e:
+                logger.error("Failed to handle a frame from the server: %r", e)
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionResetError("Connection to the server was lost"))
+
+    def _dispatch(self, frame, cipher):
+        if utils.is_room_frame(frame):
+            message = self.rooms.open(frame)
+            if message is not None:
+                self._handle_push(message)
+            return
+        message = utils.decode_message(utils.unwrap_message(frame, self.private_key, cipher))
+        with self._pending_lock:
+            future = self._pending.pop(message.get("request_id"), None)
+            if future is None and "request_id" not in message and not self._is_push(message) and self._pending:
+                # A server that does not echo request ids still answers in order.
+                future = self._pending.pop(next(iter(self._pending)))
+        if future is not None:
+            future.set_result(message)
+        else:
+            self._handle_push(message)
+
+    @staticmethod
+    def _is_push(message):
+        return message.get("code") in PUSH_CODES
+
+    def _handle_push(self, message):
+        code = message.get("code")
+        payload = message.get("payload", {})
+        if code == utils.REQUEST_CODES["SEND_TEXT"]:
+            # Messages stored while offline arrive in batches.
+            for text in payload.get("messages", [payload]):
+                self.inbox.append(text)
+                print(f"[{text.get('from')}] {text.get('message')}")
+        elif code == utils.REQUEST_CODES["CALL"]:
+            self._join_call(payload)
+            print(f"Incoming call from {payload.get('from')}.")
+        elif code == utils.REQUEST_CODES["PRESENCE"]:
+            self.presence.apply(payload)
+        elif code == utils.REQUEST_CODES["PING"]:
+            # Server heartbeat: any request proves we are alive.
+            self.submit({"code": utils.REQUEST_CODES["PING"], "payload": {}})
+        elif code == utils.REQUEST_CODES["HANGUP"]:
+            if payload.get("call_id") == self.call_id:
+                self._leave_call()
+                print("Call ended by peer.")
+        elif code == utils.REQUEST_CODES["ROOM_KEY"]:
+            self.rooms.apply(payload)
+        elif code == utils.REQUEST_CODES["ROOM_POST"]:
+            self.inbox.append(payload)
+            print(f"[{payload.get('room')}] [{payload.get('from')}] {payload.get('message')}")
+        else:
+            return False
+        return True
+
+    def _join_call(self, payload):
+        self._leave_call()
+        self.call_id = payload["call_id"]
+        self.media = MediaChannel(self.host, payload["port"], payload["ssrc"], bytes.fromhex(payload["key"]))
+        self.media.open()
+        if self.audio is not None:
+            self.audio.channel = self.media
+
+    def _leave_call(self):
+        if self.audio is not None:
+            self.audio.channel = None
+        if self.media is not None:
+            self.media.close()
+        self.call_id = None
+        self.media = None
+
     def disconnect(self):
         self.message = {
             "code": utils.REQUEST_CODES["DISCONNECT"],
@@ -54,19 +267,37 @@ class VoIPClient:
         }
         try:
             if self.isConnected:
-                response = utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket, self.private_key, self.server_public_key)
-                print(json.loads(response).get("payload"))
-                if json.loads(response).get("code") == utils.REQUEST_CODES["OK"]:
+                response = self._request()
+                print(response.get("payload"))
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
                     self.isConnected = False
             else:
                 print(f"You're not connected.")
-            self.client_socket.close()
+            self._close_socket()
             self.server_public_key = None
+            self.cipher = None
+            self.binary = False
+            self.presence.clear()
+            self.rooms.clear()
+            self._leave_call()
         except socket.error as e:
-            self.client_socket.close()
+            self._close_socket()
             self.server_public_key = None
+            self.cipher = None
+            self.binary = False
             print(f"Error while disconnecting: {e}")
 
+    def _close_socket(self):
+        try:
+            # Wakes the reader thread up even if the server never closes its side.
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.client_socket.close()
+        if self.reader is not None:
+            self.reader.join(self.timeout)
+            self.reader = None
+
     def status(self):
         self.message = {
             "code": utils.REQUEST_CODES["PING"],
@@ -74,8 +305,8 @@ class VoIPClient:
         }
         try:
             if self.isConnected:
-                response = utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket, self.private_key, self.server_public_key)
-                if json.loads(response).get("code") == utils.REQUEST_CODES["OK"]:
+                response = self._request()
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
                     print("Client is connected to the server.")
                 else:
                     print("Client is not connected to the server.")
@@ -87,14 +318,17 @@ class VoIPClient:
     def friends_list(self):
         self.message = {
             "code": utils.REQUEST_CODES["FRIENDS_LIST"],
-            "payload": {'id': self.id},
+            "payload": {'id': self.id, 'subscribe': True},
             "encrypted": True if self.server_public_key else False
         }
         try:
             if self.isConnected:
-                response = utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket, self.private_key, self.server_public_key)
-                if json.loads(response).get("code") == utils.REQUEST_CODES["OK"]:
-                    utils.print_friends(json.loads(response).get("payload"))
+                if self.presence.fresh:
+                    utils.print_friends(sorted(self.presence.online))
+                    return
+                response = self._request()
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
+                    utils.print_friends(response.get("payload"))
                 else:
                     print("An error occurred while fetching friends list.")
             else:
@@ -118,8 +352,7 @@ class VoIPClient:
                         "encrypted": True if self.server_public_key else False
                     }
                 }
-                response = utils.send_message_and_wait_for_response(utils.encode_message(self.message), self.client_socket, self.private_key, self.server_public_key)
-                response = json.loads(response)
+                response = self._request()
                 if response.get("code") == utils.REQUEST_CODES["OK"]:
                     print(f"Message sent to {recipient_username}.")
                 else:
@@ -127,4 +360,131 @@ class VoIPClient:
             else:
                 print("Client is not connected to the server.")
         except socket.error as e:
-            print(f"Server not available: {e}")
\ No newline at end of file
+            print(f"Server not available: {e}")
+
+    def call(self, username):
+        self.message = {
+            "code": utils.REQUEST_CODES["CALL"],
+            "payload": {"to": username}
+        }
+        try:
+            if self.isConnected:
+                response = self._request()
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
+                    self._join_call(response.get("payload"))
+                    print(f"Calling {username}.")
+                else:
+                    print(f"Failed to call: {response.get('payload', 'Unknown error')}")
+            else:
+                print("Client is not connected to the server.")
+        except socket.error as e:
+            print(f"Server not available: {e}")
+
+    def conference(self, usernames):
+        self.message = {
+            "code": utils.REQUEST_CODES["CONFERENCE"],
+            "payload": {"members": list(usernames)}
+        }
+        try:
+            if self.isConnected:
+                response = self._request()
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
+                    self._join_call(response.get("payload"))
+                    print(f"Conference started with {', '.join(usernames)}.")
+                else:
+                    print(f"Failed to start conference: {response.get('payload', 'Unknown error')}")
+            else:
+                print("Client is not connected to the server.")
+        except socket.error as e:
+            print(f"Server not available: {e}")
+
+    def hangup(self):
+        self.message = {
+            "code": utils.REQUEST_CODES["HANGUP"],
+            "payload": {"call_id": self.call_id}
+        }
+        try:
+            if self.isConnected and self.call_id:
+                response = self._request()
+                print(response.get("payload"))
+            else:
+                print("No call in progress.")
+            self._leave_call()
+        except socket.error as e:
+            self._leave_call()
+            print(f"Server not available: {e}")
+
+    def create_room(self, name):
+        self._room_request("ROOM_CREATE", name, f"Room {name} created.")
+
+    def join_room(self, name):
+        self._room_request("ROOM_JOIN", name, f"Joined room {name}.")
+
+    def leave_room(self, name):
+        if self._room_request("ROOM_LEAVE", name, f"Left room {name}."):
+            self.rooms.forget(name)
+
+    def _room_request(self, code, name, done):
+        self.message = {
+            "code": utils.REQUEST_CODES[code],
+            "payload": {"room": name}
+        }
+        try:
+            if self.isConnected:
+                response = self._request()
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
+                    print(done)
+                    return True
+                print(f"Room request failed: {response.get('payload', 'Unknown error')}")
+            else:
+                print("Client is not connected to the server.")
+        except socket.error as e:
+            print(f"Server not available: {e}")
+        return False
+
+    def post_to_room(self, arg):
+        try:
+            if self.isConnected:
+                parts = arg.split(' ', 1)
+                if len(parts) != 2:
+                    print("Usage: post <room> <message>")
+                    return
+                room, message = parts
+                self.message = {
+                    "code": utils.REQUEST_CODES["ROOM_POST"],
+                    "payload": {"room": room, "message": message},
+                    "encrypted": True
+                }
+                response = self._request()
+                if response.get("code") == utils.REQUEST_CODES["OK"]:
+                    print(f"Message posted to {room}.")
+                else:
+                    print(f"Failed to post: {response.get('payload', 'Unknown error')}")
+            else:
+                print("Client is not connected to the server.")
+        except socket.error as e:
+            print(f"Server not available: {e}")
+
+    def attach_audio(self, pipeline):
+        """Drive calls from an AudioPipeline: it follows the current call and is started here."""
+        if self.audio is not None:
+            self.audio.stop()
+        self.audio = pipeline
+        pipeline.channel = self.media
+        pipeline.start()
+
+    def detach_audio(self):
+        if self.audio is not None:
+            self.audio.stop()
+            self.audio.channel = None
+        self.audio = None
+
+    def send_voice(self, pcm: bytes):
+        if self.media is not None:
+            self.media.send_frame(pcm)
+
+    def receive_voice(self, timeout=None):
+        return self.media.receive(timeout) if self.media is not None else None
+
+    def play_voice(self):
+        return self.media.next_frame() if self.media is not None else None
@@ -0,0 +1,203 @@
+import asyncio
+import itertools
+
+from utils import utils, security
+from .api import KEY_EXCHANGES, PUSH_CODES, logger
+from .presence import PresenceCache
+from .rooms import RoomKeyring
+
+
+class AsyncVoIPClient:
+    """asyncio client that pipelines requests over one connection.
+
+    Every request carries a request id; a reader task resolves the matching
+    future when the reply arrives, so any number of requests can be awaited
+    together without paying one round trip each.
+    """
+
+    def __init__(self, id, host='127.0.0.1', port=8080, username="no username", keys=None, key_exchange="rsa"):
+        if key_exchange not in KEY_EXCHANGES:
+            raise ValueError(f"Unknown key exchange {key_exchange!r}, expected one of {KEY_EXCHANGES}")
+        self.id = id
+        self.username = username
+        self.host = host
+        self.port = port
+        self.isConnected = False
+        self.reader = None
+        self.writer = None
+        self.socket = None
+        self.frames = utils.FrameReader()
+        self.server_public_key = None
+        self.cipher = None
+        self.binary = False
+        self.inbox = []
+        self.pushes = asyncio.Queue()
+        self.presence = PresenceCache()
+        self.rooms = RoomKeyring()
+        self._pending = {}
+        self._request_ids = itertools.count(1)
+        self._reader_task = None
+        self._heartbeats = set()
+        self.key_exchange = key_exchange
+        if keys is None and key_exchange == "rsa":
+            keys = security.key_pool().take()
+        # Simulated clients may share one key pair instead of generating thousands.
+        self.private_key, self.public_key = keys or (None, None)
+
+    async def connect(self, presence=True):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        utils.set_nodelay(self.writer.get_extra_info('socket'))
+        self.socket = utils.StreamSocket(self.writer)
+        self.frames = utils.FrameReader()
+        message = {
+            "code": utils.REQUEST_CODES["CONNECT"],
+            "payload": {
+                "id": str(self.id),
+                "username": str(self.username),
+                "session": True,
+                "formats": ["binary"],
+                "presence": presence
+            }
+        }
+        if self.public_key:
+            message["payload"]["public_key"] = self.public_key.decode('utf-8')
+        exchange_key = None
+        if self.key_exchange == "x25519":
+            exchange_key = security.generate_exchange_key()
+            message["payload"]["exchange_key"] = security.get_exchange_key(exchange_key).hex()
+        utils.send_message(utils.encode_message(message), self.socket)
+        await self.writer.drain()
+        response = utils.decode_message(await utils.receive_message_async(self.reader, frames=self.frames))
+        if response.get("code") != utils.REQUEST_CODES["OK"]:
+            self.writer.close()
+            return response
+        self.isConnected = True
+        self.server_public_key = security.load_public_key(response.get("public_key"))
+        self.binary = response.get("format") == "binary"
+        if response.get("exchange_key") and exchange_key is not None:
+            self.cipher = security.SessionCipher(security.derive_session_key(exchange_key, bytes.fromhex(response["exchange_key"])))
+        elif response.get("session_key"):
+            session_key = security.unwrap_session_key(bytes.fromhex(response["session_key"]), self.private_key)
+            self.cipher = security.SessionCipher(session_key)
+        self.presence = PresenceCache(response.get("payload"))
+        if response.get("presence"):
+            while not self.presence.fresh:
+                self._handle_push(await self._receive())
+        self._reader_task = asyncio.get_running_loop().create_task(self._read())
+        return response
+
+    async def _receive(self):
+        return utils.decode_message(await utils.receive_message_async(self.reader, self.private_key, self.frames, self.cipher))
+
+    async def request(self, code, payload=None, encrypted=False):
+        """Send one request and wait for its reply; safe to run many concurrently."""
+        future = asyncio.get_running_loop().create_future()
+        request_id = next(self._request_ids)
+        self._pending[request_id] = future
+        message = {"code": code, "payload": payload if payload is not None else {}, "request_id": request_id}
+        if encrypted:
+            message["encrypted"] = True
+        try:
+            # Encrypting and writing happen in one step, so frames leave in nonce order.
+            utils.send_message(utils.encode_message(message, self.binary), self.socket, self.server_public_key, self.cipher, self.binary)
+            await self.writer.drain()
+        except OSError:
+            self._pending.pop(request_id, None)
+            raise
+        return await future
+
+    async def _read(self):
+        while True:
+            try:
+                frame = await utils.read_frame_async(self.reader, self.frames)
+            except (OSError, ValueError):
+                break
+            try:
+                self._dispatch(frame)
+            except Exception as e:
+                logger.error("Failed to handle a frame from the server: %r", e)
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError("Connection to the server was lost"))
+
+    def _dispatch(self, frame):
+        if utils.is_room_frame(frame):
+            message = self.rooms.open(frame)
+            if message is not None:
+                self._handle_push(message)
+            return
+        message = utils.decode_message(utils.unwrap_message(frame, self.private_key, self.cipher))
+        future = self._pending.pop(message.get("request_id"), None)
+        if future is None and "request_id" not in message and message.get("code") not in PUSH_CODES and self._pending:
+            future = self._pending.pop(next(iter(self._pending)))
+        if future is not None:
+            if not future.done():
+                future.set_result(message)
+        else:
+            self._handle_push(message)
+
+    def _handle_push(self, message):
+        code = message.get("code")
+        payload = message.get("payload", {})
+        if code == utils.REQUEST_CODES["PRESENCE"]:
+            self.presence.apply(payload)
+            return
+        if code == utils.REQUEST_CODES["PING"]:
+            task = asyncio.get_running_loop().create_task(self.ping())
+            self._heartbeats.add(task)
+            task.add_done_callback(self._heartbeats.discard)
+            return
+        if code == utils.REQUEST_CODES["ROOM_KEY"]:
+            self.rooms.apply(payload)
+            return
+        if code == utils.REQUEST_CODES["SEND_TEXT"]:
+            self.inbox.extend(payload.get("messages", [payload]))
+        if code == utils.REQUEST_CODES["ROOM_POST"]:
+            self.inbox.append(payload)
+        self.pushes.put_nowait(message)
+
+    async def ping(self):
+        response = await self.request(utils.REQUEST_CODES["PING"])
+        return response.get("code") == utils.REQUEST_CODES["OK"]
+
+    async def friends_list(self):
+        if self.presence.fresh:
+            return sorted(self.presence.online)
+        response = await self.request(utils.REQUEST_CODES["FRIENDS_LIST"], {"id": self.id, "subscribe": True}, encrypted=True)
+        return response.get("payload", [])
+
+    async def text_friend(self, username, message):
+        return await self.request(utils.REQUEST_CODES["SEND_TEXT"], {"to": username, "message": message, "encrypted": True})
+
+    async def create_room(self, name):
+        return await self.request(utils.REQUEST_CODES["ROOM_CREATE"], {"room": name})
+
+    async def join_room(self, name):
+        return await self.request(utils.REQUEST_CODES["ROOM_JOIN"], {"room": name})
+
+    async def leave_room(self, name):
+        response = await self.request(utils.REQUEST_CODES["ROOM_LEAVE"], {"room": name})
+        if response.get("code") == utils.REQUEST_CODES["OK"]:
+            self.rooms.forget(name)
+        return response
+
+    async def post_to_room(self, name, message):
+        return await self.request(utils.REQUEST_CODES["ROOM_POST"], {"room": name, "message": message}, encrypted=True)
+
+    async def disconnect(self):
+        if not self.isConnected:
+            return None
+        response = await self.request(utils.REQUEST_CODES["DISCONNECT"], {"id": str(self.id)})
+        if response.get("code") == utils.REQUEST_CODES["OK"]:
+            self.isConnected = False
+        self.writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+        self.cipher = None
+        self.server_public_key = None
+        self.binary = False
+        self.presence.clear()
+        self.rooms.clear()
+        return response
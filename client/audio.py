@@ -0,0 +1,457 @@
+import math
+import threading
+import time
+import wave
+from array import array
+
+import numpy as np
+
+from utils import rtp, security
+from .media import MediaChannel
+
+# 16-bit little-endian samples, the PCM carried in RTP payloads.
+PCM = np.dtype('<i2')
+
+
+class AudioRing:
+    """Preallocated ring of PCM samples between an audio device and the pipeline.
+
+    One thread writes (a capture callback, or the pipeline's playout) and
+    one reads; each only moves its own counter after copying, so no lock is
+    needed. Samples that do not fit are dropped and counted rather than
+    overwriting what the reader has not taken yet.
+    """
+
+    def __init__(self, capacity: int):
+        self._samples = np.zeros(capacity, PCM)
+        self._read = 0
+        self._write = 0
+        self.overruns = 0
+        self.underruns = 0
+
+    @property
+    def capacity(self):
+        return len(self._samples)
+
+    def __len__(self):
+        return self._write - self._read
+
+    def write(self, samples):
+        count = min(len(samples), self.capacity - len(self))
+        if count < len(samples):
+            self.overruns += len(samples) - count
+        start = self._write % self.capacity
+        first = min(count, self.capacity - start)
+        np.copyto(self._samples[start:start + first], samples[:first], casting='unsafe')
+        np.copyto(self._samples[:count - first], samples[first:count], casting='unsafe')
+        self._write += count
+        return count
+
+    def read_into(self, out):
+        """Fill ``out`` if that many samples are buffered; returns the count, 0 on underrun."""
+        count = len(out)
+        if len(self) < count:
+            self.underruns += 1
+            return 0
+        start = self._read % self.capacity
+        first = min(count, self.capacity - start)
+        np.copyto(out[:first], self._samples[start:start + first])
+        np.copyto(out[first:], self._samples[:count - first])
+        self._read += count
+        return count
+
+
+class ToneSource:
+    """Sine tone standing in for a microphone, so calls run headless.
+
+    With ``talk_ms`` the tone comes in spurts separated by ``pause_ms`` of
+    silence, which gives the voice activity detector something to do.
+    Samples are copied from one second of precomputed tone.
+    """
+
+    def __init__(self, frequency: float = 440.0, sample_rate: int = rtp.SAMPLE_RATE, amplitude: int = 8000,
+                 talk_ms: int = None, pause_ms: int = 0, duration: float = None):
+        self.sample_rate = sample_rate
+        self._table = (amplitude * np.sin(2 * np.pi * frequency * np.arange(sample_rate) / sample_rate)).astype(PCM)
+        self._talk = talk_ms * sample_rate // 1000 if talk_ms else None
+        self._cycle = (talk_ms + pause_ms) * sample_rate // 1000 if talk_ms else None
+        self._limit = int(duration * sample_rate) if duration is not None else None
+        self._position = 0
+
+    def _tone(self, out, position):
+        start = position % len(self._table)
+        first = min(len(out), len(self._table) - start)
+        np.copyto(out[:first], self._table[start:start + first])
+        np.copyto(out[first:], self._table[:len(out) - first])
+
+    def read_into(self, out):
+        count = len(out) if self._limit is None else max(0, min(len(out), self._limit - self._position))
+        done = 0
+        while done < count:
+            position = self._position + done
+            if self._cycle is None:
+                run = count - done
+                self._tone(out[done:done + run], position)
+            elif position % self._cycle < self._talk:
+                run = min(self._talk - position % self._cycle, count - done)
+                self._tone(out[done:done + run], position)
+            else:
+                run = min(self._cycle - position % self._cycle, count - done)
+                out[done:done + run] = 0
+            done += run
+        self._position += count
+        return count
+
+
+class WavSource:
+    """16-bit PCM WAV file as a capture source; stereo is mixed down to mono.
+
+    The file is decoded once when opened, so reading a frame is a copy.
+    """
+
+    def __init__(self, path: str, loop: bool = False):
+        with wave.open(path, 'rb') as f:
+            if f.getsampwidth() != 2:
+                raise ValueError(f"{path} has {8 * f.getsampwidth()}-bit samples, only 16-bit PCM is supported")
+            self.sample_rate = f.getframerate()
+            channels = f.getnchannels()
+            samples = np.frombuffer(f.readframes(f.getnframes()), PCM)
+        if channels > 1:
+            samples = samples.reshape(-1, channels).mean(axis=1).astype(PCM)
+        self._samples = samples
+        self.loop = loop
+        self._position = 0
+
+    def read_into(self, out):
+        done = 0
+        while done < len(out):
+            if self._position >= len(self._samples):
+                if not self.loop or not len(self._samples):
+                    break
+                self._position = 0
+            run = min(len(out) - done, len(self._samples) - self._position)
+            np.copyto(out[done:done + run], self._samples[self._position:self._position + run])
+            self._position += run
+            done += run
+        return done
+
+
+class WavSink:
+    """Writes played frames to a 16-bit mono WAV file."""
+
+    def __init__(self, path: str, sample_rate: int = rtp.SAMPLE_RATE):
+        self._wave = wave.open(path, 'wb')
+        self._wave.setnchannels(1)
+        self._wave.setsampwidth(2)
+        self._wave.setframerate(sample_rate)
+
+    def write(self, samples):
+        self._wave.writeframes(samples)
+        return len(samples)
+
+    def close(self):
+        self._wave.close()
+
+
+class Resampler:
+    """Linear-interpolation resampler for fixed-size blocks, e.g. 48 kHz capture to 16 kHz.
+
+    Fill ``input`` with one block and ``process`` writes the matching block
+    at the output rate. The last sample of each block is kept so blocks join
+    without a seam. There is no anti-aliasing filter, which is fine for
+    speech but not for music.
+    """
+
+    def __init__(self, from_rate: int, to_rate: int, output_samples: int = rtp.FRAME_SAMPLES):
+        if output_samples * from_rate % to_rate:
+            raise ValueError(f"{output_samples} samples at {to_rate} Hz are not a whole number of samples at {from_rate} Hz")
+        input_samples = output_samples * from_rate // to_rate
+        self.input = np.zeros(input_samples, PCM)
+        # Slot 0 holds the previous block's last sample, at position -1.
+        self._work = np.zeros(input_samples + 1, np.float32)
+        positions = np.arange(output_samples, dtype=np.float64) * from_rate / to_rate + 1
+        self._left = np.floor(positions).astype(np.intp)
+        self._right = np.minimum(self._left + 1, input_samples)
+        self._fraction = (positions - self._left).astype(np.float32)
+        self._a = np.zeros(output_samples, np.float32)
+        self._b = np.zeros(output_samples, np.float32)
+
+    def process(self, out):
+        np.copyto(self._work[1:], self.input, casting='unsafe')
+        np.take(self._work, self._left, out=self._a)
+        np.take(self._work, self._right, out=self._b)
+        np.subtract(self._b, self._a, out=self._b)
+        np.multiply(self._b, self._fraction, out=self._b)
+        np.add(self._a, self._b, out=self._a)
+        np.rint(self._a, out=self._a)
+        np.copyto(out, self._a, casting='unsafe')
+        self._work[0] = self._work[-1]
+        return out
+
+
+class VoiceActivityDetector:
+    """Energy gate picking the frames worth sending.
+
+    A frame is speech when its RMS reaches ``threshold``; the ``hangover``
+    frames after the last loud one count too, so word endings are not cut.
+    The same gate as the conference mixer's.
+    """
+
+    def __init__(self, threshold: float = 300.0, hangover: int = 10, frame_samples: int = rtp.FRAME_SAMPLES):
+        self.threshold = threshold
+        self.hangover = hangover
+        self.energy = 0.0
+        self._work = np.zeros(frame_samples, np.float64)
+        self._hold = 0
+
+    def is_speech(self, frame):
+        np.copyto(self._work, frame, casting='unsafe')
+        self.energy = math.sqrt(np.dot(self._work, self._work) / len(self._work))
+        if self.energy >= self.threshold:
+            self._hold = self.hangover
+            return True
+        if self._hold > 0:
+            self._hold -= 1
+            return True
+        return False
+
+
+class AudioPipeline:
+    """Capture and playout for one call, one frame per 20 ms tick.
+
+    Audio reaches the pipeline through two AudioRings, the way a sound
+    card's callbacks would deliver it: ``pump`` moves one frame period from
+    ``source`` into the capture ring and from the playback ring into
+    ``sink``, while ``tick`` only reads and writes the rings. ``start`` runs
+    the two sides on separate threads, so a slow sink or source never holds
+    up the call.
+
+    Each tick takes a frame from the capture ring, resampling it if the
+    source runs at another rate, and sends it on ``channel`` unless the voice
+    activity detector calls it silence; skipped frames still advance the RTP
+    timestamp and the first frame of a talk spurt carries the marker bit.
+    It then queues the jitter buffer's next frame for playback. Frames live
+    in arrays allocated here, so a tick allocates no sample buffers.
+
+    ``channel`` may change between ticks, e.g. when a call starts or ends.
+    """
+
+    def __init__(self, source=None, sink=None, channel: MediaChannel = None, vad: VoiceActivityDetector = None,
+                 sample_rate: int = rtp.SAMPLE_RATE, frame_samples: int = rtp.FRAME_SAMPLES, buffer_frames: int = 8):
+        self.source = source
+        self.sink = sink
+        self.channel = channel
+        self.vad = vad
+        self.sample_rate = sample_rate
+        self.frame_samples = frame_samples
+        self.frame_seconds = frame_samples / sample_rate
+        self.frame = np.zeros(frame_samples, PCM)
+        self.playout = np.zeros(frame_samples, PCM)
+        self._frame_bytes = memoryview(self.frame).cast('B')
+        self._playout_bytes = memoryview(self.playout).cast('B')
+        source_rate = getattr(source, "sample_rate", sample_rate)
+        self.resampler = Resampler(source_rate, sample_rate, frame_samples) if source_rate != sample_rate else None
+        block = len(self.resampler.input) if self.resampler is not None else frame_samples
+        # Whole frames go in and out of both rings, so neither ever holds a partial one.
+        self.capture_ring = AudioRing(buffer_frames * block)
+        self.playback_ring = AudioRing(buffer_frames * frame_samples)
+        self._captured = np.zeros(block, PCM)
+        self._played = np.zeros(frame_samples, PCM)
+        # RTP sequence of each frame in the playback ring, -1 for concealment.
+        self._sequences = array('q', [-1]) * buffer_frames
+        self._queued = 0
+        self._dequeued = 0
+        self.sequence = -1
+        self.drained = source is None
+        self._talking = False
+        self.captured = 0
+        self.sent = 0
+        self.suppressed = 0
+        self.played = 0
+        self.concealed = 0
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def pump(self):
+        """Device side: one frame period from the source into the capture ring and out of the playback ring into the sink."""
+        if not self.drained:
+            count = self.source.read_into(self._captured)
+            if count:
+                self._captured[count:] = 0
+                self.capture_ring.write(self._captured)
+            if count < len(self._captured):
+                self.drained = True
+        if self.playback_ring.read_into(self._played):
+            self.sequence = self._sequences[self._dequeued % len(self._sequences)]
+            self._dequeued += 1
+            if self.sink is not None:
+                self.sink.write(self._played)
+
+    def capture(self):
+        """Take one frame from the capture ring and send it; False once the source has run dry."""
+        block = self.resampler.input if self.resampler is not None else self.frame
+        drained = self.drained
+        if not self.capture_ring.read_into(block):
+            if drained:
+                return False
+            # The device fell behind: keep the timestamps going over the gap.
+            if self.channel is not None:
+                self.channel.skip_frame(self.frame_samples)
+            self._talking = False
+            return True
+        if self.resampler is not None:
+            self.resampler.process(self.frame)
+        self.captured += 1
+        channel = self.channel
+        if channel is None:
+            return True
+        if self.vad is not None and not self.vad.is_speech(self.frame):
+            channel.skip_frame(self.frame_samples)
+            self.suppressed += 1
+            self._talking = False
+            return True
+        channel.send_frame(self._frame_bytes, self.frame_samples, marker=not self._talking)
+        self._talking = True
+        self.sent += 1
+        return True
+
+    def play(self):
+        """Queue the frame due now for the sink; False while there is none."""
+        channel = self.channel
+        frame = channel.next_frame() if channel is not None else None
+        if frame is None:
+            return False
+        self._playout_bytes[:] = frame
+        concealed = channel.jitter.last_concealed
+        if concealed:
+            self.concealed += 1
+        else:
+            self.played += 1
+        # Label the slot before the frame becomes visible to the device thread.
+        if self.playback_ring.capacity - len(self.playback_ring) >= self.frame_samples:
+            self._sequences[self._queued % len(self._sequences)] = -1 if concealed else channel.jitter.last_sequence
+            self._queued += 1
+        self.playback_ring.write(self.playout)
+        return True
+
+    def tick(self):
+        captured = self.capture() if self.source is not None else True
+        try:
+            self.play()
+        except OSError:
+            # The call ended and its socket closed under us.
+            pass
+        return captured
+
+    def _every_frame(self, step, frames: int = None, phase: float = 0.0):
+        deadline = time.monotonic() + phase
+        if phase:
+            self._stopped.wait(phase)
+        ticks = 0
+        while not self._stopped.is_set() and (frames is None or ticks < frames):
+            if step() is False:
+                break
+            ticks += 1
+            deadline += self.frame_seconds
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                self._stopped.wait(delay)
+        return ticks
+
+    def run(self, frames: int = None):
+        """Tick every frame period until stopped, ``frames`` ticks or the end of the source."""
+        return self._every_frame(self.tick, frames)
+
+    def start(self, frames: int = None):
+        self._stopped.clear()
+        # One frame of head start, so the first tick finds audio waiting. The device then
+        # runs half a frame out of phase with the ticks, so frames wait half a period in a ring on average.
+        self.pump()
+        self._threads = [threading.Thread(target=self._every_frame, args=[self.pump, None, self.frame_seconds / 2],
+                                          name="VoIPAudioDevice", daemon=True),
+                         threading.Thread(target=self.run, args=[frames], name="VoIPAudio", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+class _LatencySink:
+    """Records when each frame reaching the sink was captured, by its RTP sequence number."""
+
+    def __init__(self, captured_at, frames: int):
+        self.pipeline = None
+        self.captured_at = captured_at
+        self.latencies = array('d', [0.0]) * frames
+        self.count = 0
+
+    def write(self, samples):
+        sequence = self.pipeline.sequence
+        if sequence >= 0 and self.count < len(self.latencies):
+            self.latencies[self.count] = (time.monotonic() - self.captured_at[sequence & 0xFFFF]) * 1000
+            self.count += 1
+        return len(samples)
+
+
+def loopback(frames: int = 250, source=None, vad: VoiceActivityDetector = None, host: str = "127.0.0.1"):
+    """Run ``frames`` ticks of audio through two media channels wired back to back over UDP.
+
+    The sending pipeline captures on this thread while the receiving one
+    plays out on its own clock, as the two ends of a call would. Returns
+    the latency from the capture ring to the sink per frame, matched by RTP
+    sequence number, and the frames that never made it, in the shape of
+    ``jitter.replay_trace``.
+    """
+    key = security.generate_session_key()
+    sender = MediaChannel(host, 0, 1, key)
+    receiver = MediaChannel(host, sender.socket.getsockname()[1], 2, key)
+    sender.address = (host, receiver.socket.getsockname()[1])
+    captured_at = array('d', [0.0]) * 0x10000
+    probe = _LatencySink(captured_at, frames)
+    capture = AudioPipeline(source or ToneSource(talk_ms=400, pause_ms=600), channel=sender, vad=vad)
+    playout = probe.pipeline = AudioPipeline(sink=probe, channel=receiver)
+    playout.start()
+    ticks = 0
+    deadline = time.monotonic()
+    try:
+        while ticks < frames:
+            capture.pump()
+            captured_at[sender.sequence] = time.monotonic()
+            if not capture.capture():
+                break
+            ticks += 1
+            deadline += capture.frame_seconds
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        # Let the receiver play out what is still buffered.
+        give_up = time.monotonic() + receiver.jitter.max_delay_ms / 1000
+        jitter = receiver.jitter
+        while ((playout.played + jitter.late + jitter.skipped < capture.sent or len(playout.playback_ring))
+               and time.monotonic() < give_up):
+            time.sleep(capture.frame_seconds / 4)
+    finally:
+        playout.stop()
+        sender.close()
+        receiver.close()
+    jitter = receiver.jitter
+    latency = sorted(probe.latencies[:probe.count])
+    return {
+        "frames": ticks,
+        "sent": capture.sent,
+        "suppressed": capture.suppressed,
+        "played": playout.played,
+        "concealed": playout.concealed,
+        "late": jitter.late,
+        "skipped": jitter.skipped,
+        "dropped": capture.sent - playout.played,
+        "mean_latency_ms": sum(latency) / len(latency) if latency else 0.0,
+        "p50_latency_ms": latency[len(latency) // 2] if latency else 0.0,
+        "p95_latency_ms": latency[int(len(latency) * 0.95)] if latency else 0.0,
+        "max_latency_ms": latency[-1] if latency else 0.0,
+        "target_delay_ms": jitter.target_depth * jitter.frame_ms,
+    }
@@ -0,0 +1,231 @@
+import math
+import random
+from array import array
+
+import numpy as np
+
+from utils import rtp
+
+
+class JitterBuffer:
+    """Receive-side jitter buffer for fixed-size PCM frames.
+
+    Frames live in a preallocated ring of slots indexed by extended sequence
+    number, so out-of-order packets simply land in their slot. The playout
+    depth follows the RFC 3550 inter-arrival jitter estimate: the buffer waits
+    a tick when it runs dry and skips a frame when it holds more than it
+    needs. Missing frames are concealed by repeating the last good frame with
+    a fading gain, then silence.
+    """
+
+    def __init__(self, frame_bytes: int = rtp.FRAME_BYTES, frame_ms: int = 20, capacity: int = 64,
+                 min_delay_ms: int = 20, max_delay_ms: int = 400, jitter_factor: float = 3.0,
+                 sample_rate: int = rtp.SAMPLE_RATE, fade: float = 0.5, max_concealed: int = 5):
+        self.frame_bytes = frame_bytes
+        self.frame_ms = frame_ms
+        self.capacity = capacity
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.jitter_factor = jitter_factor
+        self.fade = fade
+        self.max_concealed = max_concealed
+        self._samples_per_ms = sample_rate / 1000
+        self._slots = bytearray(capacity * frame_bytes)
+        self._view = memoryview(self._slots)
+        self._sequences = array('q', [-1]) * capacity
+        self._last = bytearray(frame_bytes)
+        self._last_samples = np.frombuffer(self._last, dtype=np.int16)
+        self._output = bytearray(frame_bytes)
+        self._output_samples = np.frombuffer(self._output, dtype=np.int16)
+        self._faded = np.zeros(len(self._output_samples), dtype=np.float32)
+        self._highest = None
+        self._lowest = None
+        self._next = None
+        self._previous_arrival = None
+        self._previous_timestamp = None
+        self._concealed_run = 0
+        self.jitter_ms = 0.0
+        self.received = 0
+        self.played = 0
+        self.concealed = 0
+        self.late = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.last_sequence = None
+        self.last_concealed = False
+
+    @property
+    def target_depth(self):
+        frames = math.ceil((self.min_delay_ms + self.jitter_factor * self.jitter_ms) / self.frame_ms)
+        return max(1, min(frames, self.max_delay_ms // self.frame_ms, self.capacity - 1))
+
+    @property
+    def next_sequence(self):
+        return self._next
+
+    @property
+    def depth(self):
+        if self._highest is None:
+            return 0
+        start = self._lowest if self._next is None else self._next
+        return max(0, self._highest - start + 1)
+
+    def _extend(self, sequence: int):
+        if self._highest is None:
+            return sequence
+        delta = (sequence - self._highest) & 0xFFFF
+        if delta >= 0x8000:
+            delta -= 0x10000
+        return self._highest + delta
+
+    def _update_jitter(self, timestamp: int, arrival_ms: float):
+        if self._previous_arrival is not None:
+            media_delta = (timestamp - self._previous_timestamp) & 0xFFFFFFFF
+            if media_delta >= 0x80000000:
+                media_delta -= 0x100000000
+            deviation = abs((arrival_ms - self._previous_arrival) - media_delta / self._samples_per_ms)
+            self.jitter_ms += (deviation - self.jitter_ms) / 16
+        self._previous_arrival = arrival_ms
+        self._previous_timestamp = timestamp
+
+    def put(self, sequence: int, timestamp: int, payload, arrival_ms: float):
+        extended = self._extend(sequence)
+        self._update_jitter(timestamp, arrival_ms)
+        if self._next is not None and extended < self._next:
+            self.late += 1
+            return False
+        slot = extended % self.capacity
+        if self._sequences[slot] == extended:
+            self.duplicates += 1
+            return False
+        if self._next is not None and extended >= self._next + self.capacity:
+            # The ring would wrap onto unplayed frames: jump ahead instead.
+            resume = extended - self.capacity + 1
+            self.skipped += resume - self._next
+            self._next = resume
+        self._sequences[slot] = extended
+        start = slot * self.frame_bytes
+        size = min(len(payload), self.frame_bytes)
+        self._view[start:start + size] = payload[:size]
+        if size < self.frame_bytes:
+            self._view[start + size:start + self.frame_bytes] = bytes(self.frame_bytes - size)
+        if self._highest is None or extended > self._highest:
+            self._highest = extended
+        if self._lowest is None or extended < self._lowest:
+            self._lowest = extended
+        self.received += 1
+        return True
+
+    def get(self):
+        """Return the frame to play on this tick, or None while still filling.
+
+        The returned view is reused by the next call.
+        """
+        if self._highest is None:
+            return None
+        if self._next is None:
+            if self.depth < self.target_depth:
+                return None
+            self._next = self._lowest
+
+        if self.depth > self.target_depth + 1 and self._sequences[(self._next + 1) % self.capacity] == self._next + 1:
+            self._sequences[self._next % self.capacity] = -1
+            self._next += 1
+            self.skipped += 1
+
+        slot = self._next % self.capacity
+        if self._sequences[slot] == self._next:
+            start = slot * self.frame_bytes
+            self._last[:] = self._view[start:start + self.frame_bytes]
+            self._sequences[slot] = -1
+            self.last_sequence = self._next
+            self.last_concealed = False
+            self._concealed_run = 0
+            self._next += 1
+            self.played += 1
+            return memoryview(self._last)
+
+        if self._next <= self._highest:
+            # Lost or too late to wait for: give up on it.
+            self._next += 1
+        return self._conceal()
+
+    def _conceal(self):
+        self._concealed_run += 1
+        self.concealed += 1
+        self.last_sequence = None
+        self.last_concealed = True
+        if self._concealed_run > self.max_concealed:
+            self._output[:] = bytes(self.frame_bytes)
+        else:
+            gain = self.fade ** (self._concealed_run - 1)
+            np.multiply(self._last_samples, gain, out=self._faded)
+            # Truncates toward zero, like int().
+            np.copyto(self._output_samples, self._faded, casting='unsafe')
+        return memoryview(self._output)
+
+
+def synthetic_trace(count: int = 500, frame_ms: int = 20, base_delay_ms: float = 40, jitter_ms: float = 15,
+                    loss: float = 0.02, reorder: float = 0.02, spike_every: int = 0, spike_ms: float = 120, seed: int = 1):
+    """Build a deterministic packet trace of (sequence, send_ms, arrival_ms).
+
+    ``arrival_ms`` is None for lost packets. Reordering delays a packet by a
+    couple of frames; ``spike_every`` adds a periodic delay spike.
+    """
+    generator = random.Random(seed)
+    trace = []
+    for sequence in range(count):
+        send_ms = sequence * frame_ms
+        if generator.random() < loss:
+            trace.append((sequence, send_ms, None))
+            continue
+        delay = base_delay_ms + abs(generator.gauss(0, jitter_ms))
+        if generator.random() < reorder:
+            delay += 2 * frame_ms
+        if spike_every and sequence % spike_every == 0:
+            delay += spike_ms
+        trace.append((sequence, send_ms, send_ms + delay))
+    return trace
+
+
+def replay_trace(trace, buffer: JitterBuffer = None, frame_ms: int = 20, samples_per_frame: int = rtp.FRAME_SAMPLES):
+    """Feed a packet trace through a jitter buffer on a simulated clock.
+
+    Returns the achieved mouth-to-ear latency and concealment figures.
+    """
+    buffer = buffer or JitterBuffer(frame_ms=frame_ms)
+    send_times = {sequence: send_ms for sequence, send_ms, _ in trace}
+    arrivals = sorted((arrival, sequence) for sequence, _, arrival in trace if arrival is not None)
+    payload = bytearray(buffer.frame_bytes)
+    latencies = []
+    now = arrivals[0][0] if arrivals else 0
+    end = (arrivals[-1][0] if arrivals else 0) + buffer.max_delay_ms + frame_ms
+    last_sequence = max(send_times, default=-1)
+    index = 0
+    while now <= end and not (buffer.next_sequence is not None and buffer.next_sequence > last_sequence):
+        while index < len(arrivals) and arrivals[index][0] <= now:
+            arrival, sequence = arrivals[index]
+            payload[:2] = (sequence & 0x7FFF).to_bytes(2, 'little')
+            buffer.put(sequence & 0xFFFF, (sequence * samples_per_frame) & 0xFFFFFFFF, payload, arrival)
+            index += 1
+        if buffer.get() is not None and not buffer.last_concealed:
+            latencies.append(now - send_times[buffer.last_sequence])
+        now += frame_ms
+
+    latencies.sort()
+    rendered = buffer.played + buffer.concealed
+    return {
+        "frames": len(trace),
+        "lost_in_network": sum(1 for _, _, arrival in trace if arrival is None),
+        "played": buffer.played,
+        "concealed": buffer.concealed,
+        "late": buffer.late,
+        "skipped": buffer.skipped,
+        "concealment_rate": buffer.concealed / rendered if rendered else 0.0,
+        "mean_latency_ms": sum(latencies) / len(latencies) if latencies else 0.0,
+        "p50_latency_ms": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p95_latency_ms": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        "max_latency_ms": latencies[-1] if latencies else 0.0,
+        "jitter_ms": buffer.jitter_ms,
+        "target_delay_ms": buffer.target_depth * frame_ms,
+    }
@@ -0,0 +1,79 @@
+import random
+import socket
+import time
+
+from cryptography.exceptions import InvalidTag
+
+from utils import rtp, security
+from .jitter import JitterBuffer
+
+
+class MediaChannel:
+    """UDP media leg of one call, carrying encrypted RTP voice frames.
+
+    Frames are sealed with the call key handed out over the control
+    connection and sent to the server's media relay, which forwards them to
+    the other leg.
+    """
+
+    def __init__(self, host: str, port: int, ssrc: int, key: bytes, payload_type: int = rtp.PCM_PAYLOAD_TYPE):
+        self.address = (host, port)
+        self.ssrc = ssrc
+        self.payload_type = payload_type
+        self.cipher = security.MediaCipher(key)
+        self.sequence = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(("", 0))
+        self._buffer = bytearray(rtp.MAX_PACKET_SIZE)
+        self._view = memoryview(self._buffer)
+        self.jitter = JitterBuffer()
+
+    def open(self):
+        # An empty packet lets the relay latch our address before we talk.
+        self._send(b"")
+
+    def _send(self, payload: bytes, marker: bool = False):
+        header = rtp.pack_header(self.sequence, self.timestamp, self.ssrc, self.payload_type, marker)
+        self.socket.sendto(header + self.cipher.seal(header, payload), self.address)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+
+    def send_frame(self, pcm: bytes, samples: int = rtp.FRAME_SAMPLES, marker: bool = False):
+        self._send(pcm, marker)
+        self.timestamp = (self.timestamp + samples) & 0xFFFFFFFF
+
+    def skip_frame(self, samples: int = rtp.FRAME_SAMPLES):
+        """Account for a frame that was not sent, e.g. silence, so timestamps stay on the media clock."""
+        self.timestamp = (self.timestamp + samples) & 0xFFFFFFFF
+
+    def receive(self, timeout: float = None):
+        self.socket.settimeout(timeout)
+        while True:
+            try:
+                size, _ = self.socket.recvfrom_into(self._buffer)
+            except (socket.timeout, BlockingIOError):
+                # A zero timeout makes the socket non-blocking, which reports an empty queue this way.
+                return None
+            if size < rtp.RTP_HEADER.size:
+                continue
+            header = self._view[:rtp.RTP_HEADER.size]
+            try:
+                sequence, timestamp, ssrc, payload_type = rtp.unpack_header(header)
+                payload = self.cipher.open(header, self._view[rtp.RTP_HEADER.size:size])
+            except (ValueError, InvalidTag):
+                continue
+            if payload:
+                return rtp.Packet(sequence, timestamp, ssrc, payload_type, payload)
+
+    def next_frame(self):
+        """Move every packet that has arrived into the jitter buffer and
+        return the frame to play now; call once per 20 ms playout tick."""
+        while True:
+            packet = self.receive(timeout=0)
+            if packet is None:
+                break
+            self.jitter.put(packet.sequence, packet.timestamp, packet.payload, time.monotonic() * 1000)
+        return self.jitter.get()
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,35 @@
+class PresenceCache:
+    """Client-side copy of the online list kept current from presence pushes."""
+
+    def __init__(self, username=None):
+        self.username = username
+        self.version = None
+        self.online = set()
+
+    @property
+    def fresh(self):
+        return self.version is not None
+
+    def apply(self, payload):
+        """Apply a snapshot or delta; False when a delta was missed and a resync is needed."""
+        if "online" in payload:
+            self.online = set(payload["online"])
+            self.online.discard(self.username)
+            self.version = payload["version"]
+            return True
+        if self.version is None:
+            return False
+        if payload["version"] <= self.version:
+            return True
+        if payload["version"] != self.version + 1:
+            self.version = None
+            return False
+        self.online.difference_update(payload.get("left", []))
+        self.online.update(payload.get("joined", []))
+        self.online.discard(self.username)
+        self.version = payload["version"]
+        return True
+
+    def clear(self):
+        self.version = None
+        self.online = set()
@@ -0,0 +1,53 @@
+from cryptography.exceptions import InvalidTag
+
+from utils import utils, security
+
+
+class RoomKeyring:
+    """Group keys of the rooms a client is in, pushed by the server.
+
+    Only the current epoch of each room is kept, and sequence numbers must
+    grow within an epoch, so frames from before a rekey or replayed ones
+    are dropped.
+    """
+
+    def __init__(self):
+        self.ciphers = {}
+        self.members = {}
+        self._last_seq = {}
+
+    def apply(self, payload: dict):
+        room, epoch = payload["room"], payload["epoch"]
+        current = self.ciphers.get(room)
+        if current is not None and current.epoch >= epoch:
+            return False
+        self.ciphers[room] = security.GroupCipher(bytes.fromhex(payload["key"]), epoch)
+        self.members[room] = payload.get("members", [])
+        self._last_seq[room] = 0
+        return True
+
+    def forget(self, room):
+        self.ciphers.pop(room, None)
+        self.members.pop(room, None)
+        self._last_seq.pop(room, None)
+
+    def open(self, frame):
+        """Decoded message of a room frame, or None if it cannot or must not be read."""
+        room, epoch, seq, header, ciphertext = utils.parse_room_frame(frame)
+        cipher = self.ciphers.get(room)
+        if cipher is None or cipher.epoch != epoch or seq <= self._last_seq[room]:
+            return None
+        try:
+            message = utils.decode_message(cipher.open(seq, ciphertext, header))
+        except InvalidTag:
+            return None
+        self._last_seq[room] = seq
+        return message
+
+    def __contains__(self, room):
+        return room in self.ciphers
+
+    def clear(self):
+        self.ciphers.clear()
+        self.members.clear()
+        self._last_seq.clear()
@@ -1,7 +1,12 @@
 import cmd2
+import os
 import sys
 
 from client.api import VoIPClient
+from client.audio import AudioPipeline, ToneSource, VoiceActivityDetector, WavSink, WavSource, loopback
+from utils import security
+
+KEY_DIR = os.path.join(os.path.expanduser("~"), ".voip")
 
 class VoIPClientCLI(cmd2.Cmd):
     def __init__(self, id, host='127.0.0.1', port=8080):
@@ -11,7 +16,9 @@ class VoIPClientCLI(cmd2.Cmd):
         self.port = port
         self.id = id
         self.prompt = "(VoIPClientCLI) "
-        self.client = VoIPClient(id=self.id, host=self.host, port=self.port)
+        # Loaded once from disk; reconnecting reuses the same identity.
+        self.keys = security.load_identity(os.path.join(KEY_DIR, f"{id}.pem"))
+        self.client = VoIPClient(id=self.id, host=self.host, port=self.port, keys=self.keys)
 
     def do_connect(self, arg):
         """Connect the client to the server. Usage: connect"""
@@ -24,12 +31,62 @@ class VoIPClientCLI(cmd2.Cmd):
             self.client.client_socket.close()
         except:
             pass
-        self.client = VoIPClient(self.id, self.host, self.port)
+        self.client = VoIPClient(self.id, self.host, self.port, keys=self.keys, ticket=self.client.ticket)
         
     def do_send_text(self, arg):
         """Send a text message to someone. Usage: send_text <recipient_username> <message>"""
         self.client.text_friend(arg)
 
+    def do_create_room(self, arg):
+        """Create a chat room and join it. Usage: create_room <room>"""
+        self.client.create_room(arg.strip())
+
+    def do_join_room(self, arg):
+        """Join a chat room. Usage: join_room <room>"""
+        self.client.join_room(arg.strip())
+
+    def do_leave_room(self, arg):
+        """Leave a chat room. Usage: leave_room <room>"""
+        self.client.leave_room(arg.strip())
+
+    def do_post(self, arg):
+        """Post a message to a chat room. Usage: post <room> <message>"""
+        self.client.post_to_room(arg)
+
+    def do_call(self, arg):
+        """Start a voice call with a friend. Usage: call <recipient_username>"""
+        self.client.call(arg.strip())
+
+    def do_conference(self, arg):
+        """Start a conference call. Usage: conference <username> [<username> ...]"""
+        self.client.conference(arg.split())
+
+    def do_hangup(self, arg):
+        """End the current call. Usage: hangup"""
+        self.client.hangup()
+
+    def do_audio(self, arg):
+        """Feed calls from a WAV file or a test tone, recording what is heard. Usage: audio <file.wav|tone|off> [record.wav]"""
+        args = arg.split()
+        if not args:
+            self.poutput("Usage: audio <file.wav|tone|off> [record.wav]")
+            return
+        audio = self.client.audio
+        self.client.detach_audio()
+        if audio is not None and isinstance(audio.sink, WavSink):
+            audio.sink.close()
+        if args[0] == "off":
+            return
+        source = ToneSource(talk_ms=1000, pause_ms=1000) if args[0] == "tone" else WavSource(args[0], loop=True)
+        sink = WavSink(args[1]) if len(args) > 1 else None
+        self.client.attach_audio(AudioPipeline(source, sink, vad=VoiceActivityDetector()))
+
+    def do_loopback(self, arg):
+        """Measure frame latency and drops of the audio path over local UDP. Usage: loopback [frames]"""
+        stats = loopback(int(arg) if arg else 250, vad=VoiceActivityDetector())
+        for name, value in stats.items():
+            self.poutput(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
+
     def do_status(self, arg):
         """Check client status on the server. Usage: status"""
         self.client.status()
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from utils import utils
+
+
+class TokenBucket:
+    """Allows ``rate`` events per second on average and bursts of up to ``burst``."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now: float, cost: float = 1):
+        """Spend ``cost`` tokens; returns 0 on success, else seconds until they would be available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+    def full(self, now: float):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """One token bucket per key and opcode, for the opcodes given in ``limits``.
+
+    ``limits`` maps opcode names to ``[rate, burst]``. Buckets are created on
+    first use; ``prune`` drops those that have refilled, so the table only
+    holds keys that were active within about ``burst / rate`` seconds.
+    """
+
+    def __init__(self, limits: dict = None, clock=time.monotonic):
+        self.limits = {utils.REQUEST_CODES[name]: (float(rate), float(burst)) for name, (rate, burst) in (limits or {}).items()}
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def check(self, key, code):
+        """0 if ``key`` may send ``code`` now, else seconds to wait before retrying."""
+        limit = self.limits.get(code)
+        if limit is None:
+            return 0
+        now = self.clock()
+        with self._lock:
+            bucket = self._buckets.get((key, code))
+            if bucket is None:
+                bucket = self._buckets[(key, code)] = TokenBucket(*limit, now)
+            return bucket.take(now)
+
+    def prune(self):
+        now = self.clock()
+        with self._lock:
+            for key in [key for key, bucket in self._buckets.items() if bucket.full(now)]:
+                del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionControl:
+    """Decides which connections and requests the server takes on.
+
+    New connections are refused with BUSY while ``max_handshakes`` are
+    already being negotiated or ``max_sessions`` are live, so a reconnect
+    storm queues in the client's backoff rather than in the server's CPU.
+    Requests are then rate limited per client id and per remote address.
+    """
+
+    PRUNE_INTERVAL = 1.0
+
+    def __init__(self, settings: dict = None, clock=time.monotonic):
+        settings = settings or {}
+        self.clock = clock
+        self.backlog = settings.get('backlog', 128)
+        self.handshake_timeout = settings.get('handshake_timeout', 5)
+        self.max_handshakes = settings.get('max_handshakes', 128)
+        self.max_handshake_frame = settings.get('max_handshake_frame', 64 * 1024)
+        self.max_sessions = settings.get('max_sessions')
+        limits = settings.get('rate_limits', {})
+        self.by_client = RateLimiter(limits.get('client'), clock)
+        self.by_address = RateLimiter(limits.get('address'), clock)
+        self.handshakes = 0
+        self.shed = 0
+        self.limited = 0
+        self._pruned = clock()
+        self._lock = threading.Lock()
+
+    def begin_handshake(self, sessions: int):
+        """Reserve a handshake slot; False if the server is too busy to take the connection."""
+        with self._lock:
+            if self.handshakes >= self.max_handshakes or (self.max_sessions is not None and sessions >= self.max_sessions):
+                self.shed += 1
+                return False
+            self.handshakes += 1
+            return True
+
+    def end_handshake(self):
+        with self._lock:
+            self.handshakes -= 1
+
+    def check(self, code, client_id=None, address=None):
+        """0 if the request may go ahead, else seconds the sender should wait."""
+        wait = max(self.by_client.check(client_id, code) if client_id is not None else 0,
+                   self.by_address.check(address, code) if address is not None else 0)
+        if wait:
+            self.limited += 1
+        return wait
+
+    def prune(self):
+        """Forget idle rate limit buckets, at most once per ``PRUNE_INTERVAL``; called from the tick loop."""
+        now = self.clock()
+        if now - self._pruned < self.PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        self.by_client.prune()
+        self.by_address.prune()
+
+
+def busy(message: str, retry_after: float = None):
+    response = {"code": utils.REQUEST_CODES["BUSY"], "payload": message}
+    if retry_after is not None:
+        response["retry_after"] = round(retry_after, 3)
+    return response
@@ -0,0 +1,175 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from collections import namedtuple
+
+from utils import utils
+from .directory import directory_from_settings
+
+PresenceEntry = namedtuple("PresenceEntry", ["id", "username", "worker"])
+
+
+class ClusterNode:
+    """One worker's view of the cluster.
+
+    Presence lives in two manager dicts shared by every worker (client id to
+    ``(worker, username)`` and username to ``(worker, id)``), so duplicate
+    logins, FRIENDS_LIST and routing see users on other workers. Messages for
+    a client on another worker are forwarded over that worker's Unix datagram
+    socket.
+    """
+
+    def __init__(self, index: int, presence, usernames, ipc_dir: str, workers: int, logger: logging.Logger = None):
+        self.index = index
+        self.presence = presence
+        self.usernames = usernames
+        self.paths = [os.path.join(ipc_dir, f"worker-{i}.sock") for i in range(workers)]
+        self.socket = None
+        self.thread = None
+        self.forwarded = 0
+        self.received = 0
+        self.logger = logger or logging.getLogger("VoIPServer")
+
+    def bind(self, deliver):
+        """Listen for forwarded messages and hand them to ``deliver(client_id, message)``."""
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.paths[self.index])
+        self.thread = threading.Thread(target=self._receive, daemon=True, args=[deliver])
+        self.thread.start()
+
+    def _receive(self, deliver):
+        # A datagram can be no larger than the sender's send buffer, and every
+        # worker uses the same one, so a buffer of that size holds any of them.
+        buffer = bytearray(self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+        view = memoryview(buffer)
+        while True:
+            try:
+                size = self.socket.recv_into(buffer)
+            except OSError:
+                break
+            try:
+                envelope = json.loads(view[:size].tobytes())
+                self.received += 1
+                deliver(envelope["to"], envelope["message"])
+            except Exception as e:
+                self.logger.error("Failed to deliver a forwarded message: %s", e, extra={"event": "forward_error"})
+
+    def claim(self, id, username):
+        """Register a login cluster-wide; False if another worker holds it."""
+        entry = (self.index, username)
+        current = self.presence.setdefault(id, entry)
+        if tuple(current) != entry:
+            return False
+        self.usernames[username] = (self.index, id)
+        return True
+
+    def release(self, id):
+        entry = self.presence.get(id)
+        if entry is not None and entry[0] == self.index:
+            self.presence.pop(id, None)
+            self.usernames.pop(entry[1], None)
+
+    def find(self, username):
+        entry = self.usernames.get(username)
+        return entry[1] if entry is not None else None
+
+    def online(self, exclude=None):
+        return [username for id, (_, username) in self.presence.items() if id != exclude]
+
+    def broadcast(self, message: dict):
+        """Send a message addressed to no client to every other worker."""
+        data = json.dumps({"to": None, "message": message}).encode('utf-8')
+        for index, path in enumerate(self.paths):
+            if index != self.index:
+                try:
+                    self.socket.sendto(data, path)
+                except OSError:
+                    pass
+
+    def forward(self, client_id, message: dict):
+        entry = self.presence.get(client_id)
+        if entry is None or entry[0] == self.index:
+            return False
+        try:
+            self.socket.sendto(json.dumps({"to": client_id, "message": message}).encode('utf-8'), self.paths[entry[0]])
+        except OSError:
+            return False
+        self.forwarded += 1
+        return True
+
+
+def _run_worker(index, host, port, engine, presence, usernames, ipc_dir, workers, ready):
+    from .server import VoIPServer
+
+    node = ClusterNode(index, presence, usernames, ipc_dir, workers)
+    server = VoIPServer(host, port, engine, cluster=node)
+    server.start()
+    ready.release()
+    threading.Event().wait()
+
+
+class VoIPCluster:
+    """Runs VoIPServer in several worker processes sharing one port.
+
+    Every worker binds the port with SO_REUSEPORT, so the kernel spreads
+    incoming connections across processes and cores.
+    """
+
+    def __init__(self, host: str, port: int, workers: int = None, engine: str = "threading"):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.engine = engine
+        self.running = False
+        self.processes = []
+        self.manager = None
+        self.ipc_dir = None
+        self.directory = directory_from_settings(utils.get_all_settings_from_json().get('server', {}).get('directory'))
+
+    def start(self):
+        self.manager = multiprocessing.Manager()
+        presence, usernames = self.manager.dict(), self.manager.dict()
+        self.ipc_dir = tempfile.mkdtemp(prefix="voip-")
+        ready = multiprocessing.Semaphore(0)
+        for index in range(self.workers):
+            process = multiprocessing.Process(
+                target=_run_worker,
+                args=(index, self.host, self.port, self.engine, presence, usernames, self.ipc_dir, self.workers, ready),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+        self.presence = presence
+        self.running = True
+        for _ in self.processes:
+            if not ready.acquire(timeout=60):
+                self.stop()
+                raise RuntimeError("VoIP cluster workers failed to start")
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+        if self.ipc_dir is not None:
+            shutil.rmtree(self.ipc_dir, ignore_errors=True)
+            self.ipc_dir = None
+        self.running = False
+
+    @property
+    def available_clients(self):
+        if not self.running:
+            return []
+        return [PresenceEntry(id, username, worker) for id, (worker, username) in self.presence.items()]
+
+    def describe(self):
+        return f"VoIPCluster -- {self.workers} {self.engine} workers on {self.host}:{self.port} --"
@@ -0,0 +1,162 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+
+class CryptoExecutor:
+    """Pool of threads running the server's expensive cryptography.
+
+    OpenSSL releases the GIL inside RSA and bulk AES, so plain threads keep
+    that work off the listeners and the event loop without pickling keys to
+    other processes. The queue is bounded: ``submit`` raises ``queue.Full``
+    rather than letting a backlog grow, and callers then do the work
+    themselves.
+
+    A worker takes every job already queued, up to ``batch``, and runs them
+    back to back; results bound for an event loop are handed over with one
+    wakeup per batch instead of one per job.
+
+    Urgent jobs, such as a PING sealed in an RSA envelope, skip that queue:
+    workers run them before their next queued job, so they wait for at most
+    the job already running rather than for a whole backlog of bulk work.
+    """
+
+    _WAKE = object()
+
+    def __init__(self, workers: int = 4, queue_size: int = 1024, batch: int = 32, metrics=None):
+        self.workers = workers
+        self.batch = batch
+        self._queue = queue.Queue(queue_size)
+        self._urgent = collections.deque()
+        self._threads = []
+        self.batches = 0
+        self._waited = self._ran = None
+        if metrics is not None:
+            self._waited = metrics.histogram("crypto_queue_seconds", help="Time an offloaded crypto job waited for a worker")
+            self._ran = metrics.histogram("crypto_job_seconds", help="Time a worker spent on one offloaded crypto job")
+            metrics.gauge("crypto_queue_depth", self._queue.qsize, "Crypto jobs waiting for a worker")
+            metrics.gauge("crypto_batches_total", lambda: self.batches, "Batches of crypto jobs run by the workers")
+
+    def start(self):
+        for index in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f"VoIPCrypto-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, loop=None, urgent=False):
+        """Queue ``fn(*args)``; the future belongs to ``loop`` if one is given."""
+        future = loop.create_future() if loop is not None else concurrent.futures.Future()
+        job = (fn, args, future, loop, time.perf_counter())
+        if not urgent:
+            self._queue.put_nowait(job)
+            return future
+        if len(self._urgent) >= self._queue.maxsize:
+            raise queue.Full
+        self._urgent.append(job)
+        try:
+            # Wakes an idle worker; busy ones look at the urgent jobs between their own.
+            self._queue.put_nowait(self._WAKE)
+        except queue.Full:
+            pass
+        return future
+
+    def run(self, fn, *args, urgent=False):
+        """``fn(*args)`` on a worker, or right here when the queue is full."""
+        if not self._threads:
+            return fn(*args)
+        try:
+            future = self.submit(fn, *args, urgent=urgent)
+        except queue.Full:
+            return fn(*args)
+        return future.result()
+
+    async def run_async(self, loop, fn, *args, urgent=False):
+        if not self._threads:
+            return fn(*args)
+        try:
+            future = self.submit(fn, *args, loop=loop, urgent=urgent)
+        except queue.Full:
+            return fn(*args)
+        return await future
+
+    def _work(self):
+        running = True
+        while running:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.batch:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in jobs:
+                running = False
+                # Stop signals meant for the other workers go back in the queue.
+                for _ in range(jobs.count(None) - 1):
+                    self._queue.put(None)
+                jobs = [job for job in jobs if job is not None]
+            jobs = [job for job in jobs if job is not self._WAKE]
+            if jobs:
+                self.batches += 1
+            settled = {}
+            for job in jobs:
+                self._run_urgent()
+                self._run(job, settled)
+            self._run_urgent()
+            self._hand_over(settled)
+
+    def _run_urgent(self):
+        try:
+            job = self._urgent.popleft()
+        except IndexError:
+            return
+        self.batches += 1
+        settled = {}
+        while job is not None:
+            self._run(job, settled)
+            try:
+                job = self._urgent.popleft()
+            except IndexError:
+                job = None
+        self._hand_over(settled)
+
+    def _run(self, job, settled):
+        fn, args, future, loop, queued = job
+        started = time.perf_counter()
+        try:
+            outcome = (fn(*args), None)
+        except Exception as e:
+            outcome = (None, e)
+        if self._ran is not None:
+            self._waited.observe(started - queued)
+            self._ran.observe(time.perf_counter() - started)
+        if loop is None:
+            self._settle([(future, outcome)])
+        else:
+            settled.setdefault(loop, []).append((future, outcome))
+
+    def _hand_over(self, settled):
+        for loop, outcomes in settled.items():
+            try:
+                loop.call_soon_threadsafe(self._settle, outcomes)
+            except RuntimeError:
+                # The loop was closed under us; nobody is waiting any more.
+                pass
+
+    @staticmethod
+    def _settle(outcomes):
+        for future, (result, error) in outcomes:
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
@@ -0,0 +1,230 @@
+import abc
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+from utils import utils
+
+
+class ClientDirectory(abc.ABC):
+    """Accounts allowed to connect, looked up by id or username.
+
+    Entries are plain dicts with at least ``id`` and ``username``, the shape
+    of the records in clients.json.
+    """
+
+    @abc.abstractmethod
+    def get(self, id):
+        """The account with ``id``, or None."""
+
+    @abc.abstractmethod
+    def by_username(self, username):
+        """The account called ``username``, or None."""
+
+    @abc.abstractmethod
+    def add(self, client: dict):
+        """Insert or update one account."""
+
+    @abc.abstractmethod
+    def remove(self, id):
+        """Delete the account with ``id``; True if there was one."""
+
+    def refresh(self):
+        """Pick up changes made to the backing store by someone else; True if it changed."""
+        return False
+
+    def close(self):
+        pass
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    @abc.abstractmethod
+    def __iter__(self):
+        """Every account, in no particular order."""
+
+    @abc.abstractmethod
+    def __len__(self):
+        """How many accounts there are."""
+
+
+class JsonDirectory(ClientDirectory):
+    """clients.json held in memory behind id and username indexes.
+
+    The file is re-read when its modification time changes, so accounts
+    edited by hand show up without a restart. Writes replace the file
+    atomically; for large directories prefer :class:`SqliteDirectory`.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.path.join(utils.base_dir, '..', 'clients.json')
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_username = {}
+        self._stamp = None
+        self.refresh()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _index(self, clients):
+        self._by_id = {client['id']: client for client in clients}
+        self._by_username = {client.get('username'): client for client in clients}
+
+    def refresh(self):
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return False
+        try:
+            clients = utils.get_all_clients_from_json(self.path)
+        except ValueError:
+            # Caught mid-write by an editor; keep the old copy and retry on the next tick.
+            return False
+        with self._lock:
+            self._index(clients)
+            self._stamp = stamp
+        return True
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def by_username(self, username):
+        return self._by_username.get(username)
+
+    def add(self, client: dict):
+        with self._lock:
+            clients = dict(self._by_id)
+            clients[client['id']] = dict(client)
+            self._write(list(clients.values()))
+            self._index(list(clients.values()))
+
+    def remove(self, id):
+        with self._lock:
+            clients = dict(self._by_id)
+            if clients.pop(id, None) is None:
+                return False
+            self._write(list(clients.values()))
+            self._index(list(clients.values()))
+            return True
+
+    def _write(self, clients):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".clients-", suffix=".json")
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"clients": clients}, f, indent=4)
+        os.replace(temp_path, self.path)
+        self._stamp = self._stat()
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+class SqliteDirectory(ClientDirectory):
+    """Accounts in an SQLite table indexed by id and username.
+
+    Lookups are single index probes and writes touch one row, so the
+    directory can hold hundreds of thousands of accounts without loading
+    them. Every query reads the database directly, which makes changes by
+    other processes (another worker, an admin script) visible immediately.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS clients ("
+            "id TEXT PRIMARY KEY, username TEXT NOT NULL, data TEXT NOT NULL DEFAULT '{}'"
+            ") WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS clients_username ON clients (username)")
+
+    @staticmethod
+    def _row(row):
+        if row is None:
+            return None
+        id, username, data = row
+        return {**json.loads(data), "id": id, "username": username}
+
+    @staticmethod
+    def _values(client: dict):
+        data = {key: value for key, value in client.items() if key not in ("id", "username")}
+        return client['id'], client.get('username', "Unknown"), json.dumps(data)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self._db.execute(sql, args).fetchone()
+
+    def get(self, id):
+        return self._row(self._query("SELECT id, username, data FROM clients WHERE id = ?", (id,)))
+
+    def by_username(self, username):
+        return self._row(self._query("SELECT id, username, data FROM clients WHERE username = ? LIMIT 1", (username,)))
+
+    def add(self, client: dict):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO clients (id, username, data) VALUES (?, ?, ?)", self._values(client))
+
+    def add_many(self, clients):
+        """Bulk insert in one transaction, e.g. to import clients.json."""
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany("INSERT OR REPLACE INTO clients (id, username, data) VALUES (?, ?, ?)",
+                                     (self._values(client) for client in clients))
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def remove(self, id):
+        with self._lock:
+            return self._db.execute("DELETE FROM clients WHERE id = ?", (id,)).rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __iter__(self):
+        with self._lock:
+            rows = self._db.execute("SELECT id, username, data FROM clients ORDER BY id").fetchall()
+        return (self._row(row) for row in rows)
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM clients")[0]
+
+
+BACKENDS = {"json": JsonDirectory, "sqlite": SqliteDirectory}
+
+
+def open_directory(path: str = None, backend: str = None):
+    """Open the directory at ``path``; the backend defaults from the file extension."""
+    if backend is None:
+        backend = "sqlite" if path and os.path.splitext(path)[1] in (".db", ".sqlite", ".sqlite3") else "json"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown directory backend {backend!r}, expected one of {tuple(BACKENDS)}")
+    if backend == "sqlite" and path is None:
+        raise ValueError("The sqlite directory backend needs a path")
+    return BACKENDS[backend](path)
+
+
+def directory_from_settings(settings: dict = None, path: str = None, backend: str = None):
+    """Open the directory described by the ``directory`` block of the server settings.
+
+    A relative ``path`` in the settings is taken from the project root, next to settings.json.
+    """
+    settings = settings or {}
+    if path is None and settings.get('path'):
+        path = os.path.join(utils.base_dir, '..', settings['path'])
+    return open_directory(path, backend or settings.get('backend'))
@@ -0,0 +1,159 @@
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, RotatingFileHandler
+
+# Attributes every LogRecord has; anything else was passed through ``extra``.
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the fields given through ``extra``."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep one in ``rates[event]`` records of each noisy event.
+
+    Warnings and errors are never sampled. Kept records carry ``sampled``
+    with the rate so counts can be scaled back up.
+    """
+
+    def __init__(self, rates: dict = None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        event = getattr(record, "event", None)
+        every = self.rates.get(event, 1)
+        if every <= 1:
+            return True
+        counter = self._counters.get(event)
+        if counter is None:
+            counter = self._counters.setdefault(event, itertools.count())
+        if next(counter) % every:
+            return False
+        record.sampled = every
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the writer thread without ever blocking the caller.
+
+    Records are queued as they are; formatting happens on the writer. When
+    the queue is full the record is counted in ``dropped`` and discarded.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(threading.Thread):
+    """Drains the log queue in batches into a size-rotated file."""
+
+    def __init__(self, log_queue: queue.Queue, path: str, max_bytes: int = 10 * 2 ** 20, backups: int = 5,
+                 batch_size: int = 256, formatter: logging.Formatter = None):
+        super().__init__(name="VoIPLogWriter", daemon=True)
+        self.queue = log_queue
+        self.batch_size = batch_size
+        self.formatter = formatter or JsonFormatter()
+        self.file = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        self.written = 0
+        self._stopped = False
+
+    def run(self):
+        while not self._stopped:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+        self.file.close()
+
+    def _write(self, batch):
+        stream = self.file.stream
+        size = stream.tell()
+        written = 0
+        for record in batch:
+            if record is None:
+                self._stopped = True
+                continue
+            try:
+                line = self.formatter.format(record) + "\n"
+            except Exception:
+                continue
+            # JSON lines are ASCII, so characters are bytes here.
+            if self.file.maxBytes and size and size + len(line) > self.file.maxBytes:
+                self.file.doRollover()
+                stream, size = self.file.stream, 0
+            stream.write(line)
+            size += len(line)
+            written += 1
+        stream.flush()
+        self.written += written
+
+    def stop(self, timeout: float = 5):
+        if self.is_alive():
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.join(timeout)
+
+
+def configure(name: str, path: str, level="INFO", max_bytes: int = 10 * 2 ** 20, backups: int = 5,
+              sample: dict = None, queue_size: int = 10000):
+    """Attach the queue-backed pipeline for ``path`` to logger ``name`` and return ``(logger, handler)``.
+
+    The pipeline is reused while the path stays the same; a different path
+    replaces it, so two files never share one writer.
+    """
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        if isinstance(handler, DroppingQueueHandler):
+            if handler.writer.file.baseFilename == os.path.abspath(path):
+                return logger, handler
+            logger.removeHandler(handler)
+            handler.writer.stop()
+    log_queue = queue.Queue(queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sample))
+    handler.writer = LogWriter(log_queue, path, max_bytes, backups)
+    handler.writer.start()
+    atexit.register(handler.writer.stop)
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger, handler
@@ -0,0 +1,216 @@
+import logging
+import random
+import socket
+import threading
+import time
+import uuid
+
+from cryptography.exceptions import InvalidTag
+
+from utils import rtp, security as sc
+
+
+class MediaCall:
+    """One call on the media relay: its key and the legs taking part.
+
+    A conference call also carries a mixer and one outgoing SSRC per
+    participant for the mixed stream the relay sends back.
+    """
+
+    __slots__ = ("id", "key", "ssrcs", "clients", "addresses", "mixer", "cipher", "out_ssrcs", "sequence", "timestamp")
+
+    def __init__(self, id, key, mixer=None):
+        self.id = id
+        self.key = key
+        self.ssrcs = {}
+        self.clients = {}
+        self.addresses = {}
+        self.mixer = mixer
+        self.cipher = sc.MediaCipher(key) if mixer is not None else None
+        self.out_ssrcs = {}
+        self.sequence = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+
+    def peer_of(self, client_id):
+        return next((other for other in self.ssrcs if other != client_id), None)
+
+    def receive_ssrc_of(self, client_id):
+        if self.mixer is not None:
+            return self.out_ssrcs.get(client_id)
+        return self.ssrcs.get(self.peer_of(client_id))
+
+
+class MediaRelay:
+    """UDP relay forwarding RTP packets between the legs of a call.
+
+    Packets are routed on their SSRC and the address of each leg is latched
+    from its first packet. Two-party calls stay encrypted end to end: the
+    relay never decrypts them. Conference calls are decrypted into a
+    ConferenceMixer and each participant gets the mix back every 20 ms.
+    """
+
+    TICK = rtp.FRAME_SAMPLES / rtp.SAMPLE_RATE
+
+    def __init__(self, host: str, port: int = 0, logger: logging.Logger = None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.logger = logger or logging.getLogger("VoIPServer")
+        self.thread = None
+        self.mixing_thread = None
+        self.relayed = 0
+        self.mixed = 0
+        self.dropped = 0
+        self._calls = {}
+        self._legs = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._relay, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.socket.close()
+
+    def _new_ssrc(self, call):
+        ssrc = random.getrandbits(32)
+        while ssrc in self._legs or ssrc in call.out_ssrcs.values():
+            ssrc = random.getrandbits(32)
+        return ssrc
+
+    def create_call(self, *client_ids):
+        call = MediaCall(str(uuid.uuid4()), sc.generate_session_key())
+        with self._lock:
+            for client_id in client_ids:
+                ssrc = self._new_ssrc(call)
+                call.ssrcs[client_id] = ssrc
+                call.clients[ssrc] = client_id
+                self._legs[ssrc] = call
+            self._calls[call.id] = call
+        return call
+
+    def create_conference(self, client_ids, **mixer_options):
+        from .mixer import ConferenceMixer
+
+        call = MediaCall(str(uuid.uuid4()), sc.generate_session_key(), ConferenceMixer(**mixer_options))
+        with self._lock:
+            for client_id in client_ids:
+                if not call.mixer.add(client_id):
+                    break
+                ssrc = self._new_ssrc(call)
+                call.ssrcs[client_id] = ssrc
+                call.clients[ssrc] = client_id
+                self._legs[ssrc] = call
+                call.out_ssrcs[client_id] = self._new_ssrc(call)
+            self._calls[call.id] = call
+            if self.mixing_thread is None:
+                self.mixing_thread = threading.Thread(target=self._mix, daemon=True)
+                self.mixing_thread.start()
+        return call
+
+    def leave_call(self, call_id, client_id):
+        """Drop one participant; the call ends once fewer than two remain."""
+        with self._lock:
+            call = self._calls.get(call_id)
+            if call is None or client_id not in call.ssrcs:
+                return None
+            ssrc = call.ssrcs.pop(client_id)
+            call.clients.pop(ssrc, None)
+            call.addresses.pop(ssrc, None)
+            call.out_ssrcs.pop(client_id, None)
+            self._legs.pop(ssrc, None)
+            if call.mixer is not None:
+                call.mixer.remove(client_id)
+        if len(call.ssrcs) < 2:
+            self.end_call(call_id)
+        return call
+
+    def get_call(self, call_id):
+        return self._calls.get(call_id)
+
+    def end_call(self, call_id):
+        with self._lock:
+            call = self._calls.pop(call_id, None)
+            if call is not None:
+                for ssrc in call.ssrcs.values():
+                    self._legs.pop(ssrc, None)
+            return call
+
+    def calls_of(self, client_id):
+        return [call for call in list(self._calls.values()) if client_id in call.ssrcs]
+
+    def _relay(self):
+        buffer = bytearray(rtp.MAX_PACKET_SIZE)
+        view = memoryview(buffer)
+        while True:
+            try:
+                size, address = self.socket.recvfrom_into(buffer)
+            except OSError:
+                break
+            if size < rtp.RTP_HEADER.size:
+                self.dropped += 1
+                continue
+            ssrc = rtp.peek_ssrc(buffer)
+            call = self._legs.get(ssrc)
+            if call is None:
+                self.dropped += 1
+                continue
+            latched = call.addresses.setdefault(ssrc, address)
+            if latched != address:
+                self.dropped += 1
+                continue
+            if call.mixer is not None:
+                self._collect(call, ssrc, view[:size])
+                continue
+            for other, other_address in list(call.addresses.items()):
+                if other != ssrc:
+                    try:
+                        self.socket.sendto(view[:size], other_address)
+                        self.relayed += 1
+                    except OSError as e:
+                        self.logger.error("Failed to relay media packet of call %s: %s", call.id, e, extra={"event": "relay_error", "call": call.id})
+
+    def _collect(self, call, ssrc, packet):
+        header = packet[:rtp.RTP_HEADER.size]
+        try:
+            payload = call.cipher.open(header, packet[rtp.RTP_HEADER.size:])
+        except InvalidTag:
+            self.dropped += 1
+            return
+        if payload:
+            call.mixer.push(call.clients.get(ssrc), payload)
+
+    def _mix(self):
+        deadline = time.monotonic()
+        while True:
+            deadline += self.TICK
+            with self._lock:
+                conferences = [call for call in self._calls.values() if call.mixer is not None]
+                if not conferences:
+                    # The next conference starts a new thread; the check and the reset share the lock.
+                    self.mixing_thread = None
+                    return
+            for call in conferences:
+                try:
+                    self._send_mix(call)
+                except OSError as e:
+                    self.logger.error("Failed to send conference mix of call %s: %s", call.id, e, extra={"event": "mix_error", "call": call.id})
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.monotonic()
+
+    def _send_mix(self, call):
+        ids, output, audible = call.mixer.mix()
+        for client_id, frame, hear in zip(ids, output, audible):
+            address = call.addresses.get(call.ssrcs.get(client_id))
+            out_ssrc = call.out_ssrcs.get(client_id)
+            if not hear or address is None or out_ssrc is None:
+                continue
+            header = rtp.pack_header(call.sequence, call.timestamp, out_ssrc)
+            self.socket.sendto(header + call.cipher.seal(header, frame.tobytes()), address)
+            self.mixed += 1
+        call.sequence = (call.sequence + 1) & 0xFFFF
+        call.timestamp = (call.timestamp + rtp.FRAME_SAMPLES) & 0xFFFFFFFF
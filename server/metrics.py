@@ -0,0 +1,181 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are recorded in whole microseconds. Below ``2 ** significant_bits``
+    every value has its own bucket; above it each power of two is split into
+    ``2 ** (significant_bits - 1)`` buckets, which bounds the relative error
+    of any percentile to under 2% while recording stays one index
+    computation and one increment.
+    """
+
+    def __init__(self, significant_bits: int = 7, max_seconds: float = 3600):
+        self._bits = significant_bits
+        self._half = 1 << (significant_bits - 1)
+        self._limit = int(max_seconds * 1_000_000)
+        self._counts = [0] * (self._index(self._limit) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def _index(self, value: int):
+        if value < (1 << self._bits):
+            return value
+        shift = value.bit_length() - self._bits
+        return (shift + 1) * self._half + (value >> shift) - self._half
+
+    def _value(self, index: int):
+        """Middle of the range of values sharing bucket ``index``."""
+        if index < (1 << self._bits):
+            return index
+        shift = index // self._half - 1
+        return ((index % self._half + self._half) << shift) + ((1 << shift) - 1) // 2
+
+    def observe(self, seconds: float):
+        value = min(max(int(seconds * 1_000_000), 0), self._limit)
+        index = self._index(value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q: float):
+        """Value at quantile ``q`` in seconds."""
+        with self._lock:
+            counts, count = list(self._counts), self.count
+        if not count:
+            return 0.0
+        rank = max(1, int(q * count + 0.5))
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1_000_000
+        return self.max / 1_000_000
+
+    @property
+    def sum(self):
+        return self.total / 1_000_000
+
+
+class MetricsRegistry:
+    """Named counters, labelled histograms and gauges read when scraped."""
+
+    QUANTILES = (0.5, 0.99, 0.999)
+
+    def __init__(self, prefix: str = "voip"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str = ""):
+        with self._lock:
+            if name not in self.counters:
+                self.counters[name] = Counter()
+                self.help[name] = help
+            return self.counters[name]
+
+    def histogram(self, name: str, label: str = None, help: str = ""):
+        """Histogram ``name``, one per label value; created on first use."""
+        key = (name, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+                self.help.setdefault(name, help)
+        return histogram
+
+    def gauge(self, name: str, read, help: str = ""):
+        self.gauges[name] = read
+        self.help[name] = help
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception:
+                gauges[name] = None
+        return {
+            "counters": {name: counter.value for name, counter in list(self.counters.items())},
+            "gauges": gauges,
+            "histograms": {
+                key: {"count": h.count, "sum": h.sum, "max": h.max / 1_000_000,
+                      **{q: h.percentile(q) for q in self.QUANTILES}}
+                for key, h in list(self.histograms.items())
+            },
+        }
+
+    def render_prometheus(self, label_name: str = "opcode"):
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, kind):
+            lines.append(f"# HELP {self.prefix}_{name} {self.help.get(name, '') or name}")
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for name, value in sorted(snapshot["counters"].items()):
+            header(name, "counter")
+            lines.append(f"{self.prefix}_{name} {value}")
+        for name, value in sorted(snapshot["gauges"].items()):
+            if value is not None:
+                header(name, "counter" if name.endswith("_total") else "gauge")
+                lines.append(f"{self.prefix}_{name} {value}")
+        seen = set()
+        for (name, label), stats in sorted(snapshot["histograms"].items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            if name not in seen:
+                header(name, "summary")
+                seen.add(name)
+            labels = f'{label_name}="{label}"' if label is not None else ""
+            for q in self.QUANTILES:
+                quantile = f'quantile="{q}"'
+                lines.append(f"{self.prefix}_{name}{{{', '.join(filter(None, (labels, quantile)))}}} {stats[q]:.6f}")
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.prefix}_{name}_sum{suffix} {stats['sum']:.6f}")
+            lines.append(f"{self.prefix}_{name}_count{suffix} {stats['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9100):
+    """Expose the registry as Prometheus text on http://host:port/metrics."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,110 @@
+import threading
+
+import numpy as np
+
+from utils import rtp
+
+
+class ConferenceMixer:
+    """Mixes one 20 ms tick of PCM for every participant of a conference.
+
+    Participants own contiguous rows of one preallocated int16 array. Each
+    tick the rows that pass the energy gate are summed once and every
+    participant gets that sum minus their own voice, scaled down where it
+    would clip. All of it is vectorised over the stacked frames.
+    """
+
+    def __init__(self, capacity: int = 64, frame_samples: int = rtp.FRAME_SAMPLES, threshold: float = 300.0,
+                 hangover: int = 10, normalize: bool = True):
+        self.capacity = capacity
+        self.frame_samples = frame_samples
+        self.threshold = threshold
+        self.hangover = hangover
+        self.normalize = normalize
+        self.ids = []
+        self.frames = np.zeros((capacity, frame_samples), dtype=np.int16)
+        self.fresh = np.zeros(capacity, dtype=bool)
+        self.hold = np.zeros(capacity, dtype=np.int32)
+        self.output = np.zeros((capacity, frame_samples), dtype=np.int16)
+        self._work = np.zeros((capacity, frame_samples), dtype=np.int32)
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, participant_id):
+        with self._lock:
+            if participant_id in self._rows:
+                return True
+            if len(self.ids) >= self.capacity:
+                return False
+            row = len(self.ids)
+            self._rows[participant_id] = row
+            self.ids.append(participant_id)
+            self.fresh[row] = False
+            self.hold[row] = 0
+            return True
+
+    def remove(self, participant_id):
+        with self._lock:
+            row = self._rows.pop(participant_id, None)
+            if row is None:
+                return
+            last = len(self.ids) - 1
+            if row != last:
+                # Keep rows contiguous so every tick works on a plain slice.
+                moved = self.ids[last]
+                self.ids[row] = moved
+                self._rows[moved] = row
+                self.frames[row] = self.frames[last]
+                self.fresh[row] = self.fresh[last]
+                self.hold[row] = self.hold[last]
+            self.ids.pop()
+
+    def push(self, participant_id, pcm):
+        samples = np.frombuffer(pcm, dtype='<i2', count=min(len(pcm) // 2, self.frame_samples))
+        with self._lock:
+            row = self._rows.get(participant_id)
+            if row is None:
+                return False
+            self.frames[row, :len(samples)] = samples
+            self.frames[row, len(samples):] = 0
+            self.fresh[row] = True
+            return True
+
+    def mix(self):
+        """Mix the current tick.
+
+        Returns ``(ids, output, audible)``: ``output[i]`` is what ``ids[i]``
+        hears and ``audible[i]`` is False when nobody else is speaking. The
+        output rows are reused by the next tick.
+        """
+        with self._lock:
+            count = len(self.ids)
+            ids = list(self.ids)
+            work = self._work[:count]
+            np.copyto(work, self.frames[:count], casting='unsafe')
+            fresh = self.fresh[:count]
+            energy = np.sqrt(np.einsum('ij,ij->i', work, work, dtype=np.float64) / self.frame_samples)
+
+            hold = self.hold[:count]
+            np.subtract(hold, 1, out=hold)
+            np.maximum(hold, 0, out=hold)
+            hold[fresh & (energy >= self.threshold)] = self.hangover
+            speaking = fresh & (hold > 0)
+            fresh[:] = False
+
+            work[~speaking] = 0
+            total = work.sum(axis=0)
+            np.subtract(total, work, out=work)
+            if self.normalize:
+                peaks = np.abs(work).max(axis=1) if count else np.zeros(0, dtype=np.int32)
+                loud = peaks > 32767
+                if loud.any():
+                    work[loud] = (work[loud] * (32767.0 / peaks[loud])[:, None]).astype(np.int32)
+            np.clip(work, -32768, 32767, out=work)
+            output = self.output[:count]
+            np.copyto(output, work, casting='unsafe')
+            audible = (speaking.sum() - speaking) > 0
+            return ids, output, audible
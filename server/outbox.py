@@ -0,0 +1,81 @@
+import asyncio
+import queue
+
+DEFAULT_MAXSIZE = 256
+
+
+class Outbox:
+    """Bounded queue of messages waiting for one client's writer thread.
+
+    ``put`` never blocks: when the queue is full the message is refused so the
+    caller can report backpressure instead of stalling on a slow receiver.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE):
+        self._queue = queue.Queue(maxsize)
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, message: dict):
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def get(self):
+        message = self._queue.get()
+        return None if self.closed else message
+
+    def get_ready(self, limit: int):
+        """Up to ``limit`` messages already queued, without waiting; ``[None]`` once closed."""
+        messages = []
+        while len(messages) < limit and not self.closed:
+            try:
+                messages.append(self._queue.get_nowait())
+            except (queue.Empty, asyncio.QueueEmpty):
+                break
+        return [None] if self.closed else messages
+
+    def close(self):
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def __len__(self):
+        return self._queue.qsize()
+
+
+class AsyncOutbox(Outbox):
+    """Outbox drained by a writer task on the server's event loop."""
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE):
+        self._queue = asyncio.Queue(maxsize)
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, message: dict):
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def get(self):
+        message = await self._queue.get()
+        return None if self.closed else message
+
+    def close(self):
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
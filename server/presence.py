@@ -0,0 +1,47 @@
+import threading
+
+
+class PresenceFeed:
+    """Versioned stream of who joined and left since the last tick.
+
+    Changes are collected between ticks and flushed as one delta carrying
+    the next version number, so subscribers get one small message per tick
+    instead of polling the full list. A join and a leave of the same user
+    inside one tick cancel out.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._joined = set()
+        self._left = set()
+        # Held while a snapshot or delta is queued so subscribers see versions in order.
+        self.lock = threading.Lock()
+
+    def joined(self, username):
+        with self.lock:
+            if username in self._left:
+                self._left.discard(username)
+            else:
+                self._joined.add(username)
+
+    def left(self, username):
+        with self.lock:
+            if username in self._joined:
+                self._joined.discard(username)
+            else:
+                self._left.add(username)
+
+    def flush(self):
+        """Return the pending delta as a new version, or None. Call with ``lock`` held."""
+        if not self._joined and not self._left:
+            return None
+        self.version += 1
+        delta = {"version": self.version, "joined": sorted(self._joined), "left": sorted(self._left)}
+        self._joined.clear()
+        self._left.clear()
+        return delta
+
+    def snapshot(self, online):
+        """Full state at the current version. Call with ``lock`` held."""
+        return {"version": self.version, "online": list(online)}
+
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from utils import utils
+
+
+class ClientSession:
+    """Live connection of one authenticated client."""
+
+    __slots__ = ("id", "username", "socket", "public_key", "cipher", "binary", "outbox", "lock", "subscribed", "last_seen", "address", "writer", "corked")
+
+    def __init__(self, id, username, socket, public_key=None, cipher=None, binary=False, outbox=None, writer=None):
+        self.id = id
+        self.username = username
+        self.socket = socket
+        self.public_key = public_key
+        self.cipher = cipher
+        self.binary = binary
+        self.outbox = outbox
+        self.subscribed = False
+        self.address = None
+        self.writer = writer if writer is not None else utils.FrameWriter(socket)
+        # Set by the listener while more pipelined requests are buffered, so their replies go out together.
+        self.corked = False
+        self.last_seen = time.monotonic()
+        # Serialises encryption and writes so frames and nonces stay in order.
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<ClientSession id={self.id} username={self.username}>"
+
+
+class SessionRegistry:
+    """Live sessions indexed by client id, username and socket.
+
+    Lookups are single dict reads and need no lock; mutations take the lock so
+    the three indexes always agree with each other.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_id = {}
+        self._by_username = {}
+        self._by_socket = {}
+
+    def add(self, session: ClientSession):
+        with self._lock:
+            if session.id in self._by_id:
+                return False
+            self._by_id[session.id] = session
+            self._by_username[session.username] = session
+            self._by_socket[session.socket] = session
+            return True
+
+    def remove(self, id):
+        with self._lock:
+            session = self._by_id.pop(id, None)
+            if session is not None:
+                if self._by_username.get(session.username) is session:
+                    del self._by_username[session.username]
+                self._by_socket.pop(session.socket, None)
+            return session
+
+    def get(self, id):
+        return self._by_id.get(id)
+
+    def by_username(self, username):
+        return self._by_username.get(username)
+
+    def by_socket(self, client_socket):
+        return self._by_socket.get(client_socket)
+
+    def usernames(self, exclude=None):
+        return [username for username, session in list(self._by_username.items()) if session.id != exclude]
+
+    def __contains__(self, id):
+        return id in self._by_id
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __bool__(self):
+        return bool(self._by_id)
@@ -0,0 +1,91 @@
+import threading
+
+from utils import utils, security
+
+
+class Room:
+    """One chat room: its members and the group key of the current epoch.
+
+    ``lock`` orders rekeying against posting, so every member receives a
+    new key before the first message sealed with it.
+    """
+
+    def __init__(self, name: str, owner):
+        self.name = name
+        self.owner = owner
+        self.members = {}
+        self.epoch = 0
+        self.seq = 0
+        self.cipher = None
+        self.lock = threading.Lock()
+
+    def rekey(self):
+        """Start a new key epoch, e.g. after a membership change; the lock must be held."""
+        self.epoch += 1
+        self.seq = 0
+        self.cipher = security.GroupCipher(security.generate_session_key(), self.epoch)
+
+    def seal(self, message: bytes):
+        """Frame ``message`` for every member at once; the lock must be held."""
+        self.seq += 1
+        return utils.seal_room_frame(message, self.name, self.cipher, self.seq)
+
+    def key_message(self):
+        return {
+            "code": utils.REQUEST_CODES["ROOM_KEY"],
+            "payload": {
+                "room": self.name,
+                "epoch": self.epoch,
+                "key": self.cipher.key.hex(),
+                "members": sorted(self.members.values())
+            },
+            "encrypted": True
+        }
+
+
+class RoomRegistry:
+    """Rooms by name, and the rooms of each client for cleanup on disconnect."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._by_client = {}
+
+    def create(self, name: str, owner):
+        with self._lock:
+            if name in self._rooms:
+                return None
+            room = self._rooms[name] = Room(name, owner)
+            return room
+
+    def get(self, name: str):
+        return self._rooms.get(name)
+
+    def join(self, room: Room, client_id, username):
+        """Add a member; False if the room was dropped in the meantime."""
+        with self._lock:
+            if self._rooms.get(room.name) is not room:
+                return False
+            room.members[client_id] = username
+            self._by_client.setdefault(client_id, set()).add(room.name)
+            return True
+
+    def leave(self, room: Room, client_id):
+        """Remove a member; an empty room is dropped. Returns whether it was a member."""
+        with self._lock:
+            if room.members.pop(client_id, None) is None:
+                return False
+            rooms = self._by_client.get(client_id)
+            if rooms is not None:
+                rooms.discard(room.name)
+                if not rooms:
+                    del self._by_client[client_id]
+            if not room.members and self._rooms.get(room.name) is room:
+                del self._rooms[room.name]
+            return True
+
+    def rooms_of(self, client_id):
+        return [self._rooms[name] for name in list(self._by_client.get(client_id, ())) if name in self._rooms]
+
+    def __len__(self):
+        return len(self._rooms)
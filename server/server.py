@@ -1,41 +1,109 @@
+import asyncio
+import hmac
+import os
 import socket
-import logging
-import json
 import threading
+import time
 
 from utils import utils, security as sc
+from .registry import ClientSession, SessionRegistry
+from .outbox import DEFAULT_MAXSIZE, AsyncOutbox, Outbox
+from .media import MediaRelay
+from .presence import PresenceFeed
+from .timers import TimerWheel
+from .metrics import MetricsRegistry, serve_metrics
+from .directory import directory_from_settings
+from .tickets import TicketKeeper
+from .spool import MessageSpool
+from .rooms import RoomRegistry
+from .admission import AdmissionControl, busy
+from .crypto import CryptoExecutor
+from . import logs
+
+ENGINES = ("threading", "asyncio")
+OPCODES = {code: name for name, code in utils.REQUEST_CODES.items()}
+HANDSHAKE_CODES = {utils.REQUEST_CODES["CONNECT"], utils.REQUEST_CODES["RESUME"]}
+HANDLED_CODES = {utils.REQUEST_CODES[name] for name in ("PING", "DISCONNECT", "FRIENDS_LIST", "SEND_TEXT", "CALL", "CONFERENCE", "HANGUP",
+                                                        "ROOM_CREATE", "ROOM_JOIN", "ROOM_LEAVE", "ROOM_POST")}
+
 
 class VoIPServer(socket.socket):
     """Simple client-server application class."""
 
     _instance = None
+    TICK = 0.2
+    SPOOL_BATCH = 64
+    WRITE_BATCH = 128
 
-    def __new__(cls, host: str, port: int):
+    def __new__(cls, host: str, port: int, engine: str = "threading", media_port: int = 0, cluster=None, settings: dict = None):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
             return cls._instance
         
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, engine: str = "threading", media_port: int = 0, cluster=None, settings: dict = None):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
         super().__init__(socket.AF_INET, socket.SOCK_STREAM)
         self.host = host
         self.port = port
+        self.engine = engine
+        self.cluster = cluster
         if not hasattr(self, '_initialized'):
             self._initialized = True
+        if cluster is not None:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.bind((self.host, self.port))
         self.main_listenning_thread = None
-        self.clients = []
-        self.available_clients = []
-        self.private_key, self.public_key = sc.generate_keys()
-        self.private_key = sc.get_private_key(self.private_key)
-        self.public_key = sc.get_public_key(self.public_key)
-
-        self.logger = logging.getLogger("VoIPServer")
-        self.logger.setLevel(logging.DEBUG)
-        self.file_handler = logging.FileHandler("VoIPServer.log")
-        self.file_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        self.file_handler.setFormatter(formatter)
-        self.logger.addHandler(self.file_handler)
+        self.loop = None
+        self._async_server = None
+        self.directory = None
+        self.available_clients = SessionRegistry()
+        self.outbox_size = DEFAULT_MAXSIZE
+        self.presence = PresenceFeed()
+        self.rooms = RoomRegistry()
+        if settings is None:
+            settings = utils.get_all_settings_from_json().get('server', {})
+        self.idle_timeout = settings.get('idle_timeout', 30)
+        self.heartbeat_timeout = settings.get('heartbeat_timeout', 10)
+        self.metrics_port = settings.get('metrics_port')
+        self.directory_settings = settings.get('directory', {})
+        self.admission = AdmissionControl(settings.get('admission'))
+        spool = settings.get('spool', {})
+        spool_path = os.path.join(utils.base_dir, '..', spool.get('path', "spool"))
+        if cluster is not None:
+            spool_path = os.path.join(spool_path, f"worker-{cluster.index}")
+        self.spool = MessageSpool(spool_path, spool.get('segment_bytes', 4 * 2 ** 20), spool.get('flush_interval', 0.05))
+        log = settings.get('log', {})
+        log_path = log.get('file', "VoIPServer.log")
+        if cluster is not None:
+            # Workers rotate on their own, so they must not share a file.
+            root, ext = os.path.splitext(log_path)
+            log_path = f"{root}.worker-{cluster.index}{ext}"
+        self.logger, self.log_handler = logs.configure(
+            "VoIPServer", log_path, log.get('level', "INFO"),
+            log.get('max_bytes', 10 * 2 ** 20), log.get('backups', 5), log.get('sample'),
+        )
+        self.timers = TimerWheel()
+        self.reaped = 0
+        self.metrics = MetricsRegistry()
+        self.metrics_server = None
+        self._register_metrics()
+        crypto = settings.get('crypto', {})
+        self.crypto = CryptoExecutor(crypto.get('workers', 4), crypto.get('queue_size', 1024), crypto.get('batch', 32), self.metrics)
+        self.crypto_offload_bytes = crypto.get('offload_bytes', 64 * 1024)
+        write_buffer = settings.get('write_buffer', {})
+        self.write_max_bytes = write_buffer.get('max_bytes', 64 * 1024)
+        self.write_max_delay = write_buffer.get('max_delay', 0.002)
+        self.media = MediaRelay(self.host, media_port)
+        identity_key = settings.get('identity_key')
+        if identity_key:
+            self.private_key, self.public_key = sc.load_identity(os.path.join(utils.base_dir, '..', identity_key))
+        else:
+            self.private_key, self.public_key = sc.generate_keys()
+            self.public_key = sc.get_public_key(self.public_key)
+        # Derived from a persistent identity, workers and restarts all open each other's tickets.
+        self.tickets = TicketKeeper(sc.derive_ticket_secret(self.private_key) if identity_key else None,
+                                    settings.get('ticket_lifetime', 3600), settings.get('ticket_rotation', 900))
 
         self.running = False
 
@@ -44,57 +112,668 @@ class VoIPServer(socket.socket):
     def _listen(self):
         while True:
             client_socket, addr = self.accept()
-            data = utils.receive_message(client_socket)
-            data = json.loads(data)
-            
+            utils.set_nodelay(client_socket)
+            if not self.admission.begin_handshake(len(self.available_clients)):
+                self._shed(client_socket)
+                continue
+            # The handshake runs on the connection's own thread, so a slow client only stalls itself.
+            threading.Thread(target=self._handshake, daemon=True, args=[client_socket, addr[0]]).start()
+
+    def _shed(self, client_socket: socket.socket):
+        """Turn away a new connection with BUSY instead of letting it wait in a queue."""
+        try:
+            client_socket.setblocking(False)
+            try:
+                # Unread data would turn the close into a reset that can discard the reply.
+                while client_socket.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+            self._send(busy("Server busy, try again later."), client_socket)
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        client_socket.close()
+
+    def _handshake(self, client_socket: socket.socket, address):
+        # Nobody is authenticated yet, so only a handshake sized frame may be announced.
+        frames = utils.FrameReader(max_frame=self.admission.max_handshake_frame)
+        try:
+            try:
+                # A total budget, so a client trickling bytes cannot hold its slot past the timeout.
+                deadline = time.monotonic() + self.admission.handshake_timeout
+                data = self._unwrap(frames.read_frame(client_socket, deadline))
+                client_socket.settimeout(max(deadline - time.monotonic(), 0.001))
+                if data.get("code") not in HANDSHAKE_CODES:
+                    client_socket.close()
+                    return
+                response = self._admit(data, client_socket, address)
+                self._send(response, client_socket)
+            finally:
+                self.admission.end_handshake()
+        except socket.timeout:
+            self.logger.info("Handshake from %s timed out.", address, extra={"event": "handshake_timeout"})
+            response = None
+        except ConnectionError:
+            response = None
+        except Exception as e:
+            self.logger.error("An error occurred during a handshake: %s", e, extra={"event": "handshake_error"})
+            response = None
+        if response is None or response.get("code") != utils.REQUEST_CODES["OK"]:
+            # _admit registers the session before the reply goes out, so a failed send must not leave it behind.
+            self._drop(client_socket)
+            client_socket.close()
+            return
+        client_socket.settimeout(None)
+        frames.max_frame = utils.MAX_FRAME_SIZE
+        client = self.available_clients.by_socket(client_socket)
+        if client is not None:
+            threading.Thread(target=self._write_client, daemon=True, args=[client]).start()
+        self._listen_client(client_socket, frames)
+
+    def _admit(self, data: dict, client_socket, address):
+        """Answer a handshake unless its sender is over its rate limit."""
+        wait = self.admission.check(data.get("code"), address=address)
+        if wait:
+            return busy("Too many connection attempts.", wait)
+        response = self._handle_connect(data, client_socket)
+        client = self.available_clients.by_socket(client_socket)
+        if client is not None:
+            client.address = address
+        return response
+
+    def _listen_client(self, client_socket: socket.socket, frames: utils.FrameReader):
+        client = self.available_clients.by_socket(client_socket)
+        cipher = client.cipher if client else None
+        try:
+            while True:
+                data = self._unwrap(frames.read_frame(client_socket), self.private_key, cipher)
+                if client is not None:
+                    client.corked = frames.ready
+                if not self._handle_request(data, client_socket):
+                    break
+                if client is not None and not client.corked:
+                    self._flush(client)
+        except Exception as e:
+            self.logger.error("An error occurred in client listener: %s", e, extra={"event": "listener_error"})
+        self._drop(client_socket)
+
+    def _write_client(self, client: ClientSession):
+        try:
+            while True:
+                message = client.outbox.get()
+                if message is None:
+                    break
+                # Everything queued by now leaves in one write.
+                batch = [message] + client.outbox.get_ready(self.WRITE_BATCH - 1)
+                if None in batch:
+                    break
+                for message in batch:
+                    self._send(message, client.socket, client, flush=False)
+                self._flush(client)
+        except Exception as e:
+            self.logger.error("An error occurred in client writer: %s", e, extra={"event": "writer_error", "client": client.id})
 
-            if(data.get("code") == utils.REQUEST_CODES["CONNECT"]):
-                response = self.connect(data['payload']['id'], client_socket, data['payload'].get('public_key'))
-                utils.send_message(utils.encode_message(response), client_socket)
-                if response.get("code") == utils.REQUEST_CODES["OK"]:
-                    t = threading.Thread(target=self._listen_client, daemon=True, args=[client_socket,])
-                    t.start()
+    async def _write_client_async(self, client: ClientSession):
+        try:
+            while True:
+                message = await client.outbox.get()
+                if message is None:
+                    break
+                batch = [message] + client.outbox.get_ready(self.WRITE_BATCH - 1)
+                if None in batch:
+                    break
+                for message in batch:
+                    self._send(message, client.socket, client, flush=False)
+                self._flush(client)
+                await client.socket.writer.drain()
+        except Exception as e:
+            self.logger.error("An error occurred in client writer: %s", e, extra={"event": "writer_error", "client": client.id})
 
-        #self.logger.info(f"Server stopped at {datetime.datetime.now}")
+    async def _serve(self):
+        self._async_server = await asyncio.start_server(self._listen_client_async, sock=self, backlog=self.admission.backlog)
+        ticker = asyncio.get_running_loop().create_task(self._tick_async())
+        async with self._async_server:
+            try:
+                await self._async_server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        ticker.cancel()
+        await asyncio.gather(ticker, return_exceptions=True)
 
-    def _listen_client(self, client_socket: socket.socket):
+    async def _listen_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        utils.set_nodelay(writer.get_extra_info('socket'))
+        client_socket = utils.StreamSocket(writer)
+        frames = utils.FrameReader(max_frame=self.admission.max_handshake_frame)
+        if not self.admission.begin_handshake(len(self.available_clients)):
+            self._send(busy("Server busy, try again later."), client_socket)
+            client_socket.close()
+            return
         try:
+            try:
+                data = self._unwrap(await asyncio.wait_for(utils.read_frame_async(reader, frames), self.admission.handshake_timeout))
+                if data.get("code") not in HANDSHAKE_CODES:
+                    client_socket.close()
+                    return
+                response = self._admit(data, client_socket, client_socket.getpeername()[0])
+            finally:
+                self.admission.end_handshake()
+            self._send(response, client_socket)
+            await writer.drain()
+            if response.get("code") != utils.REQUEST_CODES["OK"]:
+                client_socket.close()
+                return
+
+            frames.max_frame = utils.MAX_FRAME_SIZE
+            client = self.available_clients.by_socket(client_socket)
+            if client is not None:
+                asyncio.get_running_loop().create_task(self._write_client_async(client))
+            cipher = client.cipher if client else None
             while True:
-                data = utils.receive_message(client_socket, self.private_key)
-                data = json.loads(data)
-                
-                interlaucutor = [client for client in self.available_clients if client.get('id') == data['payload'].get('id')]
-                interlaucutor = interlaucutor[0] if interlaucutor else {}
-                
-
-                if(data.get("code") == utils.REQUEST_CODES["CLOSE"]):
+                data = await self._unwrap_async(await utils.read_frame_async(reader, frames), self.private_key, cipher)
+                if client is not None:
+                    client.corked = frames.ready
+                if not self._handle_request(data, client_socket):
                     break
-                if(data.get("code") == utils.REQUEST_CODES["PING"]):
-                    utils.send_message(utils.encode_message({"code": utils.REQUEST_CODES["OK"]}), client_socket)
-                if(data.get("code") == utils.REQUEST_CODES["DISCONNECT"]):
-                    message = {
-                        "code": utils.REQUEST_CODES["OK"],
-                        "payload": f"Client {data['payload']['id']} disconnected."
-                    }
-                    utils.send_message(utils.encode_message(message), client_socket, interlaucutor.get("public_key", None))
-                    print(f"Disconnecting client {data['payload']['id']}...")
-                    response = self.disconnect(data['payload']['id'], client_socket)
-                    if(response.get("code") == utils.REQUEST_CODES["OK"]):
-                        break
-                    else:
-                        utils.send_message(utils.encode_message(response), client_socket, interlaucutor.get("public_key", None))
-                if(data.get("code") == utils.REQUEST_CODES["FRIENDS_LIST"]):
-                    friends = [client['username'] for client in self.available_clients if client.get('id') != data['payload'].get('id')]
-                    if not friends:
-                        friends = []
-                    message = {
-                            "code": utils.REQUEST_CODES["OK"],
-                            "payload": friends,
-                            "encrypted": True
-                        }
-                    utils.send_message(utils.encode_message(message), client_socket, interlaucutor.get("public_key", None))
+                if client is None or not client.corked:
+                    if client is not None:
+                        self._flush(client)
+                    await writer.drain()
+        except asyncio.TimeoutError:
+            self.logger.info("Handshake from %s timed out.", client_socket.getpeername()[0], extra={"event": "handshake_timeout"})
+            client_socket.close()
+            return
+        except Exception as e:
+            self.logger.error("An error occurred in client listener: %s", e, extra={"event": "listener_error"})
+        self._drop(client_socket)
+
+    def _drop(self, client_socket):
+        """Forget a session whose connection ended without a DISCONNECT."""
+        client = self.available_clients.by_socket(client_socket)
+        if client is not None:
+            self.logger.info("Connection of client %s was lost.", client.id, extra={"event": "connection_lost", "client": client.id})
+            self.disconnect(client.id, client_socket)
+
+    def _tick(self):
+        while self.running:
+            time.sleep(self.TICK)
+            self._flush_presence()
+            self._check_heartbeats()
+            self._refresh_directory()
+            self.admission.prune()
+
+    async def _tick_async(self):
+        while self.running:
+            await asyncio.sleep(self.TICK)
+            self._flush_presence()
+            self._check_heartbeats()
+            self._refresh_directory()
+            self.admission.prune()
+
+    def _refresh_directory(self):
+        try:
+            if self.directory.refresh():
+                self.logger.info("Client directory reloaded, %d accounts.", len(self.directory), extra={"event": "directory_reloaded"})
         except Exception as e:
-            self.logger.error(f"An error occurred in client listener: {e}")
+            self.logger.error("Failed to reload the client directory: %s", e, extra={"event": "directory_error"})
+
+    def _check_heartbeats(self):
+        """Ping sessions idle for ``idle_timeout`` and reap those still silent ``heartbeat_timeout`` later.
+
+        Incoming requests only refresh ``last_seen``; the wheel holds one
+        deadline per session and is re-armed from ``last_seen`` when it fires.
+        """
+        now = time.monotonic()
+        for id in self.timers.advance(now):
+            client = self.available_clients.get(id)
+            if client is None:
+                continue
+            idle = now - client.last_seen
+            if idle >= self.idle_timeout + self.heartbeat_timeout:
+                self._reap(client)
+            elif idle >= self.idle_timeout:
+                client.outbox.put({"code": utils.REQUEST_CODES["PING"], "payload": {"heartbeat": True}})
+                self.timers.schedule(id, client.last_seen + self.idle_timeout + self.heartbeat_timeout)
+            else:
+                self.timers.schedule(id, client.last_seen + self.idle_timeout)
+
+    def _reap(self, client: ClientSession, missed_heartbeat=True):
+        if missed_heartbeat:
+            self.logger.warning("Client %s missed its heartbeat, closing the connection.", client.id, extra={"event": "reaped", "client": client.id})
+            self.reaped += 1
+        try:
+            # Wakes the listener blocked in recv so its thread can exit.
+            client.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.disconnect(client.id, client.socket)
+
+    def _flush_presence(self):
+        with self.presence.lock:
+            delta = self.presence.flush()
+            if delta is None:
+                return
+            message = {"code": utils.REQUEST_CODES["PRESENCE"], "payload": delta, "encrypted": True}
+            for client in self.available_clients:
+                if client.subscribed and client.outbox is not None:
+                    client.outbox.put(message)
+
+    def _send_presence_snapshot(self, client: ClientSession):
+        with self.presence.lock:
+            snapshot = self.presence.snapshot(self.online_usernames(exclude=client.id))
+            client.outbox.put({"code": utils.REQUEST_CODES["PRESENCE"], "payload": snapshot, "encrypted": True})
+
+    def _presence_changed(self, username, online: bool, broadcast: bool = True):
+        if online:
+            self.presence.joined(username)
+        else:
+            self.presence.left(username)
+        if broadcast and self.cluster is not None:
+            self.cluster.broadcast({"presence": {"username": username, "online": online}})
+
+    def _register_metrics(self):
+        self._received_bytes = self.metrics.counter("received_bytes_total", "Bytes read from client connections")
+        self._sent_bytes = self.metrics.counter("sent_bytes_total", "Bytes written to client connections")
+        self._frames_sent = self.metrics.counter("sent_frames_total", "Frames queued for client connections")
+        self._writes = self.metrics.counter("socket_writes_total", "Vectored writes that sent queued frames")
+        self._connections = self.metrics.counter("connections_total", "Accepted CONNECT requests")
+        self._dropped_pushes = self.metrics.counter("dropped_pushes_total", "Pushes refused by a full outbox")
+        self._crypto = self.metrics.histogram("crypto_seconds", help="Time spent encrypting or decrypting one message")
+        gauges = {
+            "sessions": (lambda: len(self.available_clients), "Live client sessions"),
+            "threads": (threading.active_count, "Threads in the server process"),
+            "tasks": (lambda: len(asyncio.all_tasks(self.loop)) if self.loop is not None else 0, "Tasks on the asyncio engine loop"),
+            "outbox_depth": (lambda: sum(len(client.outbox) for client in self.available_clients), "Messages waiting in all outboxes"),
+            "outbox_max_depth": (lambda: max((len(client.outbox) for client in self.available_clients), default=0), "Deepest outbox"),
+            "heartbeat_timers": (lambda: len(self.timers), "Sessions with a pending heartbeat deadline"),
+            "presence_version": (lambda: self.presence.version, "Current presence feed version"),
+            "reaped_total": (lambda: self.reaped, "Sessions closed for missing heartbeats"),
+            "media_relayed_total": (lambda: self.media.relayed, "RTP packets relayed"),
+            "media_mixed_total": (lambda: self.media.mixed, "Conference frames mixed and sent"),
+            "media_dropped_total": (lambda: self.media.dropped, "RTP packets dropped"),
+            "log_dropped_total": (lambda: self.log_handler.dropped, "Log records dropped by a full log queue"),
+            "spooled_messages": (self.spool.pending, "Messages stored for offline clients"),
+            "spool_segments": (self.spool.segments, "Segment files in the offline message spool"),
+            "rooms": (lambda: len(self.rooms), "Open chat rooms"),
+            "handshakes": (lambda: self.admission.handshakes, "Handshakes in progress"),
+            "shed_total": (lambda: self.admission.shed, "Connections turned away with BUSY"),
+            "rate_limited_total": (lambda: self.admission.limited, "Requests refused by a rate limit"),
+        }
+        for name, (read, help) in gauges.items():
+            self.metrics.gauge(name, read, help)
+
+    def _offload(self, frame, cipher):
+        """Whether decrypting ``frame`` is worth a trip to the crypto pool.
+
+        RSA envelopes and large frames are; small session frames such as
+        PING decrypt in microseconds and never queue behind them.
+        """
+        return cipher is None or len(frame) >= self.crypto_offload_bytes
+
+    def _urgent(self, frame, cipher):
+        """Small RSA envelopes are control traffic like PING; they jump the bulk queue."""
+        return cipher is None and len(frame) < self.crypto_offload_bytes
+
+    def _unwrap(self, frame, private_key=None, cipher=None):
+        self._received_bytes.inc(len(frame) + utils.FRAME_HEADER.size)
+        if private_key is None and cipher is None:
+            return utils.decode_message(frame)
+        if self._offload(frame, cipher):
+            return utils.decode_message(self.crypto.run(utils.unwrap_message, frame, private_key, cipher, urgent=self._urgent(frame, cipher)))
+        return self._decrypt(frame, private_key, cipher)
+
+    async def _unwrap_async(self, frame, private_key=None, cipher=None):
+        self._received_bytes.inc(len(frame) + utils.FRAME_HEADER.size)
+        if private_key is None and cipher is None:
+            return utils.decode_message(frame)
+        if self._offload(frame, cipher):
+            data = await self.crypto.run_async(self.loop, utils.unwrap_message, frame, private_key, cipher, urgent=self._urgent(frame, cipher))
+            return utils.decode_message(data)
+        return self._decrypt(frame, private_key, cipher)
+
+    def _decrypt(self, frame, private_key, cipher):
+        started = time.perf_counter()
+        data = utils.unwrap_message(frame, private_key, cipher)
+        self._crypto.observe(time.perf_counter() - started)
+        return utils.decode_message(data)
+
+    def _handle_connect(self, data: dict, client_socket):
+        started = time.perf_counter()
+        payload = data['payload']
+        if data.get("code") == utils.REQUEST_CODES["RESUME"]:
+            response = self.resume(payload.get('ticket', ""), payload.get('nonce', ""), payload.get('proof', ""), client_socket, payload.get('presence', False))
+        else:
+            response = self.connect(payload['id'], client_socket, payload.get('public_key'), payload.get('session', False), payload.get('formats', []), payload.get('presence', False),
+                                    payload.get('exchange_key'))
+        if response.get("code") == utils.REQUEST_CODES["OK"]:
+            self._connections.inc()
+        self.metrics.histogram("request_seconds", OPCODES[data["code"]], "Time to handle one request").observe(time.perf_counter() - started)
+        return response
+
+    def _handle_request(self, data: dict, client_socket):
+        """Answer one decoded request; return False once the connection is done."""
+        started = time.perf_counter()
+        try:
+            return self._dispatch(data, client_socket)
+        finally:
+            code = data.get("code")
+            self.metrics.histogram("request_seconds", OPCODES.get(code, str(code)), "Time to handle one request").observe(time.perf_counter() - started)
+
+    def _dispatch(self, data: dict, client_socket):
+        interlaucutor = self.available_clients.by_socket(client_socket)
+        request_id = data.get("request_id")
+        if interlaucutor is not None:
+            interlaucutor.last_seen = time.monotonic()
+            wait = self.admission.check(data.get("code"), interlaucutor.id, interlaucutor.address)
+            if wait:
+                self._send(busy(f"Too many {OPCODES.get(data.get('code'), 'unknown')} requests.", wait), client_socket, interlaucutor, request_id)
+                return True
+
+        if(data.get("code") == utils.REQUEST_CODES["CLOSE"]):
+            return False
+        if(data.get("code") == utils.REQUEST_CODES["PING"]):
+            self._send({"code": utils.REQUEST_CODES["OK"]}, client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["DISCONNECT"]):
+            # Only the connection's own session may be torn down, whatever id the payload names.
+            if interlaucutor is None:
+                return False
+            message = {
+                "code": utils.REQUEST_CODES["OK"],
+                "payload": f"Client {interlaucutor.id} disconnected."
+            }
+            self._send(message, client_socket, interlaucutor, request_id)
+            self._flush(interlaucutor)
+            self.logger.info("Disconnecting client %s...", interlaucutor.id, extra={"event": "disconnect", "client": interlaucutor.id})
+            response = self.disconnect(interlaucutor.id, client_socket)
+            if(response.get("code") == utils.REQUEST_CODES["OK"]):
+                return False
+            else:
+                self._send(response, client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["FRIENDS_LIST"]):
+            friends = self.online_usernames(exclude=interlaucutor.id if interlaucutor else data['payload'].get('id'))
+            message = {
+                    "code": utils.REQUEST_CODES["OK"],
+                    "payload": friends,
+                    "encrypted": True
+                }
+            self._send(message, client_socket, interlaucutor, request_id)
+            if data['payload'].get('subscribe') and interlaucutor is not None:
+                interlaucutor.subscribed = True
+                self._send_presence_snapshot(interlaucutor)
+        if(data.get("code") == utils.REQUEST_CODES["SEND_TEXT"]):
+            self._send(self.route_text(interlaucutor, data['payload'].get('to'), data['payload'].get('message')), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["CALL"]):
+            self._send(self.place_call(interlaucutor, data['payload'].get('to')), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["CONFERENCE"]):
+            self._send(self.start_conference(interlaucutor, data['payload'].get('members', [])), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["HANGUP"]):
+            self._send(self.hang_up(interlaucutor, data['payload'].get('call_id')), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["ROOM_CREATE"]):
+            self._send(self.create_room(interlaucutor, data['payload'].get('room')), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["ROOM_JOIN"]):
+            self._send(self.join_room(interlaucutor, data['payload'].get('room')), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["ROOM_LEAVE"]):
+            self._send(self.leave_room(interlaucutor, data['payload'].get('room')), client_socket, interlaucutor, request_id)
+        if(data.get("code") == utils.REQUEST_CODES["ROOM_POST"]):
+            self._send(self.post_to_room(interlaucutor, data['payload'].get('room'), data['payload'].get('message')), client_socket, interlaucutor, request_id)
+        if data.get("code") not in HANDLED_CODES:
+            self._send({"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": f"Unknown request code {data.get('code')}."}, client_socket, interlaucutor, request_id)
+        return True
+
+    def _call_payload(self, call, client_id):
+        return {
+            "call_id": call.id,
+            "port": self.media.port,
+            "ssrc": call.ssrcs[client_id],
+            "peer_ssrc": call.receive_ssrc_of(client_id),
+            "key": call.key.hex()
+        }
+
+    def place_call(self, caller: ClientSession, to):
+        callee_id = self._locate(to)
+        if caller is None or callee_id is None or callee_id == caller.id:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"{to} is not online."}
+        call = self.media.create_call(caller.id, callee_id)
+        invite = {
+            "code": utils.REQUEST_CODES["CALL"],
+            "payload": self._call_payload(call, callee_id),
+            "encrypted": True
+        }
+        invite["payload"]["from"] = caller.username
+        if not self._push(callee_id, invite):
+            self.media.end_call(call.id)
+            return {"code": utils.REQUEST_CODES["BUSY"], "payload": f"{to} is not keeping up, call dropped."}
+        self.logger.info("Call %s started between %s and %s.", call.id, caller.id, callee_id, extra={"event": "call_started", "call": call.id})
+        return {"code": utils.REQUEST_CODES["OK"], "payload": self._call_payload(call, caller.id), "encrypted": True}
+
+    def start_conference(self, host: ClientSession, members):
+        if host is None:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": "You are not connected."}
+        guests = [self.available_clients.by_username(username) for username in members]
+        guests = [guest for guest in guests if guest is not None and guest is not host and guest.outbox is not None]
+        if not guests:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": "None of the members are online."}
+        call = self.media.create_conference([host.id] + [guest.id for guest in guests])
+        for guest in guests:
+            if guest.id not in call.ssrcs:
+                continue
+            invite = {
+                "code": utils.REQUEST_CODES["CALL"],
+                "payload": self._call_payload(call, guest.id),
+                "encrypted": True
+            }
+            invite["payload"]["from"] = host.username
+            invite["payload"]["conference"] = True
+            if not guest.outbox.put(invite):
+                self.media.leave_call(call.id, guest.id)
+        if self.media.get_call(call.id) is None:
+            return {"code": utils.REQUEST_CODES["BUSY"], "payload": "None of the members are keeping up, conference dropped."}
+        self.logger.info("Conference %s started by %s with %d participants.", call.id, host.id, len(call.ssrcs), extra={"event": "conference_started", "call": call.id})
+        return {"code": utils.REQUEST_CODES["OK"], "payload": self._call_payload(call, host.id), "encrypted": True}
+
+    def hang_up(self, client: ClientSession, call_id):
+        call = self.media.get_call(call_id)
+        if client is None or call is None or client.id not in call.ssrcs:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"No call {call_id}."}
+        self._end_call(call, client.id)
+        return {"code": utils.REQUEST_CODES["OK"], "payload": f"Call {call_id} ended."}
+
+    def _end_call(self, call, by_id):
+        if call.mixer is not None:
+            self.media.leave_call(call.id, by_id)
+            self.logger.info("Client %s left conference %s.", by_id, call.id, extra={"event": "conference_left", "call": call.id, "client": by_id})
+            if self.media.get_call(call.id) is not None:
+                return
+            # Fewer than two legs are left, so the relay ended it; tell whoever is still on.
+        else:
+            self.media.end_call(call.id)
+        for client_id in call.ssrcs:
+            if client_id != by_id:
+                self._push(client_id, {"code": utils.REQUEST_CODES["HANGUP"], "payload": {"call_id": call.id}})
+        self.logger.info("Call %s ended by %s.", call.id, by_id, extra={"event": "call_ended", "call": call.id, "client": by_id})
+
+    def route_text(self, sender: ClientSession, to, text):
+        if sender is None:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"{to} is not online."}
+        recipient_id = self._locate(to)
+        message = {
+            "code": utils.REQUEST_CODES["SEND_TEXT"],
+            "payload": {"from": sender.username, "message": text},
+            "encrypted": True
+        }
+        if recipient_id is not None and self._push(recipient_id, message):
+            return {"code": utils.REQUEST_CODES["OK"], "payload": f"Message queued for {to}."}
+        if recipient_id is not None and self.available_clients.get(recipient_id) is not None:
+            self.logger.warning("Outbox of client %s is full, message from %s dropped.", recipient_id, sender.id, extra={"event": "outbox_full", "client": recipient_id})
+            return {"code": utils.REQUEST_CODES["BUSY"], "payload": f"{to} is not keeping up, message dropped."}
+        account = self.directory.by_username(to)
+        if account is None:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"{to} does not exist."}
+        self.spool.append(account['id'], dict(message["payload"], sent=time.time()))
+        return {"code": utils.REQUEST_CODES["OK"], "payload": f"{to} is offline, message stored."}
+
+    def _deliver_spooled(self, client: ClientSession):
+        """Hand a client that just came online what was spooled for it, here and on other workers."""
+        self._push_spooled(client.id, self.spool.take(client.id))
+        if self.cluster is not None:
+            self.cluster.broadcast({"spool": client.id})
+
+    def _push_spooled(self, client_id, messages):
+        for start in range(0, len(messages), self.SPOOL_BATCH):
+            batch = {"code": utils.REQUEST_CODES["SEND_TEXT"], "payload": {"messages": messages[start:start + self.SPOOL_BATCH]}, "encrypted": True}
+            if not self._push(client_id, batch):
+                # Gone again or not keeping up; keep the rest for next time.
+                for payload in messages[start:]:
+                    self.spool.append(client_id, payload)
+                return
+
+    def create_room(self, owner: ClientSession, name):
+        if owner is None or not name or not isinstance(name, str):
+            return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": "A room needs a name."}
+        room = self.rooms.create(name, owner.id)
+        if room is None:
+            return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": f"Room {name} already exists."}
+        self.logger.info("Room %s created by %s.", name, owner.id, extra={"event": "room_created", "client": owner.id})
+        return self.join_room(owner, name)
+
+    def join_room(self, client: ClientSession, name):
+        room = self.rooms.get(name)
+        if client is None or room is None:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"Room {name} does not exist."}
+        with room.lock:
+            if not self.rooms.join(room, client.id, client.username):
+                return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"Room {name} does not exist."}
+            if room.cipher is None:
+                room.rekey()
+            # Only members ever receive room frames, so a joiner gets the current key
+            # instead of every member getting a new one; leaving does rotate it.
+            self._push(client.id, room.key_message())
+            members = sorted(room.members.values())
+        return {"code": utils.REQUEST_CODES["OK"], "payload": {"room": name, "members": members}}
+
+    def leave_room(self, client: ClientSession, name):
+        room = self.rooms.get(name)
+        if client is None or room is None:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"Room {name} does not exist."}
+        self._leave_room(room, client.id)
+        return {"code": utils.REQUEST_CODES["OK"], "payload": {"room": name}}
+
+    def _leave_room(self, room, client_id):
+        with room.lock:
+            if self.rooms.leave(room, client_id) and room.members:
+                # Whoever left must not read what comes next.
+                self._rekey_room(room)
+
+    def _rekey_room(self, room):
+        """New group key for every member; the room lock must be held."""
+        room.rekey()
+        message = room.key_message()
+        for member_id in room.members:
+            self._push(member_id, message)
+
+    def post_to_room(self, sender: ClientSession, name, text):
+        """Encrypt one post once and queue the same frame for every other member."""
+        room = self.rooms.get(name)
+        if sender is None or room is None or sender.id not in room.members:
+            return {"code": utils.REQUEST_CODES["NOT_FOUND"], "payload": f"You are not in room {name}."}
+        message = {"code": utils.REQUEST_CODES["ROOM_POST"], "payload": {"room": name, "from": sender.username, "message": text}}
+        delivered = 0
+        with room.lock:
+            started = time.perf_counter()
+            frame = room.seal(utils.encode_message(message))
+            self._crypto.observe(time.perf_counter() - started)
+            for member_id in room.members:
+                if member_id != sender.id and self._push(member_id, frame):
+                    delivered += 1
+        return {"code": utils.REQUEST_CODES["OK"], "payload": {"room": name, "delivered": delivered}}
+
+    def _locate(self, username):
+        client = self.available_clients.by_username(username)
+        if client is not None:
+            return client.id
+        if self.cluster is not None:
+            return self.cluster.find(username)
+        return None
+
+    def _push(self, client_id, message: dict):
+        """Queue a message for a client of this worker or, in a cluster, of another one."""
+        client = self.available_clients.get(client_id)
+        if client is not None and client.outbox is not None:
+            if client.outbox.put(message):
+                return True
+            self._dropped_pushes.inc()
+            return False
+        if self.cluster is not None and not isinstance(message, bytes):
+            # Sealed room frames only make sense to this worker's members.
+            return self.cluster.forward(client_id, message)
+        return False
+
+    def _deliver_forwarded(self, client_id, message: dict):
+        # Runs on the cluster's receiver thread; with asyncio, outboxes belong to the loop.
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._apply_forwarded, client_id, message)
+        else:
+            self._apply_forwarded(client_id, message)
+
+    def _apply_forwarded(self, client_id, message: dict):
+        if client_id is None:
+            if "presence" in message:
+                self._presence_changed(message["presence"]["username"], message["presence"]["online"], broadcast=False)
+            if "spool" in message:
+                self._push_spooled(message["spool"], self.spool.take(message["spool"]))
+            return
+        client = self.available_clients.get(client_id)
+        if client is not None and client.outbox is not None:
+            client.outbox.put(message)
+
+    def online_usernames(self, exclude=None):
+        if self.cluster is not None:
+            return self.cluster.online(exclude)
+        return self.available_clients.usernames(exclude)
+
+    def _send(self, message: dict, client_socket, client: ClientSession = None, request_id=None, flush=True):
+        """Write ``message`` to a client.
+
+        With a session the frame goes through its write buffer and is sent
+        right away unless ``flush`` is off or the listener is corked, in which
+        case the caller's next ``_flush`` sends it with the frames around it.
+        """
+        if isinstance(message, bytes):
+            # Already sealed and framed, e.g. a room post shared by every member.
+            with client.lock:
+                sent = client.writer.flush() if client.writer.write(message) or (flush and not client.corked) else 0
+            self._written(sent)
+            return
+        if request_id is not None:
+            # Echoed so a pipelining client can match the reply to its request.
+            message = dict(message, request_id=request_id)
+        if client is None:
+            data = utils.seal_message(utils.encode_message(message))
+            client_socket.sendall(data)
+            self._sent_bytes.inc(len(data))
+            return
+        with client.lock:
+            started = time.perf_counter()
+            data = utils.seal_message(utils.encode_message(message, client.binary), client.public_key, client.cipher, client.binary)
+            if client.cipher is not None or client.public_key is not None:
+                self._crypto.observe(time.perf_counter() - started)
+            sent = client.writer.flush() if client.writer.write(data) or (flush and not client.corked) else 0
+        self._written(sent)
+
+    def _flush(self, client: ClientSession):
+        with client.lock:
+            sent = client.writer.flush()
+        self._written(sent, frames=0)
+
+    def _written(self, sent, frames=1):
+        if frames:
+            self._frames_sent.inc(frames)
+        if sent:
+            self._sent_bytes.inc(sent)
+            self._writes.inc()
+
+    def _frame_writer(self, client_socket):
+        return utils.FrameWriter(client_socket, self.write_max_bytes, self.write_max_delay)
 
     def describe(self):
         return f"VoIpServer -- {self} --"
@@ -102,57 +781,162 @@ class VoIPServer(socket.socket):
     def update_state(self, state):
         self.running = state
 
-    def load_clients(self):
-        self.clients = utils.get_all_clients_from_json()
+    def load_clients(self, file_path=None, backend=None):
+        if self.directory is not None:
+            self.directory.close()
+        self.directory = directory_from_settings(self.directory_settings, file_path, backend)
 
     def is_client_available(self, id):
-        return any(client['id'] == id for client in self.available_clients)
+        return id in self.available_clients
 
     def can_connect(self, id):
-        if id in [client['id'] for client in self.clients]:
-            return True
-        return False
+        return id in self.directory
     
-    def connect(self, id, client_socket: socket.socket, public_key=None):
-        self.logger.info(f"Client {id} is trying to connect.")
-        if self.can_connect(id):
-            for client in self.available_clients:
-                if client['id'] == id:
-                    self.logger.info(f"Client {id} is already connected.")
-                    return {"code": utils.REQUEST_CODES["OK"], "payload": f"You are already connected."}
-            username = [client['username'] for client in self.clients if client['id'] == id]
-            if username:
-                username = username[0]
-            else:
-                username = "Unknown"
-            self.available_clients.append({"id": id, "username": username, "socket": client_socket, "public_key": public_key})
-            self.logger.info(f"Client {id} connected.")
-            return {"code": utils.REQUEST_CODES["OK"], "payload": username, "public_key": self.public_key.decode('utf-8')}
+    def connect(self, id, client_socket: socket.socket, public_key=None, session=False, formats=(), presence=False, exchange_key=None):
+        self.logger.info("Client %s is trying to connect.", id, extra={"event": "connect_attempt", "client": id})
+        account = self.directory.get(id)
+        if account is not None:
+            if id in self.available_clients:
+                self.logger.info("Client %s is already connected.", id, extra={"event": "connect_rejected", "client": id})
+                # Not OK, so the handshake closes this connection instead of leaving it without a session.
+                return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": "You are already connected."}
+            username = account.get('username', "Unknown")
+            outbox = AsyncOutbox(self.outbox_size) if self.engine == "asyncio" else Outbox(self.outbox_size)
+            client = ClientSession(id, username, client_socket, sc.load_public_key(public_key) if public_key else None, binary="binary" in formats, outbox=outbox,
+                                   writer=self._frame_writer(client_socket))
+            response = {"code": utils.REQUEST_CODES["OK"], "payload": username, "public_key": self.public_key.decode('utf-8')}
+            if client.binary:
+                response["format"] = "binary"
+            if session and exchange_key:
+                server_key = sc.generate_exchange_key()
+                client.cipher = sc.SessionCipher(sc.derive_session_key(server_key, bytes.fromhex(exchange_key)), is_server=True)
+                response["exchange_key"] = sc.get_exchange_key(server_key).hex()
+            elif session and public_key:
+                session_key = sc.generate_session_key()
+                client.cipher = sc.SessionCipher(session_key, is_server=True)
+                response["session_key"] = sc.wrap_session_key(session_key, client.public_key).hex()
+            return self._open_session(client, response, presence)
         else:
             return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": f"Client {id} is not allowed"}
+
+    def _open_session(self, client: ClientSession, response: dict, presence=False):
+        """Register a handshaken client and finish its reply; shared by CONNECT and RESUME."""
+        id = client.id
+        if self.cluster is not None and not self.cluster.claim(id, client.username):
+            self.logger.info("Client %s is already connected on another worker.", id, extra={"event": "connect_rejected", "client": id})
+            return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": "You are already connected."}
+        if not self.available_clients.add(client):
+            self.logger.info("Client %s is already connected.", id, extra={"event": "connect_rejected", "client": id})
+            return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": "You are already connected."}
+        self._presence_changed(client.username, True)
+        self.timers.schedule(id, client.last_seen + self.idle_timeout)
+        if client.cipher is not None:
+            secret = sc.derive_resumption_secret(client.cipher.key)
+            state = {"id": id, "binary": client.binary, "subscribed": presence, "secret": secret.hex()}
+            response["ticket"] = self.tickets.issue(state).hex()
+        if presence:
+            client.subscribed = True
+            response["presence"] = True
+            self._send_presence_snapshot(client)
+        self._deliver_spooled(client)
+        self.logger.info("Client %s connected.", id, extra={"event": "connect", "client": id})
+        return response
+
+    def resume(self, ticket, nonce, proof, client_socket: socket.socket, presence=False):
+        """Restore a session from a ticket issued at an earlier CONNECT, with symmetric crypto only.
+
+        The client proves it holds the ticket's secret and both sides derive
+        a fresh session key from it and a nonce each. A session the server
+        still believes alive, typically a dropped connection not yet reaped,
+        is replaced.
+        """
+        rejected = {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": "Session ticket rejected"}
+        try:
+            state = self.tickets.open(bytes.fromhex(ticket))
+            client_nonce, proof = bytes.fromhex(nonce), bytes.fromhex(proof)
+        except (ValueError, TypeError):
+            state = None
+        if state is None:
+            self.logger.info("Rejected an invalid or expired session ticket.", extra={"event": "resume_rejected"})
+            return rejected
+        id, secret = state["id"], bytes.fromhex(state["secret"])
+        if len(client_nonce) < 16 or not hmac.compare_digest(proof, sc.resume_proof(secret, client_nonce)):
+            self.logger.warning("Client %s presented a ticket without its secret.", id, extra={"event": "resume_rejected", "client": id})
+            return rejected
+        account = self.directory.get(id)
+        if account is None:
+            return {"code": utils.REQUEST_CODES["BAD_REQUEST"], "payload": f"Client {id} is not allowed"}
+        stale = self.available_clients.get(id)
+        if stale is not None:
+            self.logger.info("Client %s resumed, replacing its previous connection.", id, extra={"event": "resume_replaced", "client": id})
+            self._reap(stale, missed_heartbeat=False)
+        server_nonce = os.urandom(16)
+        outbox = AsyncOutbox(self.outbox_size) if self.engine == "asyncio" else Outbox(self.outbox_size)
+        cipher = sc.SessionCipher(sc.resume_session_key(secret, client_nonce, server_nonce), is_server=True)
+        client = ClientSession(id, account.get('username', "Unknown"), client_socket, cipher=cipher, binary=state.get("binary", False), outbox=outbox,
+                               writer=self._frame_writer(client_socket))
+        response = {"code": utils.REQUEST_CODES["OK"], "payload": client.username, "public_key": self.public_key.decode('utf-8'),
+                    "nonce": server_nonce.hex(), "resumed": True}
+        if client.binary:
+            response["format"] = "binary"
+        return self._open_session(client, response, presence or state.get("subscribed", False))
         
     def disconnect(self, id, client_socket: socket.socket):
         try:
-            self.logger.info(f"Client {id} is trying to disconnect.")
+            self.logger.info("Client %s is trying to disconnect.", id, extra={"event": "disconnect_attempt", "client": id})
             client_socket.close()
-            self.available_clients = [client for client in self.available_clients if client['id'] != id]
-            self.logger.info(f"Client {id} disconnected.")
+            client = self.available_clients.remove(id)
+            self.timers.cancel(id)
+            if client is not None:
+                client.outbox.close()
+                if self.cluster is not None:
+                    self.cluster.release(id)
+                self._presence_changed(client.username, False)
+            for call in self.media.calls_of(id):
+                self._end_call(call, id)
+            for room in self.rooms.rooms_of(id):
+                self._leave_room(room, id)
+            self.logger.info("Client %s disconnected.", id, extra={"event": "disconnect", "client": id})
             return {"code": utils.REQUEST_CODES["OK"], "payload": f"Client {id} disconnected successfully."}
         except socket.error as e:
-            self.logger.error(f"Error while disconnecting: {e}")
+            self.logger.error("Error while disconnecting: %s", e, extra={"event": "disconnect_error", "client": id})
             return {"code": utils.REQUEST_CODES["INTERNAL_ERROR"], "payload": f"Failed to disconnect client {id}."}
 
     def start(self):
         self.update_state(True)
         try:
             print(f"Starting server at {self.host}:{self.port}")
-            self.listen(5)
-            self.logger.info(f"Server listening on {self.host}:{self.port}...")
-            self.main_listenning_thread = threading.Thread(target=self._listen, daemon=True)
+            self.listen(self.admission.backlog)
+            self.logger.info("Server listening on %s:%s...", self.host, self.port, extra={"event": "listening"})
+            self.media.start()
+            self.crypto.start()
+            if self.cluster is not None:
+                self.cluster.bind(self._deliver_forwarded)
+            if self.metrics_port and self.metrics_server is None:
+                # Cluster workers each expose their own registry on consecutive ports.
+                metrics_port = self.metrics_port + (self.cluster.index if self.cluster is not None else 0)
+                self.metrics_server = serve_metrics(self.metrics, self.host, metrics_port)
+                self.logger.info("Metrics available on http://%s:%s/metrics", self.host, metrics_port, extra={"event": "metrics"})
+            if self.engine == "asyncio":
+                self.setblocking(False)
+                self.loop = asyncio.new_event_loop()
+                self.main_listenning_thread = threading.Thread(target=self.loop.run_until_complete, daemon=True, args=[self._serve()])
+            else:
+                self.main_listenning_thread = threading.Thread(target=self._listen, daemon=True)
+                threading.Thread(target=self._tick, daemon=True).start()
             self.main_listenning_thread.start()
             
         except Exception as e:
-            self.logger.error(f"An error occurred: {e}")
+            self.logger.error("An error occurred: %s", e, extra={"event": "server_error"})
 
     def stop(self):
-        self.update_state(False)
\ No newline at end of file
+        self.update_state(False)
+        self.directory.close()
+        self.spool.close()
+        self.crypto.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        if self.loop is not None and self._async_server is not None:
+            self.loop.call_soon_threadsafe(self._async_server.close)
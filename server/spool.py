@@ -0,0 +1,198 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+RECORD_HEADER = struct.Struct("!II")
+
+
+class MessageSpool:
+    """Durable store of messages for clients that are offline.
+
+    Messages are appended to a log split into segment files; an in-memory
+    index keeps, per recipient, where its pending records are. Taking a
+    recipient's messages appends a tombstone so a restart does not deliver
+    them again, and segments at the head of the log whose records were all
+    delivered are deleted.
+
+    Appends only fill a buffer. A flusher thread writes the buffer and
+    fsyncs it every ``flush_interval`` seconds, so a burst of messages costs
+    one fsync per interval rather than one per message; a crash loses at
+    most that interval.
+    """
+
+    def __init__(self, path: str, segment_bytes: int = 4 * 2 ** 20, flush_interval: float = 0.05):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._live = {}
+        self._buffer = []
+        self._buffered = 0
+        self._seq = 0
+        self._segment = None
+        self._file = None
+        self._size = 0
+        self._dirty = False
+        self._closed = threading.Event()
+        self._recover()
+        self._flusher = threading.Thread(target=self._flush_loop, name="VoIPSpoolFlusher", daemon=True)
+        self._flusher.start()
+
+    def _segment_path(self, base: int):
+        return os.path.join(self.path, f"{base:020d}.log")
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".log") and name[:-4].isdigit())
+
+    def _recover(self):
+        delivered = {}
+        records = []
+        segments = self._segments()
+        for base in segments:
+            with open(self._segment_path(base), 'rb') as f:
+                data = f.read()
+            position = 0
+            while position + RECORD_HEADER.size <= len(data):
+                length, checksum = RECORD_HEADER.unpack_from(data, position)
+                body = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+                if len(body) < length or zlib.crc32(body) != checksum:
+                    break
+                record = json.loads(body)
+                self._seq = max(self._seq, record["seq"] + 1)
+                if "delivered" in record:
+                    delivered[record["delivered"]] = max(delivered.get(record["delivered"], -1), record["through"])
+                else:
+                    records.append((base, position, record["seq"], record["to"]))
+                position += RECORD_HEADER.size + length
+            if position < len(data):
+                # Torn write from a crash; nothing after it was ever acknowledged as durable.
+                with open(self._segment_path(base), 'r+b') as f:
+                    f.truncate(position)
+        for base in segments:
+            self._live[base] = 0
+        for base, position, seq, to in records:
+            if seq > delivered.get(to, -1):
+                self._index.setdefault(to, []).append((base, position, seq))
+                self._live[base] += 1
+        self._open_segment(segments[-1] if segments else self._seq)
+        self._compact()
+
+    def _open_segment(self, base: int):
+        if self._file is not None:
+            if self._dirty:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+            self._file.close()
+        self._segment = base
+        self._live.setdefault(base, 0)
+        self._file = open(self._segment_path(base), 'ab')
+        self._size = self._file.tell()
+
+    def _append(self, record: dict):
+        """Frame one record into the buffer; the lock must be held."""
+        body = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        if self._size >= self.segment_bytes:
+            self._write()
+            self._open_segment(self._seq)
+        location = (self._segment, self._size + self._buffered)
+        self._buffer.append(RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+        self._buffered += RECORD_HEADER.size + len(body)
+        return location
+
+    def _write(self):
+        """Move buffered records to the active segment without syncing; the lock must be held."""
+        if self._buffer:
+            data = b"".join(self._buffer)
+            self._buffer, self._buffered = [], 0
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+            self._dirty = True
+
+    def append(self, recipient, message: dict):
+        """Store ``message`` for ``recipient``; durable within ``flush_interval``."""
+        with self._lock:
+            seq = self._seq
+            self._seq += 1
+            base, position = self._append({"seq": seq, "to": recipient, "message": message})
+            self._index.setdefault(recipient, []).append((base, position, seq))
+            self._live[base] += 1
+            # Keep one segment from growing far past its size while the flusher sleeps.
+            if self._size + self._buffered >= self.segment_bytes:
+                self._write()
+
+    def take(self, recipient):
+        """Remove and return every message pending for ``recipient``, oldest first."""
+        with self._lock:
+            locations = self._index.pop(recipient, None)
+            if not locations:
+                return []
+            self._write()
+            messages = []
+            by_segment = {}
+            for base, position, seq in locations:
+                by_segment.setdefault(base, []).append(position)
+            for base, positions in by_segment.items():
+                with open(self._segment_path(base), 'rb') as f:
+                    for position in positions:
+                        f.seek(position)
+                        length, _ = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                        messages.append(json.loads(f.read(length)))
+                self._live[base] -= len(positions)
+            seq = self._seq
+            self._seq += 1
+            self._append({"seq": seq, "delivered": recipient, "through": locations[-1][2]})
+            self._compact()
+        messages.sort(key=lambda record: record["seq"])
+        return [record["message"] for record in messages]
+
+    def _compact(self):
+        """Delete segments at the head of the log with nothing left to deliver; the lock must be held.
+
+        Only the head is cut: a tombstone must outlive every older segment,
+        or a restart would resurrect what it marked delivered.
+        """
+        for base in sorted(self._live):
+            if base == self._segment or self._live[base] > 0:
+                break
+            del self._live[base]
+            try:
+                os.unlink(self._segment_path(base))
+            except FileNotFoundError:
+                pass
+
+    def pending(self, recipient=None):
+        if recipient is not None:
+            return len(self._index.get(recipient, ()))
+        return sum(len(locations) for locations in list(self._index.values()))
+
+    def segments(self):
+        return len(self._live)
+
+    def flush(self):
+        """Write and fsync everything appended so far."""
+        with self._lock:
+            self._write()
+            dirty, self._dirty = self._dirty, False
+            file = self._file
+        if dirty:
+            os.fsync(file.fileno())
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                # The segment was rolled or closed under us; the next round syncs the new one.
+                pass
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        with self._lock:
+            self._file.close()
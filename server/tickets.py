@@ -0,0 +1,82 @@
+import json
+import os
+import struct
+import threading
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+TICKET_HEADER = struct.Struct("!Q")
+NONCE_SIZE = 12
+
+
+class TicketKeeper:
+    """Seals session state into tickets that only this server can open.
+
+    Tickets are AES-GCM encrypted under a key that changes every
+    ``rotation`` seconds. Each period's key is derived from ``secret``, so
+    cluster workers and restarts that share the secret rotate together
+    without coordinating. A ticket names the period it was sealed in, and
+    keys of periods that ended more than ``lifetime`` ago are refused, so a
+    retired key opens nothing even if the state inside claims otherwise.
+    """
+
+    def __init__(self, secret: bytes = None, lifetime: float = 3600, rotation: float = 900, clock=time.time):
+        self.secret = secret or os.urandom(32)
+        self.lifetime = lifetime
+        self.rotation = rotation
+        self.clock = clock
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def epoch(self, now: float = None):
+        return int((self.clock() if now is None else now) // self.rotation)
+
+    def _window(self, now: float):
+        """Oldest and newest periods whose keys still open tickets."""
+        current = self.epoch(now)
+        return current - int(-(-self.lifetime // self.rotation)), current
+
+    def _key(self, epoch: int):
+        key = self._keys.get(epoch)
+        if key is not None:
+            return key
+        # Handshakes run concurrently, and rotation edits the shared key table.
+        with self._lock:
+            key = self._keys.get(epoch)
+            if key is None:
+                oldest, _ = self._window(self.clock())
+                for stale in [e for e in self._keys if e < oldest]:
+                    del self._keys[stale]
+                material = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                                info=b"voip ticket key" + TICKET_HEADER.pack(epoch)).derive(self.secret)
+                key = self._keys[epoch] = AESGCM(material)
+        return key
+
+    def issue(self, state: dict) -> bytes:
+        now = self.clock()
+        header = TICKET_HEADER.pack(self.epoch(now))
+        nonce = os.urandom(NONCE_SIZE)
+        body = json.dumps(dict(state, expires=now + self.lifetime)).encode('utf-8')
+        return header + nonce + self._key(self.epoch(now)).encrypt(nonce, body, header)
+
+    def open(self, ticket: bytes):
+        """The state sealed in ``ticket``, or None if it is forged, expired or its key was retired."""
+        now = self.clock()
+        if len(ticket) < TICKET_HEADER.size + NONCE_SIZE:
+            return None
+        header, nonce = ticket[:TICKET_HEADER.size], ticket[TICKET_HEADER.size:TICKET_HEADER.size + NONCE_SIZE]
+        epoch, = TICKET_HEADER.unpack(header)
+        oldest, newest = self._window(now)
+        if not oldest <= epoch <= newest:
+            return None
+        try:
+            state = json.loads(self._key(epoch).decrypt(nonce, ticket[TICKET_HEADER.size + NONCE_SIZE:], header))
+        except InvalidTag:
+            return None
+        if state.pop("expires", 0) <= now:
+            return None
+        return state
@@ -0,0 +1,57 @@
+import threading
+import time
+
+
+class TimerWheel:
+    """Hashed timer wheel tracking one deadline per key.
+
+    A deadline lands in the slot of its tick, modulo the number of slots, so
+    scheduling is an append and each advance only walks the slots of the
+    ticks that went by. Rescheduling or cancelling a key leaves its old entry
+    behind; stale entries are dropped when their slot is next walked.
+    """
+
+    def __init__(self, tick: float = 0.25, slots: int = 256, now: float = None):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._deadlines = {}
+        self._cursor = int((time.monotonic() if now is None else now) / tick)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline: float):
+        with self._lock:
+            self._deadlines[key] = deadline
+            index = max(int(deadline / self.tick), self._cursor)
+            self._slots[index % len(self._slots)].append((deadline, key))
+
+    def cancel(self, key):
+        with self._lock:
+            self._deadlines.pop(key, None)
+
+    def advance(self, now: float = None):
+        """Return the keys whose deadline has passed; they are unscheduled."""
+        now = time.monotonic() if now is None else now
+        target = int(now / self.tick)
+        expired = []
+        with self._lock:
+            steps = min(target - self._cursor + 1, len(self._slots))
+            for step in range(max(steps, 0)):
+                slot = self._slots[(self._cursor + step) % len(self._slots)]
+                kept = []
+                for deadline, key in slot:
+                    if self._deadlines.get(key) != deadline:
+                        continue
+                    if deadline <= now:
+                        del self._deadlines[key]
+                        expired.append(key)
+                    else:
+                        kept.append((deadline, key))
+                slot[:] = kept
+            self._cursor = max(self._cursor, target)
+        return expired
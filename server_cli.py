@@ -1,15 +1,18 @@
 import cmd2
-from server import server
+from server import cluster, server
 from utils.utils import get_all_settings_from_json
 
 class VoIPServerCLI(cmd2.Cmd):
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, engine: str = "threading", workers: int = 1):
         super().__init__()
         self.intro = "Welcome to the VoIP Server CLI. Type help or ? to list commands."
         self.prompt = "(VoIPServerCLI) "
         self.port = port
         self.host = host
-        self.server = server.VoIPServer(host, port)
+        if workers > 1:
+            self.server = cluster.VoIPCluster(host, port, workers, engine)
+        else:
+            self.server = server.VoIPServer(host, port, engine)
 
     def do_describe(self, arg):
         """Get infos on the VoIP server. Usage: describe"""
@@ -41,22 +44,53 @@ class VoIPServerCLI(cmd2.Cmd):
 
     def do_all_clients(self, arg):
         """List all clients. Usage: all_clients"""
-        if self.server.clients:
+        if len(self.server.directory):
             self.poutput("All clients:")
-            for client in self.server.clients:
+            for client in self.server.directory:
                 self.poutput(f"ID: {client['id']}, Username: {client['username']}")
         else:
             self.poutput("No clients connected.")
 
+    def do_add_client(self, arg):
+        """Add or update an account in the client directory. Usage: add_client <id> <username>"""
+        parts = arg.split()
+        if len(parts) != 2:
+            self.poutput("Usage: add_client <id> <username>")
+            return
+        self.server.directory.add({"id": parts[0], "username": parts[1]})
+        self.poutput(f"Client {parts[1]} saved.")
+
+    def do_remove_client(self, arg):
+        """Remove an account from the client directory. Usage: remove_client <id>"""
+        if self.server.directory.remove(arg.strip()):
+            self.poutput("Client removed.")
+        else:
+            self.poutput("No such client.")
+
     def do_clients(self, arg):
         """List connected clients. Usage: clients"""
         if self.server.available_clients:
             self.poutput("Connected clients:")
             for client in self.server.available_clients:
-                self.poutput(f"ID: {client['id']}, Socket: {client['socket']}")
+                self.poutput(f"ID: {client.id}, Username: {client.username}")
         else:
             self.poutput("No clients connected.")
 
+    def do_stats(self, arg):
+        """Show server metrics. Usage: stats"""
+        metrics = getattr(self.server, "metrics", None)
+        if metrics is None:
+            self.poutput("Metrics are exposed per worker, see metrics_port in settings.json.")
+            return
+        snapshot = metrics.snapshot()
+        for name, value in sorted({**snapshot["counters"], **snapshot["gauges"]}.items()):
+            self.poutput(f"{name}: {value}")
+        self.poutput(f"{'histogram':<28}{'count':>10}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}{'max ms':>10}")
+        for (name, label), stats in sorted(snapshot["histograms"].items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            title = f"{name}[{label}]" if label is not None else name
+            self.poutput(f"{title:<28}{stats['count']:>10}{stats[0.5] * 1000:>10.3f}{stats[0.99] * 1000:>10.3f}"
+                         f"{stats[0.999] * 1000:>10.3f}{stats['max'] * 1000:>10.3f}")
+
     def do_status(self, arg):
         """Check server status. Usage: status"""
         if self.server.running:
@@ -83,6 +117,8 @@ if __name__ == '__main__':
 
     if not (port and host):
         host, port = "localhost", 8080
+    engine = settings.get('server', {}).get('engine', "threading")
+    workers = settings.get('server', {}).get('workers', 1)
 
-    app = VoIPServerCLI(host, port)
+    app = VoIPServerCLI(host, port, engine, workers)
     app.cmdloop()
@@ -1,77 +1,1408 @@
 import json
 import socket
+import threading
+import time
 from unittest.mock import MagicMock, patch
 
-from client.client import VoIPClient
-from utils import REQUEST_CODES
-
-
-@patch("socket.socket")
-def test_connect_success(mock_socket):
-    fake_socket = MagicMock()
-    mock_socket.return_value = fake_socket
-
-    # Fake server response
-    fake_socket.recv.return_value = json.dumps({
-        "code": REQUEST_CODES["OK"]
-    }).encode("utf-8")
-
-    client = VoIPClient()
-    client.connect_to_server = lambda: None  # override for demo
-    # Inject real connect code (you paste yours here)
-    def real_connect():
-        client.client_socket = socket.socket()
-        client.client_socket.connect((client.host, client.port))
-        msg = {
-            "code": REQUEST_CODES["CONNECT"],
-            "payload": {"id": "1", "username": "test"}
-        }
-        client.client_socket.send(json.dumps(msg).encode("utf-8"))
-        resp = client.client_socket.recv(1024).decode()
-        if json.loads(resp).get("code") == REQUEST_CODES["OK"]:
-            client.isConnected = True
-
-    client.connect_to_server = real_connect
+import pytest
 
+from client.api import VoIPClient
+from utils import security, utils
+from utils.utils import REQUEST_CODES
+
+
+ENGINES = ["threading", "asyncio"]
+ACCOUNTS = utils.get_all_clients_from_json()
+
+
+def start_server(engine, tmp_path, monkeypatch, cluster=None, **settings):
+    """A real VoIPServer on a free port, logging under ``tmp_path``, with ``settings`` as its server settings."""
+    from server.server import VoIPServer
+
+    monkeypatch.chdir(tmp_path)
+    settings.setdefault("spool", {"path": str(tmp_path / "spool"), "flush_interval": 0.01})
+    VoIPServer._instance = None
+    with patch("utils.utils.get_all_settings_from_json", return_value={"server": settings}):
+        server = VoIPServer("127.0.0.1", 0, engine, cluster=cluster)
+    server.port = server.getsockname()[1]
+    server.start()
+    return server
+
+
+def connect_client(server, account):
+    client = VoIPClient(account["id"], "127.0.0.1", server.port, account["username"])
     client.connect_to_server()
+    assert client.isConnected
+    return client
+
+
+def request(client, code, **payload):
+    return client.submit({"code": REQUEST_CODES[code], "payload": dict({"id": client.id}, **payload), "encrypted": True}).result(5)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_engines_answer_connect_ping_friends_list_and_disconnect(engine, tmp_path, monkeypatch, capsys):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        # Presence deltas are batched, so wait for papa's reader to see drissa come online.
+        assert wait_until(lambda: "drissa" in papa.presence.online)
+        capsys.readouterr()
+        papa.friends_list()
+        assert capsys.readouterr().out.splitlines() == ["Available friends on the server:", "- drissa"]
+
+        drissa.disconnect()
+        assert not drissa.isConnected
+        assert wait_until(lambda: len(server.available_clients) == 1)
+        assert wait_until(lambda: "drissa" not in papa.presence.online)
+        capsys.readouterr()
+        papa.friends_list()
+        assert capsys.readouterr().out.splitlines() == ["No friends available on the server."]
+        papa.disconnect()
+        assert not papa.isConnected and wait_until(lambda: len(server.available_clients) == 0)
+    finally:
+        server.stop()
+
+
+def test_frame_reader_splits_merged_and_partial_frames():
+    left, right = socket.socketpair()
+    frames = utils.FrameReader(size=16)
+    big = b"x" * 5000
+
+    left.sendall(utils.frame_message(b"first") + utils.frame_message(b"second") + utils.frame_message(big)[:100])
+    assert bytes(frames.read_frame(right)) == b"first"
+    assert bytes(frames.read_frame(right)) == b"second"
+
+    left.sendall(utils.frame_message(big)[100:])
+    assert bytes(frames.read_frame(right)) == big
+    assert frames.buffered == 0
+    left.close()
+    right.close()
+
+
+def test_frame_reader_grows_with_received_bytes_not_announced_length():
+    frames = utils.FrameReader(size=16)
+    frames.feed(utils.FRAME_HEADER.pack(utils.MAX_FRAME_SIZE - 1) + b"x" * 8)
+    assert frames.next_frame() is None
+    assert frames.capacity == 16
+
+    capped = utils.FrameReader(max_frame=8)
+    capped.feed(utils.frame_message(b"x" * 9))
+    with pytest.raises(ValueError):
+        capped.next_frame()
+
+
+def test_receive_message_raises_on_closed_connection():
+    left, right = socket.socketpair()
+    left.sendall(utils.frame_message(b"abc")[:3])
+    left.close()
+    try:
+        utils.receive_message(right)
+    except ConnectionResetError:
+        pass
+    else:
+        raise AssertionError("expected ConnectionResetError")
+    right.close()
+
+
+def test_session_cipher_round_trip_and_replay_rejected():
+    key = security.generate_session_key()
+    client, server = security.SessionCipher(key), security.SessionCipher(key, is_server=True)
+
+    first, second = client.encrypt(b"ping"), client.encrypt(b"ping")
+    assert first != second
+    assert server.decrypt(first) == b"ping"
+    try:
+        server.decrypt(first)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("replayed frame was accepted")
+    assert server.decrypt(second) == b"ping"
+    assert client.decrypt(server.encrypt(b"pong")) == b"pong"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_session_frames_are_sealed_and_a_replayed_frame_is_refused(engine, tmp_path, monkeypatch, caplog):
+    server = start_server(engine, tmp_path, monkeypatch)
+    sock = socket.create_connection(("127.0.0.1", server.port))
+    try:
+        private_key, public_key = security.generate_keys()
+        frames = utils.FrameReader()
+        offer = {"id": ACCOUNTS[0]["id"], "username": "papa", "public_key": security.get_public_key(public_key).decode("utf-8"), "session": True, "formats": ["binary"]}
+        reply = utils.send_message_and_wait_for_response(utils.encode_message({"code": REQUEST_CODES["CONNECT"], "payload": offer}), sock, frames=frames)
+        reply = utils.decode_message(reply)
+        cipher = security.SessionCipher(security.unwrap_session_key(bytes.fromhex(reply["session_key"]), private_key))
+
+        ping = utils.encode_message({"code": REQUEST_CODES["PING"], "payload": {"id": ACCOUNTS[0]["id"]}}, True)
+        frame = utils.frame_message(cipher.encrypt(ping))
+        assert ping not in frame
+        sock.sendall(frame)
+        assert utils.decode_message(utils.receive_message(sock, private_key, frames, cipher))["code"] == REQUEST_CODES["OK"]
+
+        # The same sealed frame again carries a stale counter, so the server refuses it.
+        sock.sendall(frame)
+        assert wait_until(lambda: "replayed or out of order" in caplog.text)
+    finally:
+        sock.close()
+        server.stop()
+
+
+def test_binary_message_round_trip():
+    message = {
+        "code": REQUEST_CODES["FRIENDS_LIST"],
+        "payload": ["papa", "drissa", {"id": 7, "online": True, "score": 1.5, "note": None}],
+        "encrypted": True,
+    }
+    encoded = utils.encode_message(message, binary=True)
+    assert len(encoded) < len(utils.encode_message(message))
+    assert utils.decode_message(encoded) == message
+    assert utils.decode_message(utils.encode_message(message)) == message
+    assert utils.decode_message(utils.encode_message({"code": REQUEST_CODES["OK"]}, binary=True)) == {"code": REQUEST_CODES["OK"]}
+
+
+def test_rsa_binary_envelope_round_trip():
+    private_key, public_key = security.generate_keys()
+    left, right = socket.socketpair()
+    plaintext = utils.encode_message({"code": REQUEST_CODES["PING"], "payload": {}}, binary=True)
+
+    utils.send_message(plaintext, left, public_key, binary=True)
+    assert utils.receive_message(right, private_key) == plaintext
+    utils.send_message(plaintext, left, public_key)
+    assert utils.receive_message(right, private_key) == plaintext
+    left.close()
+    right.close()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_rsa_clients_get_binary_envelopes_only_when_they_offer_them(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    legacy = []
+    try:
+        # Neither client asks for a session, so every frame after CONNECT is RSA-wrapped.
+        for account, formats in zip(ACCOUNTS, (["binary"], [])):
+            private_key, public_key = security.generate_keys()
+            sock = socket.create_connection(("127.0.0.1", server.port))
+            frames = utils.FrameReader()
+            offer = {"id": account["id"], "username": account["username"], "public_key": security.get_public_key(public_key).decode("utf-8"), "formats": formats}
+            reply = utils.send_message_and_wait_for_response(utils.encode_message({"code": REQUEST_CODES["CONNECT"], "payload": offer}), sock, frames=frames)
+            reply = utils.decode_message(reply)
+            assert reply["code"] == REQUEST_CODES["OK"] and "session_key" not in reply
+            assert (reply.get("format") == "binary") == bool(formats)
+            legacy.append((account, sock, frames, private_key, security.load_public_key(reply["public_key"]), bool(formats)))
+
+        for (account, sock, frames, private_key, server_key, binary), friend in zip(legacy, reversed(ACCOUNTS)):
+            message = {"code": REQUEST_CODES["FRIENDS_LIST"], "payload": {"id": account["id"]}, "encrypted": True}
+            utils.send_message(utils.encode_message(message, binary), sock, server_key, binary=binary)
+            frame = bytes(frames.read_frame(sock))
+            assert (frame[0] == utils.ENVELOPE_MAGIC) == binary
+            reply = utils.decode_message(utils.unwrap_message(frame, private_key))
+            assert reply["code"] == REQUEST_CODES["OK"] and reply["payload"] == [friend["username"]]
+    finally:
+        for _, sock, *_ in legacy:
+            sock.close()
+        server.stop()
+
+
+def test_session_registry_indexes_stay_consistent():
+    from server.registry import ClientSession, SessionRegistry
+
+    registry = SessionRegistry()
+    papa_socket, drissa_socket = object(), object()
+    assert registry.add(ClientSession("1", "papa", papa_socket))
+    assert registry.add(ClientSession("2", "drissa", drissa_socket))
+    assert not registry.add(ClientSession("1", "papa", object()))
+
+    assert registry.by_username("drissa").id == "2"
+    assert registry.by_socket(papa_socket).username == "papa"
+    assert registry.usernames(exclude="1") == ["drissa"]
+
+    registry.remove("1")
+    assert "1" not in registry and len(registry) == 1
+    assert registry.by_socket(papa_socket) is None
+    assert registry.by_username("papa") is None
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_disconnect_only_ends_the_senders_own_session(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        assert request(drissa, "DISCONNECT", id=papa.id)["code"] == REQUEST_CODES["OK"]
+        assert wait_until(lambda: ACCOUNTS[1]["id"] not in server.available_clients)
+        assert ACCOUNTS[0]["id"] in server.available_clients
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_a_second_login_is_refused_and_closed_while_the_first_stays(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa = connect_client(server, ACCOUNTS[0])
+        _, public_key = security.generate_keys()
+        offer = {"id": ACCOUNTS[0]["id"], "username": "papa", "public_key": security.get_public_key(public_key).decode("utf-8"), "session": True}
+        with socket.create_connection(("127.0.0.1", server.port)) as twin:
+            reply = utils.send_message_and_wait_for_response(utils.encode_message({"code": REQUEST_CODES["CONNECT"], "payload": offer}), twin)
+            assert utils.decode_message(reply)["code"] == REQUEST_CODES["BAD_REQUEST"]
+            twin.settimeout(5)
+            assert twin.recv(1) == b""
+
+        assert len(server.available_clients) == 1
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_outbox_refuses_when_full_and_stops_writer_on_close():
+    from server.outbox import Outbox
+
+    outbox = Outbox(maxsize=2)
+    assert outbox.put({"n": 1}) and outbox.put({"n": 2})
+    assert not outbox.put({"n": 3})
+    assert outbox.dropped == 1 and len(outbox) == 2
+
+    assert outbox.get() == {"n": 1}
+    outbox.close()
+    assert outbox.get() is None
+    assert not outbox.put({"n": 4})
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_texts_are_routed_and_a_stalled_recipient_gets_busy(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    server.outbox_size = 4
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        assert request(papa, "SEND_TEXT", to="drissa", message="hi")["code"] == REQUEST_CODES["OK"]
+        assert wait_until(lambda: drissa.inbox == [{"from": "papa", "message": "hi"}])
+        assert request(papa, "SEND_TEXT", to="nobody", message="hi")["code"] == REQUEST_CODES["NOT_FOUND"]
+
+        # drissa's reader stops, so her socket buffers and then her outbox fill up.
+        gate = threading.Event()
+        handle = drissa._handle_push
+        drissa._handle_push = lambda message: gate.wait(10) and handle(message)
+        payload = "x" * 128 * 1024
+        codes = []
+        while REQUEST_CODES["BUSY"] not in codes and len(codes) < 400:
+            codes.append(request(papa, "SEND_TEXT", to="drissa", message=payload)["code"])
+        assert codes[-1] == REQUEST_CODES["BUSY"]
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+
+        gate.set()
+        assert wait_until(lambda: len(drissa.inbox) == 1 + codes.count(REQUEST_CODES["OK"]))
+        papa.disconnect()
+        drissa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_media_relay_forwards_encrypted_pcm_over_loopback():
+    import array
+    import math
+
+    from client.media import MediaChannel
+    from server.media import MediaRelay
+    from utils import rtp
+
+    relay = MediaRelay("127.0.0.1")
+    relay.start()
+    call = relay.create_call("alice", "bob")
+    alice = MediaChannel("127.0.0.1", relay.port, call.ssrcs["alice"], call.key)
+    bob = MediaChannel("127.0.0.1", relay.port, call.ssrcs["bob"], call.key)
+    alice.open()
+    bob.open()
+    for _ in range(100):
+        if len(call.addresses) == 2:
+            break
+        time.sleep(0.01)
+
+    tone = array.array("h", (int(8000 * math.sin(2 * math.pi * 440 * n / rtp.SAMPLE_RATE)) for n in range(rtp.FRAME_SAMPLES)))
+    for _ in range(3):
+        alice.send_frame(tone.tobytes())
+    received = [bob.receive(timeout=1) for _ in range(3)]
 
-    # Assertions
-    fake_socket.connect.assert_called_once_with(("localhost", 5000))
-    fake_socket.send.assert_called_once()
-    fake_socket.recv.assert_called_once()
-    assert client.isConnected is True
+    assert [packet.payload for packet in received] == [tone.tobytes()] * 3
+    assert [packet.sequence for packet in received] == [(received[0].sequence + i) & 0xFFFF for i in range(3)]
+    assert received[1].timestamp - received[0].timestamp == rtp.FRAME_SAMPLES
+    assert all(packet.ssrc == call.ssrcs["alice"] for packet in received)
 
+    relay.end_call(call.id)
+    alice.send_frame(tone.tobytes())
+    assert bob.receive(timeout=0.2) is None
+    for channel in (alice, bob):
+        channel.close()
+    relay.stop()
 
-@patch("socket.socket")
-def test_disconnect_success(mock_socket):
-    fake_socket = MagicMock()
-    mock_socket.return_value = fake_socket
 
-    # Fake server response
-    fake_socket.recv.return_value = json.dumps({
-        "code": REQUEST_CODES["OK"],
-        "payload": "Disconnected"
-    }).encode("utf-8")
+def test_jitter_buffer_replays_trace_with_loss_and_reordering():
+    from client.jitter import replay_trace, synthetic_trace
 
-    client = VoIPClient()
-    client.client_socket = fake_socket
+    clean = replay_trace(synthetic_trace(300, jitter_ms=0, loss=0, reorder=0))
+    assert clean["played"] == 300 and clean["concealed"] == 0
+    assert clean["max_latency_ms"] <= 60
+
+    lossy = replay_trace(synthetic_trace(300, jitter_ms=20, loss=0.05, reorder=0.05, seed=7))
+    assert lossy == replay_trace(synthetic_trace(300, jitter_ms=20, loss=0.05, reorder=0.05, seed=7))
+    assert lossy["played"] + lossy["late"] + lossy["skipped"] + lossy["lost_in_network"] == 300
+    assert lossy["concealment_rate"] < 0.12
+    assert lossy["p95_latency_ms"] < 250
+
+
+def test_jitter_buffer_reorders_and_fades_concealment():
+    import array
+
+    from client.jitter import JitterBuffer
+
+    buffer = JitterBuffer(frame_bytes=8)
+    frame = array.array("h", [1000, -1000, 500, -500]).tobytes()
+    buffer.put(1, 4, frame, 20)
+    buffer.put(0, 0, frame, 21)
+    assert bytes(buffer.get()) == frame and buffer.last_sequence == 0
+    assert bytes(buffer.get()) == frame and buffer.last_sequence == 1
+
+    buffer.put(3, 12, frame, 80)
+    assert list(memoryview(buffer.get()).cast("h")) == [1000, -1000, 500, -500]
+    assert buffer.last_concealed
+    assert buffer.get() is not None and buffer.last_sequence == 3
+    assert list(memoryview(buffer.get()).cast("h")) == [1000, -1000, 500, -500]
+    assert list(memoryview(buffer.get()).cast("h")) == [500, -500, 250, -250]
+
+
+def test_conference_mixer_mixes_minus_own_voice_and_gates_silence():
+    import numpy as np
+
+    from server.mixer import ConferenceMixer
+
+    mixer = ConferenceMixer(capacity=4, frame_samples=4, threshold=100)
+    for participant in ("a", "b", "c", "d"):
+        assert mixer.add(participant)
+    assert not ConferenceMixer(capacity=0).add("x")
+
+    mixer.push("a", np.full(4, 20000, dtype="<i2").tobytes())
+    mixer.push("b", np.full(4, 20000, dtype="<i2").tobytes())
+    mixer.push("c", np.full(4, 10, dtype="<i2").tobytes())
+    ids, output, audible = mixer.mix()
+    mixed = dict(zip(ids, output.tolist()))
+
+    assert mixed["a"] == [20000] * 4 and mixed["b"] == [20000] * 4
+    assert mixed["c"] == [32767] * 4 and mixed["d"] == [32767] * 4
+    assert dict(zip(ids, audible.tolist())) == {"a": True, "b": True, "c": True, "d": True}
+
+    mixer.remove("a")
+    assert sorted(mixer.ids) == ["b", "c", "d"]
+    _, _, audible = mixer.mix()
+    assert not audible.any()
+
+
+def test_media_relay_ends_a_conference_below_two_legs_and_stops_mixing():
+    from server.media import MediaRelay
+
+    relay = MediaRelay("127.0.0.1")
+    call = relay.create_conference(["a", "b", "c"])
+    first = relay.mixing_thread
+    assert first.is_alive()
+    relay.leave_call(call.id, "b")
+    assert relay.get_call(call.id) is call
+    relay.leave_call(call.id, "c")
+    assert relay.get_call(call.id) is None and list(call.ssrcs) == ["a"]
+    first.join(1)
+    assert not first.is_alive() and relay.mixing_thread is None
+
+    again = relay.create_conference(["a", "b"])
+    second = relay.mixing_thread
+    assert second is not first and second.is_alive()
+    relay.end_call(again.id)
+    second.join(1)
+    assert relay.mixing_thread is None
+    relay.stop()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_the_last_participant_of_a_conference_is_hung_up(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        papa.conference(["drissa"])
+        call_id = papa.call_id
+        assert call_id and wait_until(lambda: drissa.call_id == call_id)
+
+        drissa.hangup()
+        assert wait_until(lambda: papa.call_id is None)
+        assert server.media.get_call(call_id) is None
+        assert wait_until(lambda: server.media.mixing_thread is None)
+        papa.disconnect()
+        drissa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_cluster_nodes_share_presence_and_forward(tmp_path):
+    from server.cluster import ClusterNode
+
+    presence, usernames = {}, {}
+    first = ClusterNode(0, presence, usernames, str(tmp_path), 2)
+    second = ClusterNode(1, presence, usernames, str(tmp_path), 2)
+    received = []
+    first.bind(lambda client_id, message: received.append((client_id, message)))
+    second.bind(lambda client_id, message: None)
+
+    assert first.claim("1", "alice")
+    assert not second.claim("1", "alice")
+    assert second.claim("2", "bob")
+    assert second.find("alice") == "1"
+    assert sorted(first.online()) == ["alice", "bob"]
+    assert first.online(exclude="1") == ["bob"]
+
+    assert second.forward("1", {"code": REQUEST_CODES["SEND_TEXT"], "payload": "hi"})
+    assert not first.forward("1", {"code": REQUEST_CODES["SEND_TEXT"], "payload": "self"})
+    for _ in range(100):
+        if received:
+            break
+        time.sleep(0.01)
+    assert received == [("1", {"code": REQUEST_CODES["SEND_TEXT"], "payload": "hi"})]
+
+    second.release("1")
+    assert "1" in presence
+    first.release("1")
+    assert first.find("alice") is None
+
+
+def test_cluster_node_logs_a_bad_datagram_and_keeps_receiving(tmp_path, caplog):
+    from server.cluster import ClusterNode
+
+    presence, usernames = {}, {}
+    first = ClusterNode(0, presence, usernames, str(tmp_path), 2)
+    second = ClusterNode(1, presence, usernames, str(tmp_path), 2)
+    received = []
+    first.bind(lambda client_id, message: received.append(message["payload"]) if message["payload"] != "boom" else 1 / 0)
+    second.bind(lambda client_id, message: None)
+    first.claim("1", "alice")
+
+    second.socket.sendto(b"not json", first.paths[0])
+    second.forward("1", {"code": REQUEST_CODES["SEND_TEXT"], "payload": "boom"})
+    second.forward("1", {"code": REQUEST_CODES["SEND_TEXT"], "payload": "x" * 100000})
+    assert wait_until(lambda: received == ["x" * 100000])
+    assert caplog.text.count("Failed to deliver a forwarded message") == 2
+    first.socket.close()
+    second.socket.close()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cluster_workers_refuse_duplicate_logins_and_route_across_workers(engine, tmp_path, monkeypatch):
+    from server.cluster import ClusterNode
+
+    # Two workers in one process, each on its own port, sharing presence like the manager dicts.
+    presence, usernames = {}, {}
+    workers = [start_server(engine, tmp_path, monkeypatch, ClusterNode(index, presence, usernames, str(tmp_path), 2)) for index in range(2)]
+    try:
+        assert sorted(path.name for path in tmp_path.glob("*.log")) == ["VoIPServer.worker-0.log", "VoIPServer.worker-1.log"]
+        papa = connect_client(workers[0], ACCOUNTS[0])
+        drissa = connect_client(workers[1], ACCOUNTS[1])
+        assert presence == {ACCOUNTS[0]["id"]: (0, "papa"), ACCOUNTS[1]["id"]: (1, "drissa")}
+
+        twin = VoIPClient(ACCOUNTS[0]["id"], "127.0.0.1", workers[1].port, "papa")
+        twin.connect_to_server()
+        assert not twin.isConnected
+        assert ACCOUNTS[0]["id"] not in workers[1].available_clients
+        assert presence[ACCOUNTS[0]["id"]] == (0, "papa")
+
+        friends = request(papa, "FRIENDS_LIST")
+        assert friends["code"] == REQUEST_CODES["OK"] and friends["payload"] == ["drissa"]
+        assert request(papa, "SEND_TEXT", to="drissa", message="across")["code"] == REQUEST_CODES["OK"]
+        assert wait_until(lambda: drissa.inbox == [{"from": "papa", "message": "across"}])
+        assert workers[0].cluster.forwarded >= 1 and workers[1].cluster.received >= 1
+
+        drissa.disconnect()
+        assert wait_until(lambda: ACCOUNTS[1]["id"] not in presence)
+        response = request(papa, "SEND_TEXT", to="drissa", message="later")
+        assert response["code"] == REQUEST_CODES["OK"] and "stored" in response["payload"]
+        # Worker 0 holds the spooled text and hands it over once drissa is back on worker 1.
+        drissa = connect_client(workers[1], ACCOUNTS[1])
+        assert wait_until(lambda: [text["message"] for text in drissa.inbox] == ["later"])
+        drissa.disconnect()
+        papa.disconnect()
+    finally:
+        for worker in workers:
+            worker.stop()
+
+
+def test_presence_deltas_apply_in_version_order():
+    from client.presence import PresenceCache
+    from server.presence import PresenceFeed
+
+    feed = PresenceFeed()
+    cache = PresenceCache("alice")
+    with feed.lock:
+        assert cache.apply(feed.snapshot(["alice", "bob"]))
+    assert cache.online == {"bob"}
+
+    feed.joined("carol")
+    feed.joined("dave")
+    feed.left("dave")
+    feed.left("bob")
+    with feed.lock:
+        delta = feed.flush()
+        assert feed.flush() is None
+    assert delta == {"version": 1, "joined": ["carol"], "left": ["bob"]}
+    assert cache.apply(delta) and cache.online == {"carol"}
+    assert cache.apply(delta) and cache.version == 1
+
+    assert not cache.apply({"version": 3, "joined": ["erin"], "left": []})
+    assert not cache.fresh
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_subscribers_get_a_presence_snapshot_then_deltas(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa = connect_client(server, ACCOUNTS[0])
+        assert papa.presence.fresh and papa.presence.online == set()
+        version = papa.presence.version
+
+        drissa = connect_client(server, ACCOUNTS[1])
+        assert drissa.presence.fresh and drissa.presence.online == {"papa"}
+        assert wait_until(lambda: papa.presence.online == {"drissa"})
+        assert papa.presence.version > version
+        version = papa.presence.version
+
+        drissa.disconnect()
+        assert wait_until(lambda: papa.presence.online == set())
+        assert papa.presence.version > version
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_client_matches_pipelined_replies_by_request_id(caplog):
+    client = VoIPClient("1", host="localhost", port=5000)
+    client.client_socket, server_socket = socket.socketpair()
+    client.private_key = None
     client.isConnected = True
+    client._start_reader()
+
+    first = client.submit({"code": REQUEST_CODES["PING"], "payload": {}})
+    second = client.submit({"code": REQUEST_CODES["FRIENDS_LIST"], "payload": {}})
+    frames = utils.FrameReader()
+    ids = [json.loads(bytes(frames.read_frame(server_socket)))["request_id"] for _ in range(2)]
+
+    utils.send_message(utils.encode_message({"code": REQUEST_CODES["OK"], "payload": ["bob"], "request_id": ids[1]}), server_socket)
+    utils.send_message(utils.encode_message({"code": REQUEST_CODES["SEND_TEXT"], "payload": {"from": "bob", "message": "hi"}}), server_socket)
+    utils.send_message(b"not json", server_socket)
+    utils.send_message(utils.encode_message({"code": REQUEST_CODES["OK"], "request_id": ids[0]}), server_socket)
+
+    assert second.result(5)["payload"] == ["bob"]
+    assert first.result(5)["request_id"] == ids[0]
+    assert client.inbox == [{"from": "bob", "message": "hi"}]
+    assert "Failed to handle a frame from the server" in caplog.text
+
+    pending = client.submit({"code": REQUEST_CODES["PING"], "payload": {}})
+    server_socket.close()
+    try:
+        pending.result(5)
+        assert False, "expected the pending request to fail"
+    except ConnectionResetError:
+        pass
+    client._close_socket()
+
+
+def test_async_client_skips_a_bad_frame_and_fails_requests_on_disconnect(caplog):
+    import asyncio
+
+    from client.async_api import AsyncVoIPClient
+
+    async def exchange():
+        client = AsyncVoIPClient("1", keys=(None, None))
+        client_socket, server_socket = socket.socketpair()
+        client.reader, client.writer = await asyncio.open_connection(sock=client_socket)
+        client.socket = utils.StreamSocket(client.writer)
+        client._reader_task = asyncio.get_running_loop().create_task(client._read())
+        first = asyncio.ensure_future(client.request(REQUEST_CODES["PING"]))
+        second = asyncio.ensure_future(client.request(REQUEST_CODES["PING"]))
+        await asyncio.sleep(0.05)
+        frames = utils.FrameReader()
+        ids = [json.loads(bytes(frames.read_frame(server_socket)))["request_id"] for _ in range(2)]
+
+        utils.send_message(b"not json", server_socket)
+        utils.send_message(utils.encode_message({"code": REQUEST_CODES["OK"], "request_id": ids[0]}), server_socket)
+        assert (await asyncio.wait_for(first, 5))["request_id"] == ids[0]
+        server_socket.close()
+        try:
+            await asyncio.wait_for(second, 5)
+            assert False, "expected the pending request to fail"
+        except ConnectionResetError:
+            pass
+        client.writer.close()
+
+    asyncio.run(exchange())
+    assert "Failed to handle a frame from the server" in caplog.text
+
+
+def test_timer_wheel_expires_rescheduled_and_cancelled_keys():
+    from server.timers import TimerWheel
+
+    wheel = TimerWheel(tick=1, slots=8, now=0)
+    wheel.schedule("a", 2.5)
+    wheel.schedule("b", 3)
+    wheel.schedule("c", 20)
+    wheel.schedule("d", 4)
+    wheel.cancel("d")
+
+    assert wheel.advance(2) == []
+    assert wheel.advance(3) == ["a", "b"]
+    wheel.schedule("a", 5)
+    assert wheel.advance(10) == ["a"]
+    assert "c" in wheel and len(wheel) == 1
+    assert wheel.advance(19) == []
+    assert wheel.advance(21) == ["c"]
+    assert len(wheel) == 0
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_idle_clients_answering_heartbeats_stay_and_silent_ones_are_reaped(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch, idle_timeout=0.3, heartbeat_timeout=0.3)
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        # drissa's reader stops, so her heartbeats go unanswered.
+        gate = threading.Event()
+        handle = drissa._handle_push
+        drissa._handle_push = lambda message: gate.wait(10) and handle(message)
+
+        assert wait_until(lambda: ACCOUNTS[1]["id"] not in server.available_clients)
+        assert server.reaped == 1 and ACCOUNTS[0]["id"] in server.available_clients
+        gate.set()
+        with pytest.raises(OSError):
+            request(drissa, "PING")
+
+        time.sleep(1.0)
+        assert ACCOUNTS[0]["id"] in server.available_clients and server.reaped == 1
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_benchmark_mix_and_percentiles():
+    from benchmark import parse_mix, summarize
+
+    assert parse_mix("ping=3, send_text=1") == {"ping": 3.0, "send_text": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("call=1")
+
+    stats = summarize([i / 1000 for i in range(1, 1001)], errors=2)
+    assert stats["count"] == 1000 and stats["errors"] == 2
+    assert round(stats["p50_ms"]) == 501 and round(stats["p99_ms"]) == 991 and round(stats["p999_ms"]) == 1000
+    assert summarize([])["p99_ms"] == 0.0
+
+
+def test_histogram_percentiles_and_prometheus_text():
+    from server.metrics import Histogram, MetricsRegistry
+
+    histogram = Histogram()
+    for micros in range(1, 10001):
+        histogram.observe(micros / 1_000_000)
+    assert histogram.count == 10000
+    for q in (0.5, 0.99, 0.999):
+        assert abs(histogram.percentile(q) - q * 0.01) <= q * 0.01 * 0.02
+    assert histogram.percentile(1.0) == 0.01
+
+    registry = MetricsRegistry()
+    registry.counter("sent_bytes_total").inc(42)
+    registry.gauge("sessions", lambda: 3)
+    registry.histogram("request_seconds", "PING").observe(0.002)
+    text = registry.render_prometheus()
+    assert "voip_sent_bytes_total 42" in text
+    assert "# TYPE voip_sessions gauge" in text and "voip_sessions 3" in text
+    assert 'voip_request_seconds{opcode="PING", quantile="0.99"} 0.002' in text
+    assert 'voip_request_seconds_count{opcode="PING"} 1' in text
+
+
+def test_log_pipeline_samples_batches_and_rotates(tmp_path):
+    from server import logs
+
+    path = tmp_path / "server.log"
+    logger, handler = logs.configure("VoIPServerTest", str(path), max_bytes=4096, backups=2, sample={"noisy": 5})
+    assert logs.configure("VoIPServerTest", str(path))[1] is handler
+
+    for i in range(50):
+        logger.info("noisy %d", i, extra={"event": "noisy"})
+    for i in range(40):
+        logger.info("Client %s connected.", i, extra={"event": "connect", "client": i})
+    logger.warning("kept", extra={"event": "noisy"})
+    handler.writer.stop()
+    logger.removeHandler(handler)
+
+    lines = []
+    for name in ("server.log.2", "server.log.1", "server.log"):
+        if (tmp_path / name).exists():
+            lines += [json.loads(line) for line in (tmp_path / name).read_text().splitlines()]
+    assert (tmp_path / "server.log.1").exists()
+    assert all(path.stat().st_size <= 4096 for path in tmp_path.iterdir())
+    noisy = [line for line in lines if line["event"] == "noisy" and line["level"] == "INFO"]
+    assert len(noisy) == 10 and all(line["sampled"] == 5 for line in noisy)
+    assert lines[-1]["message"] == "kept" and lines[-1]["level"] == "WARNING"
+    assert {"ts", "level", "logger", "message", "event", "client"} <= set(lines[-2])
+    assert handler.dropped == 0
+
+
+def test_log_pipeline_is_replaced_when_the_path_changes(tmp_path):
+    from server import logs
+
+    logger, first = logs.configure("VoIPServerSwap", str(tmp_path / "a.log"))
+    _, second = logs.configure("VoIPServerSwap", str(tmp_path / "b.log"))
+    assert second is not first and logger.handlers == [second]
+    first.writer.join(5)
+    assert not first.writer.is_alive()
+
+    logger.info("to b", extra={"event": "swap"})
+    second.writer.stop()
+    logger.removeHandler(second)
+    assert (tmp_path / "a.log").read_text() == ""
+    assert json.loads((tmp_path / "b.log").read_text())["message"] == "to b"
+
+
+def test_client_directories_index_update_and_reload(tmp_path):
+    import os
+
+    from server.directory import JsonDirectory, SqliteDirectory, open_directory
+
+    path = tmp_path / "clients.json"
+    path.write_text(json.dumps({"clients": [{"id": "a", "username": "alice"}]}))
+    directory = open_directory(str(path))
+    assert isinstance(directory, JsonDirectory)
+    assert "a" in directory and directory.by_username("alice")["id"] == "a"
+    assert directory.refresh() is False
+
+    directory.add({"id": "b", "username": "bob"})
+    assert directory.refresh() is False
+    assert json.loads(path.read_text())["clients"][-1] == {"id": "b", "username": "bob"}
+
+    path.write_text(json.dumps({"clients": [{"id": "c", "username": "carol"}]}))
+    os.utime(path, ns=(0, 10 ** 9))
+    assert directory.refresh() is True
+    assert "a" not in directory and directory.get("c")["username"] == "carol"
+
+    database = open_directory(str(tmp_path / "clients.db"))
+    assert isinstance(database, SqliteDirectory)
+    database.add_many({"id": f"id-{i}", "username": f"user{i}", "friends": [i]} for i in range(1000))
+    assert len(database) == 1000
+    assert database.get("id-42") == {"id": "id-42", "username": "user42", "friends": [42]}
+    assert database.by_username("user7")["id"] == "id-7"
+    database.add({"id": "id-42", "username": "renamed"})
+    assert database.by_username("user42") is None and database.get("id-42")["username"] == "renamed"
+    other = SqliteDirectory(str(tmp_path / "clients.db"))
+    assert other.remove("id-1") and "id-1" not in database
+    assert database.get("missing") is None
+    database.close()
+    other.close()
+
+
+def test_identity_keys_persist_and_x25519_sessions_agree(tmp_path):
+    import os
+    import stat
+
+
+    path = tmp_path / "keys" / "client.pem"
+    private_key, public_key = security.load_identity(str(path))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert security.load_identity(str(path))[1] == public_key
+    wrapped = security.wrap_session_key(b"k" * 32, public_key)
+    assert security.unwrap_session_key(wrapped, security.load_identity(str(path))[0]) == b"k" * 32
+
+    generated = []
+    pool = security.KeyPool(size=1, generate=lambda: generated.append(1) or security.generate_keys())
+    assert security.load_public_key(pool.take()[1])
+    assert generated
+
+    client_key, server_key = security.generate_exchange_key(), security.generate_exchange_key()
+    client = security.SessionCipher(security.derive_session_key(client_key, security.get_exchange_key(server_key)))
+    server = security.SessionCipher(security.derive_session_key(server_key, security.get_exchange_key(client_key)), is_server=True)
+    assert server.decrypt(client.encrypt(b"hello")) == b"hello"
+
+
+def test_session_tickets_rotate_keys_and_expire():
+    from server.tickets import TicketKeeper
+
+    now = [1000.0]
+    keeper = TicketKeeper(b"s" * 32, lifetime=300, rotation=100, clock=lambda: now[0])
+    ticket = keeper.issue({"id": "a", "secret": "00"})
+    assert keeper.open(ticket) == {"id": "a", "secret": "00"}
+
+    now[0] += 150
+    rotated = keeper.issue({"id": "b"})
+    assert rotated[:8] != ticket[:8]
+    assert keeper.open(ticket)["id"] == "a"
+    assert TicketKeeper(b"s" * 32, lifetime=300, rotation=100, clock=lambda: now[0]).open(rotated) == {"id": "b"}
+    assert TicketKeeper(b"t" * 32, lifetime=300, rotation=100, clock=lambda: now[0]).open(rotated) is None
+    assert keeper.open(rotated[:-1] + bytes([rotated[-1] ^ 1])) is None
+    assert keeper.open(b"short") is None
+
+    now[0] += 200
+    assert keeper.open(ticket) is None
+    assert keeper.open(rotated)["id"] == "b"
+
+    # Retired keys are refused even when the sealed state would still be valid.
+    long_lived = TicketKeeper(b"s" * 32, lifetime=10 ** 6, rotation=100, clock=lambda: now[0])
+    old = long_lived.issue({"id": "c"})
+    long_lived.lifetime = 300
+    now[0] += 500
+    assert long_lived.open(old) is None
+    assert long_lived.open(long_lived.issue({"id": "d"})) == {"id": "d"}
+    assert all(epoch >= long_lived.epoch() - 3 for epoch in long_lived._keys)
+
+
+def test_resume_proof_and_keys_bind_both_nonces():
+    import os
+
+
+    secret = security.derive_resumption_secret(b"k" * 32)
+    client_nonce, server_nonce = os.urandom(16), os.urandom(16)
+    key = security.resume_session_key(secret, client_nonce, server_nonce)
+    assert key != security.resume_session_key(secret, client_nonce, os.urandom(16))
+    assert security.resume_proof(secret, client_nonce) != security.resume_proof(secret, server_nonce)
+    client, server = security.SessionCipher(key), security.SessionCipher(key, is_server=True)
+    assert server.decrypt(client.encrypt(b"back")) == b"back"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_reconnect_resumes_from_the_ticket_and_falls_back_when_it_is_refused(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa = connect_client(server, ACCOUNTS[0])
+        assert papa.ticket is not None
+        papa.disconnect()
+        assert wait_until(lambda: len(server.available_clients) == 0)
+
+        server.resume = MagicMock(wraps=server.resume)
+        server.connect = MagicMock(wraps=server.connect)
+        papa.connect_to_server()
+        assert papa.isConnected and server.resume.call_count == 1 and server.connect.call_count == 0
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        papa.disconnect()
+        assert wait_until(lambda: len(server.available_clients) == 0)
+
+        papa.ticket = ("00" * 64, papa.ticket[1])
+        papa.connect_to_server()
+        assert papa.isConnected and server.resume.call_count == 2 and server.connect.call_count == 1
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_message_spool_survives_restart_and_compacts(tmp_path):
+    from server.spool import MessageSpool
+
+    spool = MessageSpool(str(tmp_path), segment_bytes=512, flush_interval=60)
+    for i in range(40):
+        spool.append("bob" if i % 2 else "alice", {"from": "carol", "message": f"hello {i}"})
+    assert spool.pending() == 40 and spool.segments() > 2
+    assert [m["message"] for m in spool.take("alice")] == [f"hello {i}" for i in range(0, 40, 2)]
+    assert spool.take("alice") == []
+    spool.close()
+
+    # A torn record at the tail is cut off; the tombstone keeps alice's messages delivered.
+    last = sorted(tmp_path.iterdir())[-1]
+    with open(last, 'ab') as f:
+        f.write(b"\x00\x00\x01\x00garbage")
+    spool = MessageSpool(str(tmp_path), segment_bytes=512, flush_interval=60)
+    assert spool.pending("alice") == 0 and spool.pending("bob") == 20
+    spool.append("bob", {"from": "carol", "message": "late"})
+    messages = spool.take("bob")
+    assert [m["message"] for m in messages] == [f"hello {i}" for i in range(1, 40, 2)] + ["late"]
+    assert spool.pending() == 0 and spool.segments() == 1
+    spool.close()
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_texts_to_offline_users_are_spooled_and_delivered_on_connect(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa = connect_client(server, ACCOUNTS[0])
+        for index in range(3):
+            response = request(papa, "SEND_TEXT", to="drissa", message=f"while you were out {index}")
+            assert response["code"] == REQUEST_CODES["OK"] and "stored" in response["payload"]
+
+        drissa = connect_client(server, ACCOUNTS[1])
+        assert wait_until(lambda: len(drissa.inbox) == 3)
+        assert [text["message"] for text in drissa.inbox] == [f"while you were out {index}" for index in range(3)]
+        assert all(text["from"] == "papa" for text in drissa.inbox)
+        drissa.disconnect()
+
+        drissa = connect_client(server, ACCOUNTS[1])
+        time.sleep(0.2)
+        assert drissa.inbox == []
+        papa.disconnect()
+        drissa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_room_frames_are_sealed_once_and_rekeyed_on_leave():
+    from client.rooms import RoomKeyring
+    from server.rooms import RoomRegistry
+
+    registry = RoomRegistry()
+    room = registry.create("lobby", "a")
+    assert registry.create("lobby", "b") is None
+    for member in ("a", "b", "c"):
+        assert registry.join(room, member, member.upper())
+    room.rekey()
+    keyrings = {member: RoomKeyring() for member in room.members}
+    for keyring in keyrings.values():
+        assert keyring.apply(room.key_message()["payload"])
+
+    frame = room.seal(utils.encode_message({"code": REQUEST_CODES["ROOM_POST"], "payload": {"message": "hi"}}))
+    assert utils.is_room_frame(frame[utils.FRAME_HEADER.size:])
+    body = utils.FrameReader()
+    body.feed(frame)
+    body = body.next_frame()
+    assert all(keyring.open(body)["payload"]["message"] == "hi" for keyring in keyrings.values())
+    assert keyrings["b"].open(body) is None
+
+    assert registry.leave(room, "c") and registry.rooms_of("c") == []
+    room.rekey()
+    keyrings["a"].apply(room.key_message()["payload"])
+    assert keyrings["a"].members["lobby"] == ["A", "B"]
+    assert not keyrings["a"].apply(dict(room.key_message()["payload"], epoch=1))
+    after = utils.FrameReader()
+    after.feed(room.seal(b'{"code": 2000, "payload": {"message": "bye"}}'))
+    after = after.next_frame()
+    assert keyrings["a"].open(after)["payload"]["message"] == "bye"
+    assert keyrings["c"].open(after) is None
+
+    registry.leave(room, "a")
+    registry.leave(room, "b")
+    assert registry.get("lobby") is None and len(registry) == 0
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_room_posts_are_sealed_once_and_a_leave_rotates_the_key(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        assert request(papa, "ROOM_CREATE", room="lobby")["code"] == REQUEST_CODES["OK"]
+        assert request(drissa, "ROOM_JOIN", room="lobby")["code"] == REQUEST_CODES["OK"]
+        assert wait_until(lambda: "lobby" in drissa.rooms and "lobby" in papa.rooms)
+        epoch = drissa.rooms.ciphers["lobby"].epoch
+        assert papa.rooms.ciphers["lobby"].epoch == epoch
+
+        reply = request(papa, "ROOM_POST", room="lobby", message="hello")
+        assert reply["code"] == REQUEST_CODES["OK"] and reply["payload"]["delivered"] == 1
+        assert wait_until(lambda: drissa.inbox == [{"room": "lobby", "from": "papa", "message": "hello"}])
+        assert server.rooms.get("lobby").seq == 1
+
+        assert request(drissa, "ROOM_LEAVE", room="lobby")["code"] == REQUEST_CODES["OK"]
+        assert wait_until(lambda: papa.rooms.ciphers["lobby"].epoch > epoch)
+        assert request(papa, "ROOM_POST", room="lobby", message="after")["payload"]["delivered"] == 0
+        assert request(drissa, "ROOM_POST", room="lobby", message="ghost")["code"] == REQUEST_CODES["NOT_FOUND"]
+        time.sleep(0.1)
+        assert len(drissa.inbox) == 1
+        papa.disconnect()
+        drissa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_admission_sheds_handshakes_and_rate_limits_per_key():
+    from server.admission import AdmissionControl
+
+    now = [0.0]
+    admission = AdmissionControl({"max_handshakes": 2, "max_sessions": 10,
+                                  "rate_limits": {"client": {"SEND_TEXT": [2, 4]}, "address": {"CONNECT": [1, 1]}}},
+                                 clock=lambda: now[0])
+    assert admission.begin_handshake(0) and admission.begin_handshake(0)
+    assert not admission.begin_handshake(0)
+    admission.end_handshake()
+    assert not admission.begin_handshake(10)
+    assert admission.begin_handshake(9) and admission.shed == 2
+
+    connect, text = REQUEST_CODES["CONNECT"], REQUEST_CODES["SEND_TEXT"]
+    assert admission.check(connect, address="10.0.0.1") == 0
+    assert admission.check(connect, address="10.0.0.1") == 1.0
+    assert admission.check(connect, address="10.0.0.2") == 0
+    assert [admission.check(text, "a") for _ in range(5)] == [0, 0, 0, 0, 0.5]
+    assert admission.check(text, "b") == 0 and admission.check(REQUEST_CODES["PING"], "a") == 0
+    now[0] = 0.5
+    assert admission.check(text, "a") == 0 and admission.limited == 2
+
+    now[0] = 10.0
+    admission.prune()
+    assert len(admission.by_client) == 0 and len(admission.by_address) == 0
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_server_sheds_connects_while_busy_and_rate_limits_requests(engine, tmp_path, monkeypatch):
+    admission = {"max_handshakes": 1, "handshake_timeout": 0.5, "rate_limits": {"client": {"SEND_TEXT": [1, 2]}}}
+    server = start_server(engine, tmp_path, monkeypatch, admission=admission)
+    try:
+        # A peer trickling its handshake holds the only slot, but only until the timeout.
+        slow = socket.create_connection(("127.0.0.1", server.port))
+        slow.sendall(b"\x00\x00\x01")
+        assert wait_until(lambda: server.admission.handshakes == 1)
+        started = time.monotonic()
+        shed = VoIPClient(ACCOUNTS[0]["id"], "127.0.0.1", server.port, "papa")
+        shed.connect_to_server()
+        assert not shed.isConnected and server.admission.shed == 1
+
+        slow.settimeout(0.1)
+        closed = False
+        while not closed and time.monotonic() - started < 3:
+            try:
+                slow.send(b"\x00")
+                closed = slow.recv(1) == b""
+            except socket.timeout:
+                pass
+            except OSError:
+                closed = True
+        assert closed and time.monotonic() - started < 1.5
+        slow.close()
+
+        papa = connect_client(server, ACCOUNTS[0])
+        codes = [request(papa, "SEND_TEXT", to="drissa", message="hi") for _ in range(3)]
+        assert [response["code"] for response in codes] == [REQUEST_CODES["OK"]] * 2 + [REQUEST_CODES["BUSY"]]
+        assert 0 < codes[-1]["retry_after"] <= 1
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_a_handshake_reply_that_fails_to_send_leaves_no_session(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    send = server._send
+
+    def fail_once(message, *args, **kwargs):
+        if isinstance(message, dict) and message.get("payload") == "papa":
+            server._send = send
+            raise ConnectionResetError("reply lost")
+        return send(message, *args, **kwargs)
+
+    server._send = fail_once
+    try:
+        failed = VoIPClient(ACCOUNTS[0]["id"], "127.0.0.1", server.port, "papa")
+        failed.connect_to_server()
+        assert not failed.isConnected
+        assert wait_until(lambda: len(server.available_clients) == 0)
+
+        papa = connect_client(server, ACCOUNTS[0])
+        assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        papa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_read_frame_deadline_bounds_a_trickling_sender():
+    left, right = socket.socketpair()
+    frame = utils.frame_message(b"x" * 64)
+    stop = threading.Event()
+
+    def trickle():
+        for byte in frame:
+            if stop.wait(0.05):
+                break
+            left.send(bytes([byte]))
+
+    threading.Thread(target=trickle, daemon=True).start()
+    started = time.monotonic()
+    with pytest.raises(socket.timeout):
+        utils.FrameReader().read_frame(right, time.monotonic() + 0.3)
+    assert time.monotonic() - started < 0.5
+    stop.set()
+    left.close()
+    right.close()
+
+
+def test_crypto_executor_batches_jobs_and_falls_back_when_full():
+    import asyncio
+    from server.crypto import CryptoExecutor
+    from server.metrics import MetricsRegistry
+
+    metrics = MetricsRegistry()
+    executor = CryptoExecutor(workers=1, queue_size=4, batch=8, metrics=metrics)
+    assert executor.run(pow, 2, 10) == 1024
+    executor.start()
+    try:
+        gate = threading.Event()
+        blocker = executor.submit(gate.wait, 5)
+        time.sleep(0.05)
+        futures = [executor.submit(pow, 2, n) for n in range(4)]
+        threads = {executor.run(lambda: threading.current_thread().name)}
+        gate.set()
+        assert blocker.result(5) and [future.result(5) for future in futures] == [1, 2, 4, 8]
+        # The queued jobs ran as one batch; the one that found the queue full ran on the caller.
+        assert executor.batches == 2 and threads == {threading.current_thread().name}
+
+        async def offloaded():
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*(executor.run_async(loop, pow, 3, n) for n in range(3)))
+            try:
+                await executor.run_async(loop, int, "not a number")
+            except ValueError:
+                return results
+        assert asyncio.run(offloaded()) == [1, 3, 9]
+        assert metrics.histogram("crypto_job_seconds").count == 9
+    finally:
+        executor.stop()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_rsa_envelopes_and_bulk_frames_decrypt_on_the_pool_and_pings_inline(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch, crypto={"workers": 2, "offload_bytes": 4096})
+    legacy = socket.create_connection(("127.0.0.1", server.port))
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        batches = server.crypto.batches
+        for _ in range(20):
+            assert request(papa, "PING")["code"] == REQUEST_CODES["OK"]
+        assert server.crypto.batches == batches
+
+        assert request(papa, "SEND_TEXT", to="drissa", message="x" * 8192)["code"] == REQUEST_CODES["OK"]
+        assert server.crypto.batches == batches + 1
+        assert wait_until(lambda: len(drissa.inbox) == 1)
+        drissa.disconnect()
+        assert wait_until(lambda: ACCOUNTS[1]["id"] not in server.available_clients)
+
+        # Without a session every request is an RSA envelope.
+        private_key, public_key = security.generate_keys()
+        frames = utils.FrameReader()
+        offer = {"id": ACCOUNTS[1]["id"], "username": "drissa", "public_key": security.get_public_key(public_key).decode("utf-8"), "formats": ["binary"]}
+        reply = utils.send_message_and_wait_for_response(utils.encode_message({"code": REQUEST_CODES["CONNECT"], "payload": offer}), legacy, frames=frames)
+        server_key = security.load_public_key(utils.decode_message(reply)["public_key"])
+        for count in range(1, 4):
+            message = {"code": REQUEST_CODES["FRIENDS_LIST"], "payload": {"id": ACCOUNTS[1]["id"]}, "encrypted": True}
+            utils.send_message(utils.encode_message(message, True), legacy, server_key, binary=True)
+            reply = utils.decode_message(utils.receive_message(legacy, private_key, frames))
+            assert reply["code"] == REQUEST_CODES["OK"] and reply["payload"] == ["papa"]
+            assert server.crypto.batches == batches + 1 + count
+        papa.disconnect()
+    finally:
+        legacy.close()
+        server.stop()
+
+
+def test_crypto_executor_runs_urgent_jobs_before_queued_ones():
+    from server.crypto import CryptoExecutor
+
+    executor = CryptoExecutor(workers=1, queue_size=8, batch=8)
+    executor.start()
+    try:
+        order = []
+        gate = threading.Event()
+        executor.submit(gate.wait, 5)
+        time.sleep(0.05)
+        bulk = [executor.submit(order.append, n) for n in range(4)]
+        urgent = executor.submit(order.append, "ping", urgent=True)
+        gate.set()
+        urgent.result(5)
+        [future.result(5) for future in bulk]
+        assert order == ["ping", 0, 1, 2, 3]
+    finally:
+        executor.stop()
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_rsa_pings_overtake_queued_bulk_rsa_work(engine, tmp_path, monkeypatch):
+    import select
+
+    server = start_server(engine, tmp_path, monkeypatch, crypto={"workers": 1, "offload_bytes": 4096})
+    accounts = [{"id": f"load-{index}", "username": f"load{index}"} for index in range(17)]
+    (tmp_path / "clients.json").write_text(json.dumps({"clients": accounts}))
+    server.load_clients(str(tmp_path / "clients.json"))
+    private_key, public_key = security.generate_keys()
+    sockets, server_key = [], None
+    try:
+        # Legacy clients without a session: every request they send is an RSA envelope.
+        for account in accounts:
+            sockets.append(socket.create_connection(("127.0.0.1", server.port)))
+            offer = {"id": account["id"], "username": account["username"], "public_key": security.get_public_key(public_key).decode("utf-8"), "formats": ["binary"]}
+            reply = utils.send_message_and_wait_for_response(utils.encode_message({"code": REQUEST_CODES["CONNECT"], "payload": offer}), sockets[-1])
+            server_key = security.load_public_key(utils.decode_message(reply)["public_key"])
+        pinger, loaders = sockets[0], sockets[1:]
+
+        # Hold the only crypto worker so a backlog of bulk envelopes builds up behind it.
+        gate = threading.Event()
+        server.crypto.submit(gate.wait, 10)
+        assert wait_until(lambda: server.crypto._queue.qsize() == 0)
+        for loader, account in zip(loaders, accounts[1:]):
+            text = {"code": REQUEST_CODES["SEND_TEXT"], "payload": {"id": account["id"], "to": "nobody", "message": "x" * 8192}, "encrypted": True}
+            utils.send_message(utils.encode_message(text, True), loader, server_key, binary=True)
+        assert wait_until(lambda: server.crypto._queue.qsize() == len(loaders))
+        ping = {"code": REQUEST_CODES["PING"], "payload": {"id": accounts[0]["id"]}, "encrypted": True}
+        utils.send_message(utils.encode_message(ping, True), pinger, server_key, binary=True)
+        assert wait_until(lambda: len(server.crypto._urgent) == 1)
+
+        gate.set()
+        started = time.perf_counter()
+        assert utils.decode_message(utils.receive_message(pinger, private_key))["code"] == REQUEST_CODES["OK"]
+        latency = time.perf_counter() - started
+        assert len(select.select(loaders, [], [], 0)[0]) <= len(loaders) // 2
+        waiting = set(loaders)
+        while waiting:
+            answered = select.select(list(waiting), [], [], 5)[0]
+            assert answered
+            waiting -= set(answered)
+        drained = time.perf_counter() - started
+        # The PING waited for at most the envelope already being decrypted, not for the backlog.
+        assert latency < drained / 2
+        for loader in loaders:
+            assert utils.decode_message(utils.receive_message(loader, private_key))["code"] == REQUEST_CODES["NOT_FOUND"]
+    finally:
+        for client_socket in sockets:
+            client_socket.close()
+        server.stop()
+
+
+def test_frame_writer_coalesces_and_resumes_partial_sends():
+    from server.outbox import Outbox
+
+    class TrickleSocket:
+        def __init__(self):
+            self.calls, self.data = 0, b""
+
+        def sendmsg(self, buffers):
+            self.calls += 1
+            chunk = b"".join(bytes(buffer) for buffer in buffers)[:7]
+            self.data += chunk
+            return len(chunk)
+
+    sock = TrickleSocket()
+    writer = utils.FrameWriter(sock, max_bytes=50, max_delay=60)
+    frames = [utils.frame_message(b"frame %d" % n) for n in range(5)]
+    assert [writer.write(frame) for frame in frames] == [False, False, False, False, True]
+    assert writer.flush() == sum(map(len, frames)) and len(writer) == 0 and writer.flush() == 0
+    reader = utils.FrameReader()
+    reader.feed(sock.data)
+    assert reader.ready
+    assert [bytes(reader.next_frame()) for _ in frames] == [b"frame %d" % n for n in range(5)]
+    assert not reader.ready and sock.calls == -(-len(sock.data) // 7)
+
+    assert utils.FrameWriter(sock, max_delay=0).write(b"x")
+    outbox = Outbox(8)
+    for n in range(3):
+        outbox.put({"n": n})
+    assert outbox.get() == {"n": 0} and outbox.get_ready(5) == [{"n": 1}, {"n": 2}] and outbox.get_ready(5) == []
+    outbox.close()
+    assert outbox.get_ready(5) == [None]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_pipelined_replies_and_fanned_in_texts_share_socket_writes(engine, tmp_path, monkeypatch):
+    server = start_server(engine, tmp_path, monkeypatch)
+    try:
+        papa, drissa = [connect_client(server, account) for account in ACCOUNTS]
+        frames, writes = server._frames_sent.value, server._writes.value
+        pings = [papa.submit({"code": REQUEST_CODES["PING"], "payload": {}}) for _ in range(500)]
+        assert all(ping.result(5)["code"] == REQUEST_CODES["OK"] for ping in pings)
+        # The counters move just after the write that carried the last reply.
+        assert wait_until(lambda: server._frames_sent.value - frames >= 500)
+        assert (server._writes.value - writes) * 4 < server._frames_sent.value - frames
+
+        frames, writes = server._frames_sent.value, server._writes.value
+        texts = [papa.submit({"code": REQUEST_CODES["SEND_TEXT"], "payload": {"to": "drissa", "message": f"text {index}"}}) for index in range(200)]
+        assert all(text.result(5)["code"] == REQUEST_CODES["OK"] for text in texts)
+        assert wait_until(lambda: len(drissa.inbox) == 200)
+        assert [text["message"] for text in drissa.inbox] == [f"text {index}" for index in range(200)]
+        assert wait_until(lambda: server._frames_sent.value - frames >= 400)
+        assert (server._writes.value - writes) * 4 < server._frames_sent.value - frames
+        papa.disconnect()
+        drissa.disconnect()
+    finally:
+        server.stop()
+
+
+def test_audio_pipeline_resamples_gates_silence_and_loops_back(tmp_path):
+    import wave
+
+    import numpy as np
+
+    from client.audio import AudioPipeline, AudioRing, ToneSource, VoiceActivityDetector, WavSink, WavSource, loopback
+
+    samples = np.zeros(22050, dtype="<i2")
+    ToneSource(sample_rate=44100, duration=0.5).read_into(samples)
+    with wave.open(str(tmp_path / "tone.wav"), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(44100)
+        f.writeframes(np.repeat(samples, 2).tobytes())
+
+    class Channel:
+        def __init__(self):
+            self.markers, self.skipped = [], 0
+
+        def send_frame(self, pcm, samples, marker=False):
+            self.markers.append(marker)
+
+        def skip_frame(self, samples):
+            self.skipped += 1
+
+    pipeline = AudioPipeline(WavSource(str(tmp_path / "tone.wav")), channel=Channel())
+    reference = ToneSource()
+    expected = np.zeros(320, dtype="<i2")
+    for _ in range(24):
+        pipeline.pump()
+        assert pipeline.capture()
+        reference.read_into(expected)
+        assert np.abs(pipeline.frame.astype(int) - expected).max() < 60
+    pipeline.pump()
+    assert pipeline.capture() and pipeline.capture_ring.underruns == 0
+    pipeline.pump()
+    assert not pipeline.capture() and pipeline.captured == 25
+
+    channel = Channel()
+    gated = AudioPipeline(ToneSource(talk_ms=100, pause_ms=200, duration=0.6), channel=channel,
+                          vad=VoiceActivityDetector(hangover=2))
+    gated.pump()
+    while gated.capture():
+        gated.pump()
+    assert (gated.sent, gated.suppressed, channel.skipped) == (14, 16, 16)
+    assert channel.markers == [True] + [False] * 6 + [True] + [False] * 6
+
+    class Receiving:
+        def __init__(self):
+            self.jitter = MagicMock(last_concealed=False, last_sequence=6)
+
+        def next_frame(self):
+            self.jitter.last_sequence += 1
+            return np.full(320, self.jitter.last_sequence, dtype="<i2").tobytes()
 
-    # Inject your disconnect code
-    def real_disconnect():
-        msg = {"code": REQUEST_CODES["DISCONNECT"]}
-        client.client_socket.send(json.dumps(msg).encode("utf-8"))
-        resp = client.client_socket.recv(1024).decode()
-        if json.loads(resp).get("code") == REQUEST_CODES["OK"]:
-            client.isConnected = False
-        client.client_socket.close()
+    heard = []
+    speaker = AudioPipeline(sink=MagicMock(write=lambda samples: heard.append((speaker.sequence, int(samples[0])))),
+                            channel=Receiving(), buffer_frames=2)
+    speaker.pump()
+    assert speaker.playback_ring.underruns == 1 and heard == []
+    for _ in range(3):
+        speaker.tick()
+    assert speaker.played == 3 and speaker.playback_ring.overruns == 320
+    speaker.pump()
+    speaker.pump()
+    speaker.tick()
+    speaker.pump()
+    assert heard == [(7, 7), (8, 8), (10, 10)]
 
-    client.disconnect = real_disconnect
+    ring = AudioRing(500)
+    assert ring.write(np.arange(320, dtype="<i2")) == 320 and ring.read_into(expected) == 320
+    assert ring.write(np.arange(400, dtype="<i2")) == 400 and ring.write(expected) == 100 and ring.overruns == 220
+    assert ring.read_into(expected) == 320 and list(expected[:3]) == [0, 1, 2] and ring.read_into(expected) == 0
 
-    client.disconnect()
+    sink = WavSink(str(tmp_path / "out.wav"))
+    sink.write(expected)
+    sink.close()
+    assert WavSource(str(tmp_path / "out.wav")).read_into(np.zeros(400, dtype="<i2")) == 320
 
-    # Assertions
-    fake_socket.send.assert_called_once()
-    fake_socket.recv.assert_called_once()
-    fake_socket.close.assert_called_once()
-    assert client.isConnected is False
+    stats = loopback(50)
+    assert stats["played"] == stats["sent"] == 50 and stats["dropped"] == 0
+    assert 0 < stats["p95_latency_ms"] < stats["target_delay_ms"] + 40
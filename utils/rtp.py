@@ -0,0 +1,31 @@
+import struct
+from collections import namedtuple
+
+# RTP fixed header (RFC 3550): V/P/X/CC, M/PT, sequence, timestamp, SSRC.
+RTP_HEADER = struct.Struct("!BBHII")
+_SSRC = struct.Struct("!I")
+RTP_VERSION = 0x80
+MAX_PACKET_SIZE = 2048
+
+# Dynamic payload type for 16-bit little-endian mono PCM at 16 kHz.
+PCM_PAYLOAD_TYPE = 96
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 320  # 20 ms
+FRAME_BYTES = FRAME_SAMPLES * 2
+
+Packet = namedtuple("Packet", ["sequence", "timestamp", "ssrc", "payload_type", "payload"])
+
+
+def pack_header(sequence: int, timestamp: int, ssrc: int, payload_type: int = PCM_PAYLOAD_TYPE, marker: bool = False):
+    return RTP_HEADER.pack(RTP_VERSION, (0x80 if marker else 0) | payload_type, sequence & 0xFFFF, timestamp & 0xFFFFFFFF, ssrc)
+
+
+def unpack_header(data):
+    version, marker_type, sequence, timestamp, ssrc = RTP_HEADER.unpack_from(data)
+    if version & 0xC0 != RTP_VERSION:
+        raise ValueError("Not an RTP packet")
+    return sequence, timestamp, ssrc, marker_type & 0x7F
+
+
+def peek_ssrc(data):
+    return _SSRC.unpack_from(data, 8)[0]
@@ -1,9 +1,20 @@
+import hmac
 import os
-from cryptography.hazmat.primitives.asymmetric import rsa
+import queue
+import threading
+from cryptography.hazmat.primitives.asymmetric import rsa, x25519
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
 
 def generate_keys():
     private_key = rsa.generate_private_key(
@@ -26,8 +37,20 @@ def get_private_key(private_key):
             encryption_algorithm=serialization.NoEncryption()
         )
     
-def encrypt_message(message: bytes, public_key: bytes) -> bytes:
-    public_key = serialization.load_pem_public_key(public_key)
+def load_public_key(public_key):
+    if isinstance(public_key, str):
+        public_key = public_key.encode('utf-8')
+    if isinstance(public_key, bytes):
+        return serialization.load_pem_public_key(public_key)
+    return public_key
+
+def load_private_key(private_key):
+    if isinstance(private_key, bytes):
+        return serialization.load_pem_private_key(private_key, password=None)
+    return private_key
+    
+def encrypt_message(message: bytes, public_key) -> bytes:
+    public_key = load_public_key(public_key)
     
     aes_key = os.urandom(32)
     iv = os.urandom(16)
@@ -36,34 +59,211 @@ def encrypt_message(message: bytes, public_key: bytes) -> bytes:
     encryptor = cipher.encryptor()
     ciphertext = encryptor.update(message) + encryptor.finalize()
     
-    encrypted_key = public_key.encrypt(
-    aes_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+    encrypted_key = public_key.encrypt(aes_key, OAEP)
     return {
         "ciphertext": ciphertext,
         "encrypted_key": encrypted_key,
         "iv": iv
     }
 
-def decrypt_message(encrypted_block: dict, private_key: bytes) -> dict:
-    private_key = serialization.load_pem_private_key(private_key, password=None)
+def decrypt_message(encrypted_block: dict, private_key) -> dict:
+    private_key = load_private_key(private_key)
 
-    aes_key = private_key.decrypt(
-    encrypted_block['encrypted_key'],
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+    aes_key = private_key.decrypt(encrypted_block['encrypted_key'], OAEP)
     
     cipher = Cipher(algorithms.AES(aes_key), modes.CFB(encrypted_block["iv"]))
     decryptor = cipher.decryptor()
     plaintext = decryptor.update(encrypted_block["ciphertext"]) + decryptor.finalize()
     
-    return plaintext
\ No newline at end of file
+    return plaintext
+
+def load_identity(path: str):
+    """Load the RSA key pair kept at ``path``, creating it on first use.
+
+    Returns the private key and the PEM public key, like a freshly generated
+    pair. The file is created atomically with owner-only permissions, so
+    processes starting together end up sharing the same key.
+    """
+    try:
+        with open(path, 'rb') as f:
+            # We wrote this key ourselves; validating it costs more than generating a new one.
+            private_key = serialization.load_pem_private_key(f.read(), password=None, unsafe_skip_rsa_key_validation=True)
+        return private_key, get_public_key(private_key.public_key())
+    except FileNotFoundError:
+        pass
+    private_key, public_key = generate_keys()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(get_private_key(private_key))
+    try:
+        os.link(temp_path, path)
+    except FileExistsError:
+        # Someone else won the race, use their key.
+        os.unlink(temp_path)
+        return load_identity(path)
+    os.unlink(temp_path)
+    return private_key, get_public_key(public_key)
+
+
+class KeyPool:
+    """RSA key pairs generated ahead of time by a background thread.
+
+    ``take`` hands out a ready pair, falling back to generating one inline
+    when the pool ran dry, and wakes the thread to refill it.
+    """
+
+    def __init__(self, size: int = 2, generate=None):
+        self.size = size
+        self.generate = generate or generate_keys
+        self._keys = queue.Queue(size)
+        self._thread = threading.Thread(target=self._fill, name="VoIPKeyPool", daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        while True:
+            private_key, public_key = self.generate()
+            self._keys.put((private_key, get_public_key(public_key)))
+
+    def take(self):
+        """A private key and its PEM public key."""
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            private_key, public_key = self.generate()
+            return private_key, get_public_key(public_key)
+
+    def __len__(self):
+        return self._keys.qsize()
+
+
+_key_pool = None
+_key_pool_lock = threading.Lock()
+
+def key_pool() -> KeyPool:
+    """The process-wide key pool, started on first use."""
+    global _key_pool
+    with _key_pool_lock:
+        if _key_pool is None:
+            _key_pool = KeyPool()
+        return _key_pool
+
+def generate_exchange_key():
+    """Ephemeral X25519 key for the CONNECT key exchange; microseconds instead of RSA's tens of milliseconds."""
+    return x25519.X25519PrivateKey.generate()
+
+def get_exchange_key(private_key) -> bytes:
+    return private_key.public_key().public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+def derive_session_key(private_key, peer_public_key: bytes) -> bytes:
+    """Session key both sides derive from an X25519 exchange."""
+    shared = private_key.exchange(x25519.X25519PublicKey.from_public_bytes(peer_public_key))
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"voip session key").derive(shared)
+
+def derive_ticket_secret(private_key) -> bytes:
+    """Ticket sealing secret tied to a long-term identity key."""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"voip ticket secret").derive(get_private_key(private_key))
+
+def derive_resumption_secret(session_key: bytes) -> bytes:
+    """Secret both ends keep to resume a session later without a new key exchange."""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"voip resumption").derive(session_key)
+
+def resume_session_key(resumption_secret: bytes, client_nonce: bytes, server_nonce: bytes) -> bytes:
+    """Fresh session key for a resumed session; the nonces keep it from ever repeating."""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=client_nonce + server_nonce, info=b"voip resumed session").derive(resumption_secret)
+
+def resume_proof(resumption_secret: bytes, client_nonce: bytes) -> bytes:
+    """Shows the server that whoever presents a ticket also holds its secret."""
+    return hmac.new(resumption_secret, b"voip resume" + client_nonce, "sha256").digest()
+
+def generate_session_key() -> bytes:
+    return AESGCM.generate_key(bit_length=256)
+
+def wrap_session_key(session_key: bytes, public_key) -> bytes:
+    return load_public_key(public_key).encrypt(session_key, OAEP)
+
+def unwrap_session_key(wrapped_key: bytes, private_key) -> bytes:
+    return load_private_key(private_key).decrypt(wrapped_key, OAEP)
+
+
+class SessionCipher:
+    """AES-GCM cipher for every frame after the CONNECT handshake.
+
+    Each frame carries an 8-byte counter; the 12-byte nonce is that counter
+    behind a 4-byte direction prefix, so client and server share one key
+    without ever reusing a nonce. Frames must arrive in order, anything
+    replayed or reordered is rejected.
+    """
+
+    CLIENT = b"\x00\x00\x00\x01"
+    SERVER = b"\x00\x00\x00\x02"
+    COUNTER_SIZE = 8
+
+    def __init__(self, key: bytes, is_server: bool = False):
+        self.key = key
+        self._aead = AESGCM(key)
+        self._send_prefix, self._receive_prefix = (self.SERVER, self.CLIENT) if is_server else (self.CLIENT, self.SERVER)
+        self.sent = 0
+        self.received = 0
+
+    def encrypt(self, plaintext: bytes, associated_data: bytes = None) -> bytes:
+        counter = self.sent.to_bytes(self.COUNTER_SIZE, 'big')
+        self.sent += 1
+        return counter + self._aead.encrypt(self._send_prefix + counter, plaintext, associated_data)
+
+    def decrypt(self, frame, associated_data: bytes = None) -> bytes:
+        frame = memoryview(frame)
+        counter = bytes(frame[:self.COUNTER_SIZE])
+        if int.from_bytes(counter, 'big') != self.received:
+            raise ValueError("Unexpected session counter, frame replayed or out of order")
+        plaintext = self._aead.decrypt(self._receive_prefix + counter, frame[self.COUNTER_SIZE:], associated_data)
+        self.received += 1
+        return plaintext
+
+
+class GroupCipher:
+    """AES-GCM for the messages of one room under one key epoch.
+
+    A room message is encrypted once and the same bytes go to every member.
+    The nonce is the epoch and the room's message sequence number; the key
+    changes with every epoch, so a nonce never repeats under one key.
+    """
+
+    def __init__(self, key: bytes, epoch: int):
+        self.key = key
+        self.epoch = epoch
+        self._aead = AESGCM(key)
+
+    def _nonce(self, seq: int) -> bytes:
+        return self.epoch.to_bytes(4, 'big') + seq.to_bytes(8, 'big')
+
+    def seal(self, seq: int, plaintext: bytes, associated_data: bytes = None) -> bytes:
+        return self._aead.encrypt(self._nonce(seq), plaintext, associated_data)
+
+    def open(self, seq: int, ciphertext, associated_data: bytes = None) -> bytes:
+        return self._aead.decrypt(self._nonce(seq), ciphertext, associated_data)
+
+
+class MediaCipher:
+    """AES-GCM for the RTP packets of one call.
+
+    The nonce is built from the packet's SSRC, sequence number and timestamp,
+    which never repeat for one sender during a call, and the 12-byte RTP
+    header is authenticated as associated data.
+    """
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self._aead = AESGCM(key)
+
+    @staticmethod
+    def _nonce(header: bytes) -> bytes:
+        return bytes(header[8:12]) + bytes(header[2:8]) + b"\x00\x00"
+
+    def seal(self, header: bytes, payload: bytes) -> bytes:
+        return self._aead.encrypt(self._nonce(header), payload, bytes(header))
+
+    def open(self, header: bytes, ciphertext) -> bytes:
+        return self._aead.decrypt(self._nonce(header), ciphertext, bytes(header))
@@ -1,6 +1,9 @@
+import asyncio
 import json
 import os
 import socket
+import struct
+import time
 
 from . import security
 
@@ -9,25 +12,59 @@ REQUEST_CODES = {
     "BAD_REQUEST": 400,
     "NOT_FOUND": 404,
     "INTERNAL_ERROR": 500,
+    "BUSY": 503,
     "CLOSE": 600,
     "PING": 700,
     "CONNECT": 800,
     "DISCONNECT": 900,
     "FRIENDS_LIST": 1000,
-    "SEND_TEXT": 1100
+    "SEND_TEXT": 1100,
+    "CALL": 1200,
+    "HANGUP": 1300,
+    "CONFERENCE": 1400,
+    "PRESENCE": 1500,
+    "RESUME": 1600,
+    "ROOM_CREATE": 1700,
+    "ROOM_JOIN": 1800,
+    "ROOM_LEAVE": 1900,
+    "ROOM_POST": 2000,
+    "ROOM_KEY": 2100
 }
 
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Binary wire format, negotiated at CONNECT. A binary message is
+# MESSAGE_HEADER (magic, flags, opcode, body length) followed by the rest of
+# the message as compact JSON; an RSA envelope is ENVELOPE_HEADER
+# (magic, flags, key length, iv length) followed by the raw key, iv and
+# ciphertext. JSON text never starts with either magic byte, so receivers
+# tell the formats apart per frame.
+MESSAGE_MAGIC = 0xB1
+ENVELOPE_MAGIC = 0xE1
+MESSAGE_HEADER = struct.Struct("!BBHI")
+ENVELOPE_HEADER = struct.Struct("!BBHH")
+FLAG_ENCRYPTED = 0x01
+
+# Room frame: ROOM_HEADER (magic, flags, room name length, key epoch,
+# sequence) followed by the room name and the message sealed with the room's
+# GroupCipher, header and name authenticated. It bypasses the session cipher
+# so one frame can be written to every member; session frames start with a
+# zero counter byte, so they are never mistaken for one.
+ROOM_MAGIC = 0xC1
+ROOM_HEADER = struct.Struct("!BBHIQ")
+
 base_dir = os.path.dirname(os.path.abspath(__file__))
 
-def get_all_clients_from_json():
-    file_path = os.path.join(base_dir, '..', 'clients.json')
+def get_all_clients_from_json(file_path=None):
+    file_path = file_path or os.path.join(base_dir, '..', 'clients.json')
     import json
     try:
         with open(file_path, 'r') as f:
             clients = json.load(f).get("clients", [])
             return clients
     except FileNotFoundError:
-        return {}
+        return []
     
     
 def get_all_settings_from_json():
@@ -52,15 +89,16 @@ def get_client_by_username(clients, username):
             return client
     return None
 
-def update_client(client):
-    clients = get_all_clients_from_json()
+def update_client(client, file_path=None):
+    file_path = file_path or os.path.join(base_dir, '..', 'clients.json')
+    clients = get_all_clients_from_json(file_path)
     for i, c in enumerate(clients):
         if c['id'] == client['id']:
             clients[i] = client
             break
     else:
         clients.append(client)
-    with open('voip/server/clients.json', 'w') as f:
+    with open(file_path, 'w') as f:
         json.dump({"clients": clients}, f, indent=4)
         
 def print_friends(friends):
@@ -71,37 +109,316 @@ def print_friends(friends):
     else:
         print("No friends available on the server.")
         
-def encode_message(message: dict):
-    return json.dumps(message).encode('utf-8')
+def encode_message(message: dict, binary: bool = False):
+    if not binary:
+        return json.dumps(message).encode('utf-8')
+    body = {key: value for key, value in message.items() if key not in ("code", "encrypted")}
+    body = json.dumps(body, separators=(',', ':')).encode('utf-8') if body else b""
+    flags = FLAG_ENCRYPTED if message.get("encrypted") else 0
+    return MESSAGE_HEADER.pack(MESSAGE_MAGIC, flags, message.get("code", 0), len(body)) + body
+
+def decode_message(data):
+    if isinstance(data, str):
+        return json.loads(data)
+    view = memoryview(data)
+    if not view or view[0] != MESSAGE_MAGIC:
+        return json.loads(str(view, 'utf-8'))
+    _, flags, code, length = MESSAGE_HEADER.unpack_from(view)
+    message = {"code": code}
+    if length:
+        message.update(json.loads(str(view[MESSAGE_HEADER.size:], 'utf-8')))
+    if flags & FLAG_ENCRYPTED:
+        message["encrypted"] = True
+    return message
+
+def pack_envelope(encrypted_block: dict):
+    return b"".join((
+        ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, 0, len(encrypted_block["encrypted_key"]), len(encrypted_block["iv"])),
+        encrypted_block["encrypted_key"],
+        encrypted_block["iv"],
+        encrypted_block["ciphertext"],
+    ))
+
+def unpack_envelope(data):
+    view = memoryview(data)
+    _, _, key_length, iv_length = ENVELOPE_HEADER.unpack_from(view)
+    key_end = ENVELOPE_HEADER.size + key_length
+    return {
+        "encrypted_key": bytes(view[ENVELOPE_HEADER.size:key_end]),
+        "iv": bytes(view[key_end:key_end + iv_length]),
+        "ciphertext": view[key_end + iv_length:],
+    }
+
+
+class FrameReader:
+    """Incremental reader for length-prefixed frames.
+
+    Partial reads are gathered into one reusable buffer. Complete frames are
+    handed out as memoryview slices of that buffer, which stay valid until the
+    next read on the same reader.
+
+    The buffer grows with the bytes that actually arrive, never with the
+    length a header merely announces; frames longer than ``max_frame`` are
+    refused outright.
+    """
+
+    def __init__(self, size: int = 4096, max_frame: int = MAX_FRAME_SIZE):
+        self._buffer = bytearray(size)
+        self._start = 0
+        self._end = 0
+        self.max_frame = max_frame
+
+    @property
+    def buffered(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+    @property
+    def ready(self):
+        """Whether a whole frame is already buffered, e.g. the next of several pipelined requests."""
+        if self.buffered < FRAME_HEADER.size:
+            return False
+        (length,) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        return self._start + FRAME_HEADER.size + length <= self._end
+
+    def _reserve(self, size: int):
+        if self._end + size <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if pending + size <= len(self._buffer):
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(max(2 * len(self._buffer), pending + size))
+            buffer[:pending] = memoryview(self._buffer)[self._start:self._end]
+            self._buffer = buffer
+        self._start, self._end = 0, pending
+
+    def feed(self, data: bytes):
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def fill(self, _socket: socket.socket, size: int = 4096):
+        self._reserve(size)
+        received = _socket.recv_into(memoryview(self._buffer)[self._end:])
+        self._end += received
+        return received
+
+    def next_frame(self):
+        if self.buffered < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        if length > self.max_frame:
+            raise ValueError(f"Frame of {length} bytes exceeds the {self.max_frame} bytes limit")
+        end = self._start + FRAME_HEADER.size + length
+        if end > self._end:
+            return None
+        frame = memoryview(self._buffer)[self._start + FRAME_HEADER.size:end]
+        self._start = end
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frame
+
+    def read_frame(self, _socket: socket.socket, deadline: float = None):
+        """Next frame from ``_socket``; raises ``socket.timeout`` once ``time.monotonic()`` passes ``deadline``."""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("Frame not received in time")
+                _socket.settimeout(remaining)
+            if not self.fill(_socket):
+                raise ConnectionResetError("Connection closed by peer")
+
+
+class FrameWriter:
+    """Outgoing frames of one connection, written together in one vectored send.
+
+    ``write`` only queues a frame and tells the caller whether it is time to
+    flush: the buffer holds ``max_bytes``, ``MAX_BUFFERS`` frames, or a frame
+    that has waited ``max_delay`` seconds. Callers that know more frames are
+    coming, like a writer draining its outbox, flush once at the end.
+    """
+
+    # Stays below IOV_MAX (1024 on Linux) so one sendmsg takes the whole batch.
+    MAX_BUFFERS = 512
+
+    def __init__(self, _socket, max_bytes: int = 64 * 1024, max_delay: float = 0.002):
+        self._socket = _socket
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._frames = []
+        self._size = 0
+        self._since = 0.0
+
+    def write(self, frame: bytes):
+        if not self._frames:
+            self._since = time.monotonic()
+        self._frames.append(frame)
+        self._size += len(frame)
+        return (self._size >= self.max_bytes or len(self._frames) >= self.MAX_BUFFERS
+                or time.monotonic() - self._since >= self.max_delay)
+
+    def flush(self):
+        """Send everything queued; returns the number of bytes written."""
+        if not self._frames:
+            return 0
+        frames, size = self._frames, self._size
+        self._frames, self._size = [], 0
+        send_frames(self._socket, frames)
+        return size
+
+    def __len__(self):
+        return len(self._frames)
+
+
+def set_nodelay(_socket):
+    """Disable Nagle's algorithm: frames are coalesced before they are written, so
+    holding back a small final segment only adds a delayed-ACK round trip."""
+    try:
+        _socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        # Not a TCP socket, e.g. a socketpair in tests.
+        pass
+
+
+def send_frames(_socket, frames):
+    """Write ``frames`` in order with as few system calls as the socket allows.
+
+    Uses scatter-gather ``sendmsg`` where available and resumes after a
+    partial write from the first byte the kernel did not take.
+    """
+    if hasattr(_socket, "writelines"):
+        return _socket.writelines(frames)
+    if not hasattr(_socket, "sendmsg"):
+        return _socket.sendall(b"".join(frames))
+    buffers = [memoryview(frame).cast('B') for frame in frames]
+    first = 0
+    while first < len(buffers):
+        sent = _socket.sendmsg(buffers[first:first + FrameWriter.MAX_BUFFERS])
+        while first < len(buffers) and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+class StreamSocket:
+    """Socket-like facade over an asyncio StreamWriter.
+
+    Lets ``send_message`` and the code around it treat threaded and asyncio
+    connections the same way; writes are buffered until the owning
+    coroutine drains the writer.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def send(self, data: bytes):
+        self.writer.write(data)
+        return len(data)
+
+    sendall = send
+
+    def writelines(self, frames):
+        self.writer.writelines(frames)
+
+    def close(self):
+        self.writer.close()
+
+    def shutdown(self, how=None):
+        self.writer.close()
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+    def __repr__(self):
+        return f"<StreamSocket peer={self.getpeername()}>"
+
+
+def frame_message(message: bytes):
+    return FRAME_HEADER.pack(len(message)) + message
         
-def send_message(message: bytes, _socket: socket.socket, public_key = None):
+def seal_room_frame(message: bytes, room: str, cipher: security.GroupCipher, seq: int):
+    """Encrypt a room message once and frame it for every member."""
+    name = room.encode('utf-8')
+    header = ROOM_HEADER.pack(ROOM_MAGIC, 0, len(name), cipher.epoch, seq) + name
+    return frame_message(header + cipher.seal(seq, message, header))
+
+def is_room_frame(frame):
+    return len(frame) > 0 and frame[0] == ROOM_MAGIC
+
+def parse_room_frame(frame):
+    """Split a room frame into room name, key epoch, sequence, authenticated header and ciphertext."""
+    view = memoryview(frame)
+    _, _, name_length, epoch, seq = ROOM_HEADER.unpack_from(view)
+    end = ROOM_HEADER.size + name_length
+    return str(view[ROOM_HEADER.size:end], 'utf-8'), epoch, seq, bytes(view[:end]), view[end:]
+
+def seal_message(message: bytes, public_key = None, cipher: security.SessionCipher = None, binary: bool = False):
+    """Encrypt an encoded message as requested and frame it for the wire."""
+    if cipher:
+        message = cipher.encrypt(message)
+    elif public_key and binary:
+        message = pack_envelope(security.encrypt_message(message, public_key))
+    elif public_key:
+        message = security.encrypt_message(message, public_key)
+        for key in message:
+            message[key] = message[key].hex()
+        message = encode_message(message)
+    return frame_message(message)
+
+def send_message(message: bytes, _socket: socket.socket, public_key = None, cipher: security.SessionCipher = None, binary: bool = False):
     try:
-        message = security.encrypt_message(message, public_key.encode('utf-8')) if public_key else message
-        if public_key:
-            for key in message:
-                message[key] = message[key].hex()
-            message = encode_message(message)
-        return _socket.send(message)
+        return _socket.sendall(seal_message(message, public_key, cipher, binary))
     except socket.error as e:
         raise e
     
-def receive_message(_socket: socket.socket, private_key = None):
+def unwrap_message(response, private_key = None, cipher: security.SessionCipher = None):
+    if cipher:
+        return cipher.decrypt(response)
+    if not private_key:
+        return response
+    if response[0] == ENVELOPE_MAGIC:
+        return security.decrypt_message(unpack_envelope(response), private_key)
+    response = json.loads(str(response, 'utf-8'))
+    for key in response.copy():
+        response[key] = bytes.fromhex(response[key])
+    return security.decrypt_message(response, private_key)
+
+def receive_message(_socket: socket.socket, private_key = None, frames: FrameReader = None, cipher: security.SessionCipher = None):
     try:
-        response = _socket.recv(1024)
-        if private_key:
-            response = response.decode('utf-8')
-            response = json.loads(response)
-            for key in response.copy():
-                response[key] = bytes.fromhex(response[key])
-        message = security.decrypt_message(response, private_key) if private_key else response
-        return message
+        frames = frames if frames is not None else FrameReader()
+        response = frames.read_frame(_socket)
+        return unwrap_message(response, private_key, cipher)
     except socket.error as e:
         raise e
+
+async def read_frame_async(reader, frames: FrameReader):
+    frame = frames.next_frame()
+    while frame is None:
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionResetError("Connection closed by peer")
+        frames.feed(data)
+        frame = frames.next_frame()
+    return frame
+
+async def receive_message_async(reader, private_key = None, frames: FrameReader = None, cipher: security.SessionCipher = None):
+    frames = frames if frames is not None else FrameReader()
+    response = await read_frame_async(reader, frames)
+    return unwrap_message(response, private_key, cipher)
         
-def send_message_and_wait_for_response(message, _socket: socket.socket, private_key=None, public_key=None):
+def send_message_and_wait_for_response(message, _socket: socket.socket, private_key=None, public_key=None, frames: FrameReader = None, cipher: security.SessionCipher = None, binary: bool = False):
     try:
-        send_message(message, _socket, public_key)
-        message = receive_message(_socket, private_key)
+        send_message(message, _socket, public_key, cipher, binary)
+        message = receive_message(_socket, private_key, frames, cipher)
         return message
     except socket.error as e:
-        raise e
\ No newline at end of file
+        raise e